@@ -0,0 +1,240 @@
+# Sytem imports
+import os
+import hashlib
+from typing import Tuple, Dict, Any, List, BinaryIO
+from uuid import UUID, uuid5
+
+# FastAPI-related imports
+from app.postgres.mappings import Audio_Blob, Audio_File, User
+from app.postgres.utils import unix_timestamp
+from app import log
+
+# SQLAlchemy-related imports
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# unreferenced blobs are kept this long before the worker deletes them, an upload of the same content in the meantime revives them
+BLOB_SWEEP_GRACE_SECONDS = int(os.getenv("BLOB_SWEEP_GRACE_SECONDS") or 3600)
+
+# namespace of the content-addressed blob names
+CONTENT_NAMESPACE = UUID("5d3c8e0a-1f4b-4e5c-9a57-0b6f1e2d7c94")
+
+def hash_file(f: BinaryIO) -> str:
+    # blocking, run in a thread, hashlib releases the GIL while it hashes each chunk
+    f.seek(0)
+    sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+    f.seek(0)
+
+    return sha256
+
+def content_blob_name(sha256: str, content_type: str) -> UUID:
+    # the same bytes uploaded with the same content type always map to the same blob
+    return uuid5(CONTENT_NAMESPACE, f"{sha256}/{content_type}")
+
+async def reference_blob(
+    session: AsyncSession,
+    blob_name: UUID,
+    sha256: str,
+    content_type: str,
+    size: int
+) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Adds a reference to a content-addressed blob, creating its row on the first one. Part of the caller's transaction.
+
+    The row stays locked until the caller commits, together with the audio file pointing at the blob: the worker's sweep cannot
+    claim it in the meantime, and a failed insert rolls the reference back instead of leaving the count inflated.
+
+    Returns:
+        (bool, dict): (True, { "ref_count": int, "created": bool }) with the count after this reference, or (False, { "error": str }).
+                      created means the row was (re)created by this reference, the blob may have been swept and has to be
+                      uploaded before the caller commits.
+    """
+    try:
+        now = unix_timestamp()
+
+        # waits for a sweep that has claimed the row, which is then gone and inserted again below
+        await session.execute(
+            select(Audio_Blob.blob_name).where(Audio_Blob.blob_name == blob_name).with_for_update()
+        )
+
+        statement = insert(Audio_Blob).values(
+            blob_name=blob_name,
+            sha256=sha256,
+            content_type=content_type,
+            size=size,
+            ref_count=1,
+            created_at=now
+        )
+        # a concurrent first reference inserts it first, this one then waits for its commit and adds to its count
+        statement = statement.on_conflict_do_update(
+            index_elements=["blob_name"],
+            set_={"ref_count": Audio_Blob.ref_count + 1, "updated_at": now}
+        ).returning(Audio_Blob.ref_count)
+
+        ref_count = (await session.execute(statement)).scalar_one()
+
+        return True, {
+            "ref_count": ref_count,
+            "created": ref_count == 1
+        }
+    except Exception as e:
+        log.error("Postgres", "Failed to reference blob", blob_name=str(blob_name), error=str(e))
+        return False, {
+            "error": str(e)
+        }
+
+async def reference_blobs(
+    session: AsyncSession,
+    blobs: List[Dict[str, Any]]
+) -> Dict[UUID, int]:
+    """
+    Batch version of reference_blob, one INSERT ... ON CONFLICT for every blob. Part of the caller's transaction, the rows
+    stay locked until it commits.
+
+    Args:
+        blobs (list): { "blob_name", "sha256", "content_type", "size", "ref_count" }, each blob_name once, ref_count being the references to add.
+
+    Returns:
+        dict: blob_name -> ref_count after the references were added.
+    """
+    now = unix_timestamp()
+    # locked in the same order by every request, two bulk uploads sharing blobs cannot deadlock
+    blobs = sorted(blobs, key=lambda blob: blob.get("blob_name"))
+
+    # waits for sweeps that have claimed any of the rows, which are then gone and inserted again below
+    await session.execute(
+        select(Audio_Blob.blob_name).where(
+            Audio_Blob.blob_name.in_([blob.get("blob_name") for blob in blobs])
+        ).order_by(Audio_Blob.blob_name).with_for_update()
+    )
+
+    statement = insert(Audio_Blob).values([{**blob, "created_at": now} for blob in blobs])
+    statement = statement.on_conflict_do_update(
+        index_elements=["blob_name"],
+        set_={"ref_count": Audio_Blob.ref_count + statement.excluded.ref_count, "updated_at": now}
+    ).returning(Audio_Blob.blob_name, Audio_Blob.ref_count)
+
+    return {row.blob_name: row.ref_count for row in await session.execute(statement)}
+
+async def release_blob(
+    session: AsyncSession,
+    blob_name: UUID,
+    count: int = 1
+):
+    # part of the caller's transaction, blobs uploaded before deduplication have no row and are left alone
+    await session.execute(
+        update(Audio_Blob).where(
+            Audio_Blob.blob_name == blob_name,
+            Audio_Blob.ref_count > 0
+        ).values(
+            ref_count=func.greatest(Audio_Blob.ref_count - count, 0),
+            updated_at=unix_timestamp()
+        )
+    )
+
+async def release_user_blobs(
+    session: AsyncSession,
+    user_id: UUID
+):
+    """
+    Releases every reference held by the user's audio files, which deleting the user removes with ON DELETE CASCADE.
+
+    Part of the caller's transaction, which has to delete the user before it commits. The user's row is locked first,
+    so that an audio file inserted concurrently either is counted here or fails its foreign key once the user is gone.
+    """
+    await session.execute(select(User.id).where(User.id == user_id).with_for_update())
+
+    references = select(
+        Audio_File.blob_name,
+        func.count().label("count")
+    ).where(
+        Audio_File.user_id == user_id
+    ).group_by(
+        Audio_File.blob_name
+    ).subquery()
+
+    # locked in blob_name order like reference_blobs, so that this cannot deadlock with an upload of the same blobs
+    await session.execute(
+        select(Audio_Blob.blob_name).where(
+            Audio_Blob.blob_name.in_(select(references.c.blob_name))
+        ).order_by(Audio_Blob.blob_name).with_for_update()
+    )
+
+    # one statement for all of them, blobs uploaded before deduplication have no row and are left alone
+    await session.execute(
+        update(Audio_Blob).where(
+            Audio_Blob.blob_name == references.c.blob_name,
+            Audio_Blob.ref_count > 0
+        ).values(
+            ref_count=func.greatest(Audio_Blob.ref_count - references.c.count, 0),
+            updated_at=unix_timestamp()
+        )
+    )
+
+async def track_orphan_blobs(
+    session: AsyncSession,
+    blobs: List[Dict[str, Any]]
+):
+    """
+    Registers uploaded blobs that ended up without an audio file, with no references, so that the worker's sweep deletes them.
+
+    Blobs that are referenced in the meantime (same content uploaded again) already have a row and are left as they are. Commits.
+
+    Args:
+        blobs (list): { "blob_name", "sha256", "content_type", "size" } of every orphan.
+    """
+    if len(blobs) == 0:
+        return
+
+    try:
+        now = unix_timestamp()
+
+        await session.execute(
+            insert(Audio_Blob).values([{**blob, "ref_count": 0, "created_at": now, "updated_at": now} for blob in blobs]).on_conflict_do_nothing(index_elements=["blob_name"])
+        )
+        await session.commit()
+    except Exception as e:
+        log.error("Postgres", "Failed to track orphan blobs", count=len(blobs), error=str(e))
+        await session.rollback()
+
+async def claim_unreferenced_blob(session: AsyncSession) -> Audio_Blob:
+    # locked until the caller commits, so a concurrent reference_blob waits instead of reviving a blob that is being deleted
+    # oldest first, a blob that could not be deleted is postponed (postpone_blob) and goes to the back
+    unreferenced_since = func.coalesce(Audio_Blob.updated_at, Audio_Blob.created_at)
+
+    return (await session.execute(
+        select(Audio_Blob).where(
+            Audio_Blob.ref_count == 0,
+            unreferenced_since < unix_timestamp() - BLOB_SWEEP_GRACE_SECONDS
+        ).order_by(unreferenced_since).limit(1).with_for_update(skip_locked=True)
+    )).scalar_one_or_none()
+
+async def postpone_blob(session: AsyncSession, blob_name: UUID):
+    # claimed again once BLOB_SWEEP_GRACE_SECONDS have passed, the other unreferenced blobs are swept in the meantime
+    await session.execute(update(Audio_Blob).where(Audio_Blob.blob_name == blob_name).values(updated_at=unix_timestamp()))
+
+async def forget_blob(session: AsyncSession, blob_name: UUID):
+    await session.execute(delete(Audio_Blob).where(Audio_Blob.blob_name == blob_name))
+
+def select_blob_stats(user_id: UUID):
+    # the blobs behind the user's audio files, logical bytes are what storage would hold for them without deduplication
+    # files uploaded before deduplication have no blob row and are not counted
+    per_blob = select(
+        Audio_Blob.size,
+        func.count().label("references")
+    ).join(
+        Audio_File, Audio_File.blob_name == Audio_Blob.blob_name
+    ).where(
+        Audio_File.user_id == user_id,
+        Audio_File.deleted_at.is_(None)
+    ).group_by(
+        Audio_Blob.blob_name
+    ).subquery()
+
+    return select(
+        func.count().label("blobs"),
+        func.coalesce(func.sum(per_blob.c.references), 0).label("references"),
+        func.coalesce(func.sum(per_blob.c.size), 0).label("stored_bytes"),
+        func.coalesce(func.sum(per_blob.c.size * per_blob.c.references), 0).label("logical_bytes")
+    )
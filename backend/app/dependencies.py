@@ -1,89 +1,304 @@
 # Sytem imports
 import os
+import time
+import asyncio
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Union
+from typing import Union, Dict, Tuple, Callable, Any, Annotated
+from uuid import UUID, uuid4
 
 # FastAPI-related imports
-from app.postgres.postgres_db import Postgres_DB
-from fastapi import HTTPException, status
+from app.cache import TTLCache
+from app.postgres.migrations import migrate, schema_version, LATEST_VERSION, USER_CHANGES_CHANNEL
+from app.postgres.utils import unix_timestamp
+from app.metrics import InstrumentedPool, instrument_engine, register_cache, PASSWORD_HASH_SECONDS
+from app import log
+from app.postgres.async_postgres_db import Async_Postgres_DB
+from fastapi import HTTPException, status, Depends
 from app.postgres.mappings import User
+from pydantic import BaseModel, ConfigDict
 
 # SQLAlchemy-related imports
-from sqlalchemy import create_engine, Engine
-from sqlalchemy.orm import Session
+import asyncpg
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 
 # Security-related imports
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 
+# storage-related imports
+from app.storage.base import BaseStorage
+
 # token-related imports
 import jwt
 from jwt.exceptions import InvalidTokenError
 
-engine: Engine = create_engine(
-    f"postgresql+psycopg2://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('POSTGRES_HOST')}/{os.getenv('POSTGRES_DATABASE')}",
-    isolation_level="SERIALIZABLE"
+# token key material, read once when the process starts instead of on every encode / decode
+SECRET_KEY = os.getenv("SECRET_KEY")
+JWT_SIGNING_ALGORITHM = os.getenv("JWT_SIGNING_ALGORITHM")
+ACCESS_TOKEN_EXPIRE_MINUTES = float(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES") or 30)
+
+# sha256(token) -> verified claims, each entry expires together with its token
+token_cache = TTLCache(max_size=int(os.getenv("TOKEN_CACHE_SIZE") or 10000))
+register_cache("token", token_cache)
+
+# optional in-process check for revoked tokens, called as token_denylist(token_hash, claims) on every decode
+token_denylist: Union[Callable[[bytes, Dict[str, Any]], bool], None] = None
+
+# user_id -> UserScheme snapshot of the authenticated user, only used while listen_for_user_changes is connected:
+# postgres notifies every process of changed users (disabled, deleted) as their transaction commits,
+# the ttl only bounds how long a notification lost to a dropped connection can go unnoticed
+CURRENT_USER_CACHE_TTL = float(os.getenv("CURRENT_USER_CACHE_TTL") or 30)
+current_user_cache = TTLCache(max_size=int(os.getenv("CURRENT_USER_CACHE_SIZE") or 10000))
+register_cache("current_user", current_user_cache)
+
+class UserScheme(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: UUID
+    username: str
+    email: str
+    full_name: str
+    disabled: bool
+
+# server processes sharing the database (uvicorn / gunicorn workers), and the connections all of them may hold together,
+# keep the budget below postgres' max_connections minus what the worker and admin sessions need
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY") or 1)
+POSTGRES_CONNECTION_BUDGET = int(os.getenv("POSTGRES_CONNECTION_BUDGET") or 80)
+
+# per process, one connection of its share listens for changed users, half of the rest is kept open
+# and the other half is opened on demand, unless set explicitly
+POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE") or max((POSTGRES_CONNECTION_BUDGET // WEB_CONCURRENCY - 1) // 2, 2))
+POSTGRES_MAX_OVERFLOW = int(os.getenv("POSTGRES_MAX_OVERFLOW") or max(POSTGRES_CONNECTION_BUDGET // WEB_CONCURRENCY - 1 - POSTGRES_POOL_SIZE, 0))
+# seconds a request waits for a connection before failing, see db_pool_checkout_timeouts_total
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT") or 10)
+# connections older than this are replaced on checkout, below the idle timeouts of load balancers / pgbouncer
+POSTGRES_POOL_RECYCLE = int(os.getenv("POSTGRES_POOL_RECYCLE") or 1800)
+# a round trip on checkout, so that connections left dead by a failover are replaced instead of failing a request
+POSTGRES_POOL_PRE_PING = (os.getenv("POSTGRES_POOL_PRE_PING") or "true").lower() == "true"
+# behind pgbouncer in transaction pooling mode consecutive statements may run on different server connections,
+# so no prepared statement can be reused, and their names have to be unique across the clients of pgbouncer
+POSTGRES_PGBOUNCER = (os.getenv("POSTGRES_PGBOUNCER") or "false").lower() == "true"
+# pgbouncer in transaction pooling mode does not relay notifications, point this at postgres itself there
+POSTGRES_LISTEN_HOST = os.getenv("POSTGRES_LISTEN_HOST") or os.getenv("POSTGRES_HOST")
+# seconds between round trips on the listening connection, a connection that died silently is noticed (and the cache bypassed) within this
+USER_LISTENER_PING_SECONDS = float(os.getenv("USER_LISTENER_PING_SECONDS") or 5)
+user_listener_connected = False
+# single-process development setups only, otherwise every worker would migrate on start, see python -m app.migrate
+MIGRATE_ON_STARTUP = (os.getenv("MIGRATE_ON_STARTUP") or "false").lower() == "true"
+
+def connect_args() -> Dict[str, Any]:
+    if not POSTGRES_PGBOUNCER:
+        return {}
+
+    return {
+        # asyncpg's own statement cache, and the one of sqlalchemy's asyncpg dialect
+        "statement_cache_size": 0,
+        "prepared_statement_cache_size": 0,
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__"
+    }
+
+# default isolation for writes, stricter levels are opted into per operation below
+engine: AsyncEngine = create_async_engine(
+    f"postgresql+asyncpg://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('POSTGRES_HOST')}/{os.getenv('POSTGRES_DATABASE')}",
+    isolation_level=os.getenv("POSTGRES_ISOLATION_LEVEL") or "READ COMMITTED",
+    # the default pool class, plus the checkout wait histogram of /metrics
+    poolclass=InstrumentedPool,
+    pool_size=POSTGRES_POOL_SIZE,
+    max_overflow=POSTGRES_MAX_OVERFLOW,
+    pool_timeout=POSTGRES_POOL_TIMEOUT,
+    pool_recycle=POSTGRES_POOL_RECYCLE,
+    pool_pre_ping=POSTGRES_POOL_PRE_PING,
+    connect_args=connect_args()
 )
+# statement timings by fingerprint, shared by the engines derived below
+instrument_engine(engine)
+
+# same connection pool, different transaction characteristics
+read_engine: AsyncEngine = engine.execution_options(isolation_level="READ COMMITTED", postgresql_readonly=True)
+serializable_engine: AsyncEngine = engine.execution_options(isolation_level="SERIALIZABLE")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# expire_on_commit=False, otherwise reading obj.id after a commit would trigger an implicit (sync) refresh
+async_session = async_sessionmaker(engine, expire_on_commit=False)
+async_read_session = async_sessionmaker(read_engine, expire_on_commit=False)
+async_serializable_session = async_sessionmaker(serializable_engine, expire_on_commit=False)
+
+# min / max pin the cost factor, hashes made with any other cost are rehashed on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS") or 12)
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+
+# bcrypt takes 100ms+ of cpu per call, it runs on these threads (bcrypt releases the GIL) instead of the event loop
+# jobs beyond PASSWORD_HASH_MAX_PENDING (running + queued) are turned away with a 429
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS") or os.cpu_count() or 1)
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING") or PASSWORD_HASH_WORKERS * 4)
+
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_jobs_pending = 0
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def get_session():
-    with Session(engine) as session:
+# blob storage backend, "azure" or "local", created in main.lifespan and shared by every request
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND") or "azure"
+storage: Union[BaseStorage, None] = None
+
+async def get_session():
+    async with async_session() as session:
+        yield session
+
+# read-only transactions, for routes that never write
+async def get_read_session():
+    async with async_read_session() as session:
+        yield session
+
+# for writes that must not interleave with concurrent writes, serialization failures are retried by Async_Postgres_DB
+async def get_serializable_session():
+    async with async_serializable_session() as session:
         yield session
 
-def initialise_db():
+async def initialise_db():
     try:
-        success = Postgres_DB.test_connection(engine=engine)
+        log.info(
+            "Postgres", "Connection pool",
+            pool_size=POSTGRES_POOL_SIZE,
+            max_overflow=POSTGRES_MAX_OVERFLOW,
+            pool_timeout=POSTGRES_POOL_TIMEOUT,
+            pool_recycle=POSTGRES_POOL_RECYCLE,
+            pool_pre_ping=POSTGRES_POOL_PRE_PING,
+            pgbouncer=POSTGRES_PGBOUNCER,
+            web_concurrency=WEB_CONCURRENCY
+        )
+
+        if MIGRATE_ON_STARTUP:
+            success, res = await migrate(engine=engine)
+
+            if not success:
+                raise Exception(res.get("error"))
+
+            success = await create_default_user()
+
+            if not success:
+                raise Exception("Could not create default user")
+
+        # the schema is created by python -m app.migrate, only its version is checked here, which also opens the first pooled connection
+        success, res = await schema_version(engine=engine)
 
         if not success:
             raise Exception("Could not connect to the database")
 
-        success = Postgres_DB.create_all_tables(engine=engine)
+        if res.get("version") is None or res.get("version") < LATEST_VERSION:
+            raise Exception(f"The database schema is at {res.get('version')}, expected {LATEST_VERSION}, run python -m app.migrate")
 
-        if not success:
-            raise Exception("Could not create tables")
-        
-        success = create_default_user(engine=engine)
+    except Exception as e:
+        log.error("FastAPI", "Fatal Error", error=str(e))
+
+async def dispose_db():
+    await engine.dispose()
+
+async def listen_for_user_changes():
+    # runs for the lifetime of the process (main.lifespan), reconnecting whenever its connection is lost
+    global user_listener_connected
+
+    def on_user_changed(conn, pid, channel, payload):
+        # payload is the id of the user, as the token's sub
+        current_user_cache.invalidate(payload)
+
+    while True:
+        conn = None
+
+        try:
+            conn = await asyncpg.connect(f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{POSTGRES_LISTEN_HOST}/{os.getenv('POSTGRES_DATABASE')}")
+            await conn.add_listener(USER_CHANGES_CHANNEL, on_user_changed)
+
+            # changes made while nothing was listening were missed
+            current_user_cache.clear()
+            user_listener_connected = True
+            log.info("Postgres", "Listening for user changes", channel=USER_CHANGES_CHANNEL)
+
+            while True:
+                await asyncio.sleep(USER_LISTENER_PING_SECONDS)
+                await conn.execute("SELECT 1", timeout=USER_LISTENER_PING_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Postgres", "Not listening for user changes", error=str(e))
+        finally:
+            user_listener_connected = False
+
+            if conn is not None:
+                conn.terminate()
+
+        await asyncio.sleep(USER_LISTENER_PING_SECONDS)
+
+async def initialise_storage():
+    global storage
+
+    try:
+        # backends are imported lazily, the azure sdk is only loaded when it is used
+        if STORAGE_BACKEND == "azure":
+            from app.storage.azure import AzureStorage
+            storage = AzureStorage()
+        elif STORAGE_BACKEND == "local":
+            from app.storage.local import LocalStorage
+            storage = LocalStorage()
+        else:
+            raise Exception(f"Unknown storage backend {STORAGE_BACKEND!r}")
+
+        success = await storage.initialise()
 
         if not success:
-            raise Exception("Could not create default user")
+            raise Exception(f"Could not initialise {STORAGE_BACKEND} storage")
 
     except Exception as e:
-        print(f"[!] (FastAPI) Fatal Error: {e}")
+        log.error("FastAPI", "Fatal Error", error=str(e))
+
+async def dispose_storage():
+    global storage
+
+    if storage is not None:
+        await storage.dispose()
+        storage = None
 
-def dispose_db():
-    engine.dispose()
+def get_storage() -> BaseStorage:
+    if storage is None:
+        raise Exception("Storage has not been initialised")
 
-@staticmethod
-def create_default_user(engine: Engine) -> bool:
+    return storage
 
-    with Session(engine) as session:
+async def create_default_user() -> bool:
+    # run by python -m app.migrate, a no-op once the user exists, also when several processes run it at the same time
+    async with async_session() as session:
         try:
-            success, res = Postgres_DB.retrieve(session=session, tbl=User, value="admin", col_name="username")
+            success, res = await Async_Postgres_DB.retrieve(session=session, tbl=User, value="admin", col_name="username")
 
             if not success:
                 raise Exception(res.get("error"))
-            elif len(res.get("objs")) > 0: # user already exists
+            elif len(res.get("objs")) > 0: # user already exists, skip the bcrypt hash
                 return True
 
-            user = User(
+            await session.execute(insert(User).values(
+                id=uuid4(),
                 username="admin",
                 email="admin@gmail.com",
-                password_hash=get_password_hash("admin"),
-                full_name="Administrator"
-            )
-
-            success, res = Postgres_DB.insert(session=session, obj=user)
+                password_hash=await get_password_hash("admin"),
+                full_name="Administrator",
+                disabled=False,
+                created_at=unix_timestamp()
+            ).on_conflict_do_nothing())
+            await session.commit()
 
-            if not success:
-                raise Exception(res.get("error"))
-            
             return True
     
         except Exception as e:
-            print(f"[!] (Postgres) Failed to create default user: {e}")
+            log.error("Postgres", "Failed to create default user", error=str(e))
             return False
 
 # Token-related functions
@@ -99,11 +314,11 @@ def create_access_token(
         if expires_delta:
             expire = datetime.now(timezone.utc) + expires_delta
         else:
-            expire = datetime.now(timezone.utc) + timedelta(minutes=float(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")))
+            expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         
         to_encode.update({"exp": expire})
 
-        encoded_jwt = jwt.encode(to_encode, os.getenv("SECRET_KEY"), algorithm=os.getenv("JWT_SIGNING_ALGORITHM"))
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=JWT_SIGNING_ALGORITHM)
 
         # do not change this format, it is the format expected by the OAuth2
         return True, { "access_token": encoded_jwt, "token_type": "bearer" }
@@ -116,8 +331,18 @@ def decode_access_token(
     token: str
 ):
     try:
-        # will raise an exception if the token is invalid, or if the token is expired
-        payload = jwt.decode(token, os.getenv("SECRET_KEY"), algorithms=[os.getenv("JWT_SIGNING_ALGORITHM")])
+        token_hash = hashlib.sha256(token.encode()).digest()
+
+        # the cache only holds tokens whose signature was verified, and drops them once they expire
+        payload = token_cache.get(token_hash)
+
+        if payload is None:
+            # will raise an exception if the token is invalid, or if the token is expired
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[JWT_SIGNING_ALGORITHM])
+            token_cache.set(token_hash, payload, expires_at=payload.get("exp"))
+
+        if token_denylist is not None and token_denylist(token_hash, payload):
+            raise Exception("Token has been revoked")
 
         user_id: str = payload.get("sub") # sub is the subject of the token, which is the user_id
         
@@ -133,11 +358,86 @@ def decode_access_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+async def current_user(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    session: Annotated[AsyncSession, Depends(get_read_session)]
+) -> UserScheme:
+    user_id = decode_access_token(token)
+
+    # without the listener a cached snapshot could outlive a disabled or deleted user, every request reads the row then
+    user: Union[UserScheme, None] = current_user_cache.get(user_id) if user_listener_connected else None
+
+    if user is None:
+        success, res = await Async_Postgres_DB.retrieve(session=session, tbl=User, value=UUID(user_id))
+
+        if not success:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=res.get("error")
+            )
+        elif len(res.get("objs")) == 0:
+            # e.g., the user was deleted after the token was issued
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not validate credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
+        user = UserScheme.model_validate(res.get("objs")[0])
+
+        if user_listener_connected:
+            current_user_cache.set(user_id, user, expires_at=time.time() + CURRENT_USER_CACHE_TTL)
+
+    if user.disabled:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="User is disabled"
+        )
+
+    return user
+
+def invalidate_current_user(
+    user_id: Union[str, UUID]
+):
+    current_user_cache.invalidate(str(user_id))
+
+def set_token_denylist(
+    denylist: Union[Callable[[bytes, Dict[str, Any]], bool], None]
+):
+    # e.g., a set of logged out token hashes kept in memory, must not hit the database as it runs on every request
+    global token_denylist
+    token_denylist = denylist
+
 # Auth-related functions
 # -----------------------
 
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+async def run_password_job(func, *args):
+    global password_jobs_pending
+
+    # only touched from the event loop, so the counter needs no lock
+    if password_jobs_pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many password operations in progress, please try again shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    password_jobs_pending += 1
+    start = time.perf_counter()
+
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, functools.partial(func, *args))
+    finally:
+        password_jobs_pending -= 1
+        # hash / verify / verify_and_update
+        PASSWORD_HASH_SECONDS.labels(operation=func.__name__).observe(time.perf_counter() - start)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_job(pwd_context.verify, plain_password, hashed_password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Union[str, None]]:
+    # the second value is a new hash when hashed_password was made with outdated parameters (e.g., BCRYPT_ROUNDS changed)
+    return await run_password_job(pwd_context.verify_and_update, plain_password, hashed_password)
 
-def get_password_hash(password: str):
-    return pwd_context.hash(password)
\ No newline at end of file
+async def get_password_hash(password: str) -> str:
+    return await run_password_job(pwd_context.hash, password)
\ No newline at end of file
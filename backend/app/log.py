@@ -0,0 +1,58 @@
+# Sytem imports
+import os
+import sys
+import json
+import random
+import logging
+from typing import Dict, Any
+
+# routine events (e.g., a row inserted, a request served) are written at this rate, warnings and errors always are
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE") or 0.1)
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").upper()
+
+# a namespace of its own, loggers named after app modules (e.g., sqlalchemy's pool logger) do not end up here
+LOGGER_NAME = "structured"
+
+class JSONFormatter(logging.Formatter):
+    # one json object per line, e.g. {"ts": ..., "level": "error", "component": "Postgres", "event": "Failed to insert", "error": ...}
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "component": record.name.removeprefix(f"{LOGGER_NAME}."),
+            "event": record.getMessage(),
+            **getattr(record, "fields", {})
+        }
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(JSONFormatter())
+
+root_logger = logging.getLogger(LOGGER_NAME)
+root_logger.addHandler(handler)
+root_logger.setLevel(LOG_LEVEL)
+# uvicorn's own handlers are left alone
+root_logger.propagate = False
+
+def write(level: int, component: str, event: str, sampled: bool, fields: Dict[str, Any]):
+    if sampled:
+        if random.random() >= LOG_SAMPLE_RATE:
+            return
+
+        # so that counts can be scaled back up from the logs
+        fields["sample_rate"] = LOG_SAMPLE_RATE
+
+    logging.getLogger(f"{LOGGER_NAME}.{component}").log(level, event, extra={"fields": fields})
+
+def info(component: str, event: str, sampled: bool = False, **fields: Any):
+    write(logging.INFO, component, event, sampled, fields)
+
+def warning(component: str, event: str, **fields: Any):
+    write(logging.WARNING, component, event, False, fields)
+
+def error(component: str, event: str, **fields: Any):
+    write(logging.ERROR, component, event, False, fields)
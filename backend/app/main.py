@@ -1,16 +1,26 @@
 from typing import Annotated
 from fastapi import FastAPI, Depends, Response
 from contextlib import asynccontextmanager
-from app.dependencies import initialise_db, dispose_db, get_session
-from app.routers import users, audio_files
+import asyncio
+from app.dependencies import initialise_db, dispose_db, listen_for_user_changes, initialise_storage, dispose_storage, STORAGE_BACKEND, get_session
+from app.routers import users, audio_files, uploads, storage
+from app.metrics import MetricsMiddleware, start_metrics_server, mirror_collectors_periodically, MULTIPROCESS
+from app import log
 from fastapi.security import OAuth2PasswordRequestForm
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("[*] (FastAPI) Initialising...")
-    initialise_db()
+    log.info("FastAPI", "Initialising")
+    await initialise_db()
+    await initialise_storage()
+    # keeps the current_user cache of this worker in step with the users table
+    user_listener_task = asyncio.create_task(listen_for_user_changes())
+    # one per worker under app.server, the pool and cache gauges of every worker are shared through PROMETHEUS_MULTIPROC_DIR
+    mirror_task = asyncio.create_task(mirror_collectors_periodically()) if MULTIPROCESS else None
+    # under app.server the metrics of every worker are served by the gunicorn master instead
+    metrics_server = start_metrics_server() if not MULTIPROCESS else None
     # ---------------------------------------
     # Before server starts, run code above
 
@@ -18,18 +28,33 @@ async def lifespan(app: FastAPI):
 
     # Before server stops, run code below
     # ---------------------------------------
-    print("[*] (FastAPI) Shutting down...")
-    dispose_db()
+    log.info("FastAPI", "Shutting down")
+    if mirror_task is not None:
+        mirror_task.cancel()
+    if metrics_server is not None:
+        await asyncio.to_thread(metrics_server.shutdown)
+        metrics_server.server_close()
+    user_listener_task.cancel()
+    await dispose_storage()
+    await dispose_db()
 
 app = FastAPI(lifespan=lifespan)
 
+# request latency histograms by route and the sampled access log
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(users.router)
 app.include_router(audio_files.router)
+app.include_router(uploads.router)
+
+# signed playback urls of the local backend point at this router
+if STORAGE_BACKEND == "local":
+    app.include_router(storage.router)
 
 @app.post("/token")
 async def login(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)]
 ):
     return await users.login_for_access_token(username=form_data.username, password=form_data.password, session=session)
 
@@ -0,0 +1,361 @@
+# Sytem imports
+import os
+import re
+import time
+import asyncio
+import hashlib
+import functools
+from typing import Dict, Tuple, List, Any, Callable, AsyncIterator
+
+# FastAPI-related imports
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+from app.cache import TTLCache
+from app import log
+
+# prometheus-related imports
+from prometheus_client import Histogram, Counter, Gauge, REGISTRY, CollectorRegistry, multiprocess, start_http_server
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from prometheus_client.registry import Collector
+
+# SQLAlchemy-related imports
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# requests slower than this are always logged, faster ones are sampled (LOG_SAMPLE_RATE)
+LOG_SLOW_REQUEST_SECONDS = float(os.getenv("LOG_SLOW_REQUEST_SECONDS") or 1)
+
+# set by app.server when there are several workers, counters and histograms are then shared through files in that directory
+MULTIPROCESS = os.getenv("PROMETHEUS_MULTIPROC_DIR") is not None
+# the scrape target, a listener of its own so that metrics are never served on the public port (PORT),
+# docker-compose.yaml does not publish it and prometheus reaches it over the internal network, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 9100)
+METRICS_ADDR = os.getenv("METRICS_ADDR") or "0.0.0.0"
+# seconds between copies of the scrape-time collectors (pool, caches) to the shared files, see mirror_collectors
+METRICS_MIRROR_INTERVAL = float(os.getenv("METRICS_MIRROR_INTERVAL") or 5)
+
+# buckets from 1 ms to 30 s, wide enough for a cached token lookup and a multi-gigabyte upload alike
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time from the request to the last byte of the response, by route template",
+    ["method", "route", "status_code"],
+    buckets=LATENCY_BUCKETS
+)
+
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Time spent executing a statement, by statement fingerprint (see the 'New statement fingerprint' log event for its sql)",
+    ["operation", "fingerprint"],
+    buckets=LATENCY_BUCKETS
+)
+DB_QUERY_ERRORS = Counter(
+    "db_query_errors_total",
+    "Statements that raised, by statement fingerprint",
+    ["operation", "fingerprint"]
+)
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection, including opening a new one",
+    buckets=LATENCY_BUCKETS
+)
+DB_POOL_CHECKOUT_TIMEOUTS = Counter(
+    "db_pool_checkout_timeouts_total",
+    "Checkouts that gave up after POSTGRES_POOL_TIMEOUT because every connection was in use"
+)
+DB_POOL_INVALIDATIONS = Counter(
+    "db_pool_invalidated_connections_total",
+    "Connections discarded as dead, by the pre-ping on checkout or after an error on a statement",
+    ["source"]
+)
+
+STORAGE_SECONDS = Histogram(
+    "storage_operation_duration_seconds",
+    "Time spent in a blob storage operation, a read is timed until its last chunk is consumed",
+    ["backend", "operation", "outcome"],
+    buckets=LATENCY_BUCKETS
+)
+STORAGE_BYTES = Counter(
+    "storage_bytes_total",
+    "Bytes sent to (upload, stage_block) and read from (read) blob storage",
+    ["backend", "operation"]
+)
+
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_duration_seconds",
+    "Time spent hashing / verifying a password, including the wait for a free executor thread",
+    ["operation"],
+    buckets=LATENCY_BUCKETS
+)
+
+# --------------------------------------------------------------------------------------------------------------------------------------
+# HTTP
+
+class MetricsMiddleware:
+    """
+    Times every request until the last byte of its response, labelled with the route template (e.g. /audio_files/{id}/stream)
+    so that the label set stays bounded, and writes a sampled access log entry.
+
+    A plain ASGI middleware, streaming responses are passed through untouched.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status_code
+
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            # set by the router on the scope once a route matched
+            route = getattr(scope.get("route"), "path", "unmatched")
+
+            HTTP_REQUEST_SECONDS.labels(method=scope["method"], route=route, status_code=status_code).observe(duration)
+
+            fields = {
+                "method": scope["method"],
+                "route": route,
+                "status_code": status_code,
+                "duration_ms": round(duration * 1000, 1)
+            }
+
+            if status_code >= 500 or duration >= LOG_SLOW_REQUEST_SECONDS:
+                log.warning("HTTP", "Request", **fields)
+            else:
+                log.info("HTTP", "Request", sampled=True, **fields)
+
+def metrics_registry() -> CollectorRegistry:
+    if not MULTIPROCESS:
+        return REGISTRY
+
+    # every worker's metrics, read from PROMETHEUS_MULTIPROC_DIR at each scrape
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+
+    return registry
+
+def start_metrics_server():
+    """
+    Serves the metrics on METRICS_ADDR:METRICS_PORT, from a thread of this process.
+
+    Started by the gunicorn master under app.server (its workers write their metrics to PROMETHEUS_MULTIPROC_DIR, and mirror
+    their scrape-time collectors there every METRICS_MIRROR_INTERVAL), and by main.lifespan when the app is a single process.
+
+    Returns:
+        the http server, to be shut down by the caller, or None when METRICS_PORT is 0.
+    """
+    if METRICS_PORT == 0:
+        return None
+
+    server, _ = start_http_server(METRICS_PORT, addr=METRICS_ADDR, registry=metrics_registry())
+    log.info("Metrics", "Serving", addr=METRICS_ADDR, port=METRICS_PORT)
+
+    return server
+
+# --------------------------------------------------------------------------------------------------------------------------------------
+# Multiprocess
+
+# the scrape-time collectors of this process (PoolCollector, CacheCollector)
+local_collectors: List[Collector] = []
+mirrored_gauges: Dict[str, Gauge] = {}
+
+def register_collector(collector: Collector):
+    local_collectors.append(collector)
+    REGISTRY.register(collector)
+
+def mirror_collectors():
+    # collectors only see their own process, so in multiprocess mode their samples are copied to gauges that are summed
+    # over the live workers (ratios are kept per worker, with a pid label), counters become gauges on the way
+    for collector in local_collectors:
+        for family in collector.collect():
+            for sample in family.samples:
+                gauge = mirrored_gauges.get(sample.name)
+
+                if gauge is None:
+                    gauge = Gauge(
+                        sample.name,
+                        family.documentation,
+                        labelnames=list(sample.labels.keys()),
+                        registry=None,
+                        multiprocess_mode="liveall" if family.name.endswith("_ratio") else "livesum"
+                    )
+                    mirrored_gauges[sample.name] = gauge
+
+                (gauge.labels(**sample.labels) if sample.labels else gauge).set(sample.value)
+
+async def mirror_collectors_periodically():
+    # started by main.lifespan in multiprocess mode, so that workers that are not scraped stay current as well
+    while True:
+        try:
+            mirror_collectors()
+        except Exception as e:
+            log.warning("Metrics", "Failed to mirror collectors", error=str(e))
+
+        await asyncio.sleep(METRICS_MIRROR_INTERVAL)
+
+# --------------------------------------------------------------------------------------------------------------------------------------
+# Postgres
+
+# literals and bind parameters, so that the same statement with different values has one fingerprint
+# asyncpg's parameters carry their type ($1::UUID, $2::VARCHAR[]), the cast goes with them so that lists of them still collapse below
+STATEMENT_LITERALS = re.compile(r"'(?:[^']|'')*'|\$\d+(?:::\w+(?: WITH(?:OUT)? TIME ZONE)?(?:\[\])?)?|%\(\w+\)s|\b\d+(?:\.\d+)?\b")
+# multi-row VALUES and IN lists, their length does not change the statement
+STATEMENT_LISTS = re.compile(r"\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))*")
+
+@functools.lru_cache(maxsize=1024)
+def statement_fingerprint(statement: str) -> Tuple[str, str]:
+    # returns (operation, fingerprint), cached by statement text so the regexes run once per distinct statement
+    normalised = " ".join(STATEMENT_LISTS.sub("(?)", STATEMENT_LITERALS.sub("?", statement)).split())
+    operation = normalised.split(" ", 1)[0].upper() if normalised else "UNKNOWN"
+    fingerprint = hashlib.sha1(normalised.encode()).hexdigest()[:12]
+
+    log.info("Postgres", "New statement fingerprint", fingerprint=fingerprint, statement=normalised)
+
+    return operation, fingerprint
+
+def instrument_engine(engine: AsyncEngine):
+    # events of the sync engine the async one wraps, they run around every round trip to postgres
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        operation, fingerprint = statement_fingerprint(statement)
+        DB_QUERY_SECONDS.labels(operation=operation, fingerprint=fingerprint).observe(time.perf_counter() - context.metrics_start)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        if exception_context.statement is not None:
+            operation, fingerprint = statement_fingerprint(exception_context.statement)
+            DB_QUERY_ERRORS.labels(operation=operation, fingerprint=fingerprint).inc()
+
+        if exception_context.is_disconnect:
+            # the pool invalidates the connection right after, pre-ping failures on checkout are reported here as well
+            DB_POOL_INVALIDATIONS.labels(source="pre_ping" if exception_context.is_pre_ping else "statement").inc()
+
+    register_collector(PoolCollector(engine))
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # the default pool of create_async_engine, timing how long a checkout waits for a free (or new) connection
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            DB_POOL_CHECKOUT_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start)
+
+class PoolCollector(Collector):
+    # read at scrape time, nothing is tracked between scrapes
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+
+    def collect(self):
+        pool = self.engine.pool
+
+        if not isinstance(pool, AsyncAdaptedQueuePool):
+            return
+
+        connections = GaugeMetricFamily("db_pool_connections", "Connections of the pool by state", labels=["state"])
+        connections.add_metric(["checked_out"], pool.checkedout())
+        connections.add_metric(["idle"], pool.checkedin())
+        connections.add_metric(["overflow"], max(pool.overflow(), 0))
+        yield connections
+
+        yield GaugeMetricFamily("db_pool_size", "Connections the pool keeps open", value=pool.size())
+
+# --------------------------------------------------------------------------------------------------------------------------------------
+# Storage
+
+def observe_storage(operation: str):
+    # for the (success, res) methods of app.storage backends, bytes are counted from res["size"]
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs) -> Tuple[bool, Dict[str, Any]]:
+            start = time.perf_counter()
+            success, res = await func(self, *args, **kwargs)
+
+            STORAGE_SECONDS.labels(backend=self.name, operation=operation, outcome="success" if success else "error").observe(time.perf_counter() - start)
+
+            if success and "size" in res and operation in ["upload", "stage_block"]:
+                STORAGE_BYTES.labels(backend=self.name, operation=operation).inc(res.get("size"))
+
+            return success, res
+
+        return wrapper
+
+    return decorator
+
+def observe_storage_read(func: Callable) -> Callable:
+    # the read generator is timed from its first to its last chunk, a client that stops listening ends it early
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs) -> AsyncIterator[bytes]:
+        start = time.perf_counter()
+        outcome = "error"
+        size = 0
+
+        try:
+            async for chunk in func(self, *args, **kwargs):
+                size += len(chunk)
+                yield chunk
+
+            outcome = "success"
+        except GeneratorExit:
+            outcome = "aborted"
+            raise
+        finally:
+            STORAGE_SECONDS.labels(backend=self.name, operation="read", outcome=outcome).observe(time.perf_counter() - start)
+            STORAGE_BYTES.labels(backend=self.name, operation="read").inc(size)
+
+    return wrapper
+
+# --------------------------------------------------------------------------------------------------------------------------------------
+# Caches
+
+class CacheCollector(Collector):
+    # TTLCache.stats() of every registered cache, read at scrape time
+    def __init__(self):
+        self.caches: Dict[str, TTLCache] = {}
+
+    def collect(self):
+        hits = CounterMetricFamily("cache_hits", "Lookups that found a live entry", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Lookups that found no entry or an expired one", labels=["cache"])
+        evictions = CounterMetricFamily("cache_evictions", "Entries evicted to stay within max_size", labels=["cache"])
+        entries = GaugeMetricFamily("cache_entries", "Entries held", labels=["cache"])
+        hit_ratio = GaugeMetricFamily("cache_hit_ratio", "Hits over lookups since the process started", labels=["cache"])
+
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            hits.add_metric([name], stats.get("hits"))
+            misses.add_metric([name], stats.get("misses"))
+            evictions.add_metric([name], stats.get("evictions"))
+            entries.add_metric([name], stats.get("size"))
+            hit_ratio.add_metric([name], stats.get("hit_ratio"))
+
+        yield from [hits, misses, evictions, entries, hit_ratio]
+
+cache_collector = CacheCollector()
+register_collector(cache_collector)
+
+def register_cache(name: str, cache: TTLCache):
+    cache_collector.caches[name] = cache
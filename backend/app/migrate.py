@@ -0,0 +1,29 @@
+# Sytem imports
+import sys
+import asyncio
+
+# FastAPI-related imports
+from app.dependencies import engine, create_default_user, dispose_db
+from app.postgres.migrations import migrate
+from app import log
+
+async def main() -> int:
+    try:
+        success, res = await migrate(engine=engine)
+
+        if not success:
+            return 1
+
+        log.info("Postgres", "Schema up to date", version=res.get("version"), applied=res.get("applied"))
+
+        # once per database, the servers no longer create it on start
+        if not await create_default_user():
+            return 1
+
+        return 0
+    finally:
+        await dispose_db()
+
+if __name__ == "__main__":
+    # python -m app.migrate, run once per deploy before the servers / workers start
+    sys.exit(asyncio.run(main()))
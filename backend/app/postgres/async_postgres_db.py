@@ -0,0 +1,393 @@
+# System imports
+import os
+import json
+import random
+import asyncio
+import functools
+from typing import Union, Annotated, Tuple, Dict, Any
+
+# required imports
+from sqlalchemy import Connection, Executable, PrimaryKeyConstraint, ForeignKeyConstraint, select, update, delete, exists, or_, text, bindparam, any_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncConnection, AsyncSession
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError, DBAPIError
+from app.postgres.utils import unix_timestamp, Explain
+from app.postgres.mappings import Base
+from app import log
+
+# QoL imports
+from typing import Type, List, Dict, Tuple
+
+# SQLSTATE codes of the integrity errors mapped in Async_Postgres_DB.integrity_error
+NOT_NULL_VIOLATION = "23502"
+FOREIGN_KEY_VIOLATION = "23503"
+UNIQUE_VIOLATION = "23505"
+
+# SQLSTATE codes of transactions that were aborted by a concurrent transaction, and can simply be run again
+SERIALIZATION_FAILURE = "40001"
+DEADLOCK_DETECTED = "40P01"
+
+# writes are attempted at most 1 + SERIALIZATION_MAX_RETRIES times
+SERIALIZATION_MAX_RETRIES = int(os.getenv("POSTGRES_SERIALIZATION_MAX_RETRIES") or 5)
+SERIALIZATION_BACKOFF_BASE = float(os.getenv("POSTGRES_SERIALIZATION_BACKOFF_BASE") or 0.01)
+SERIALIZATION_BACKOFF_MAX = float(os.getenv("POSTGRES_SERIALIZATION_BACKOFF_MAX") or 0.5)
+
+def retry_on_serialization_failure(func):
+    # retries a write whose result is flagged as retryable, with full-jitter exponential backoff
+    # the write has already rolled back its session when it returns, so it can be called again as is
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs) -> Tuple[bool, Dict[str, Any]]:
+        attempt = 0
+
+        while True:
+            success, res = await func(*args, **kwargs)
+
+            if success or not res.get('retryable') or attempt >= SERIALIZATION_MAX_RETRIES:
+                return success, res
+
+            delay = min(SERIALIZATION_BACKOFF_MAX, SERIALIZATION_BACKOFF_BASE * 2 ** attempt)
+            attempt += 1
+            log.info("Postgres", "Serialization failure, retrying", operation=func.__name__, attempt=attempt, max_retries=SERIALIZATION_MAX_RETRIES)
+            await asyncio.sleep(random.uniform(0, delay))
+
+    return wrapper
+
+# Async Postgres DB Class
+# async twin of Postgres_DB, every query is awaited so that it does not block the event loop
+class Async_Postgres_DB:
+    @staticmethod
+    async def test_connection(engine: AsyncEngine) -> bool:
+        try:
+            async with engine.connect() as conn:
+                conn: AsyncConnection
+                results = (await conn.execute(text('SELECT version()'))).fetchone()
+                log.info("Postgres", "Connection Successful", version=results[0])
+            return True
+        except Exception as e:
+            log.error("Postgres", "Connection Failure", error=str(e))
+            return False
+
+    @staticmethod
+    async def create_all_tables(engine: AsyncEngine, overwrite=False):
+        try:
+            if overwrite:
+                if not await Async_Postgres_DB.drop_all_tables(engine=engine):
+                    # drop tables failure
+                    return False
+            # metadata operations are sync only, so run them on the connection's greenlet
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                # create_all only creates the indexes of tables it creates, so add indexes declared after a table already existed
+                await conn.run_sync(Async_Postgres_DB.create_missing_indexes)
+            return True
+        except (SQLAlchemyError, Exception) as e:
+            log.error("Postgres", "Failed to create tables", error=str(e))
+            return False
+
+    @staticmethod
+    def create_missing_indexes(conn: Connection):
+        for tbl in Base.metadata.sorted_tables:
+            for index in tbl.indexes:
+                index.create(conn, checkfirst=True)
+
+    @staticmethod
+    async def explain(session: AsyncSession, statement: Executable) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            conn = await session.connection()
+            res = (await conn.execute(Explain(statement))).scalar_one()
+
+            # drivers without a json codec hand the plan back as text
+            if isinstance(res, str):
+                res = json.loads(res)
+
+            return True, {
+                'plan': res[0]['Plan']
+            }
+        except (SQLAlchemyError, Exception) as e:
+            log.error("Postgres", "Failed to explain", statement=str(statement), error=str(e))
+            return False, {
+                'error': str(e)
+            }
+
+    @staticmethod
+    def find_seq_scans(plan: Dict[str, Any]) -> List[str]:
+        # walks an EXPLAIN (FORMAT JSON) plan and returns the tables that are read with a sequential scan
+        tables = []
+
+        if plan.get('Node Type') == 'Seq Scan':
+            tables.append(plan.get('Relation Name'))
+
+        for child in plan.get('Plans', []):
+            tables += Async_Postgres_DB.find_seq_scans(child)
+
+        return tables
+
+    @staticmethod
+    async def drop_all_tables(engine: AsyncEngine):
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.drop_all)
+            return True
+        except SQLAlchemyError as e:
+            log.error("Postgres", "Failed to drop tables", error=str(e))
+            return False
+
+    @staticmethod
+    async def retrieve(session: AsyncSession, tbl: Type[Base], value = None, col_name: str = "id") -> Tuple[bool, Dict[str, Any]]:
+        try:
+            # select * by default
+            statement = select(tbl)
+
+            if value is not None:
+                col = getattr(tbl, col_name)
+                if col is None:
+                    raise Exception(f"Column {col_name} does not exist in {tbl.__name__}.")
+                statement = select(tbl).where(col == value)
+
+            # this is list of rows, so we need to convert it into objects first
+            res = await session.execute(statement)
+
+            # converts the rows into classes/scalars
+            return True, {
+                'objs': res.scalars().all()
+            }
+        except (SQLAlchemyError, Exception) as e:
+            log.error("Postgres", "Failed to retrieve", table=tbl.__tablename__, error=str(e))
+            return False, {
+                'error': str(e)
+            }
+
+    @staticmethod
+    async def retrieve_any(session: AsyncSession, tbl: Type[Base], values: List[Any], col_name: str = "id", where: Dict[str, Any] = None) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            col = getattr(tbl, col_name)
+
+            # col = ANY(:values) binds the whole list as one array parameter, so the statement is the same for any list length
+            statement = select(tbl).where(col == any_(bindparam(f"{col_name}_values", value=list(values), type_=ARRAY(col.type))))
+
+            # additional equality filters, e.g., { "user_id": user_id } for ownership checks
+            for filter_col_name, filter_value in (where or {}).items():
+                statement = statement.where(getattr(tbl, filter_col_name) == filter_value)
+
+            res = await session.execute(statement)
+
+            return True, {
+                'objs': res.scalars().all()
+            }
+        except (SQLAlchemyError, Exception) as e:
+            log.error("Postgres", "Failed to retrieve", table=tbl.__tablename__, error=str(e))
+            return False, {
+                'error': str(e)
+            }
+
+    @staticmethod
+    @retry_on_serialization_failure
+    async def insert(session: AsyncSession, obj: Base, pk_constraint: bool = False, fk_constraint: bool = False) -> Tuple[bool, Dict[str, Any]]:
+        # pk_constraint and fk_constraint are enforced by the primary / foreign keys of the table,
+        # a violation fails the INSERT itself and is mapped back to an error in integrity_error
+        try:
+            obj.created_at = unix_timestamp()
+            session.add(obj)
+            await session.commit()
+        except IntegrityError as e:
+            error = Async_Postgres_DB.integrity_error(e=e, obj=obj)
+            log.error("Postgres", "Failed to insert", obj=repr(obj), error=str(error))
+            await session.rollback()
+            return False, {
+                'error': error,
+                'conflict': Async_Postgres_DB.is_conflict(e)
+            }
+        except (SQLAlchemyError, Exception) as e:
+            # log before rolling back, a rollback expires obj and its repr would need another (async) load
+            log.error("Postgres", "Failed to insert", obj=repr(obj), error=str(e))
+            await session.rollback()
+            return False, {
+                'error': str(e),
+                'retryable': Async_Postgres_DB.is_retryable(e)
+            }
+        else:
+            log.info("Postgres", "Inserted", sampled=True, obj=repr(obj))
+            return True, {
+                'id': obj.id,
+                'created_at': obj.created_at
+            }
+
+    @staticmethod
+    @retry_on_serialization_failure
+    async def update(session: AsyncSession, updated_obj: Base) -> Tuple[bool, Dict[str, Any]]:
+        # a single UPDATE ... WHERE <some column changed> RETURNING, instead of loading the row and diffing it in python
+        tbl = updated_obj.__table__
+        values = {}
+        not_found = False
+
+        try:
+            for col in tbl.columns:
+                # do not update primary / foreign key values, as well as created_at, updated_at, deleted_at
+                if col.primary_key or len(col.foreign_keys) > 0 or col.name in ["created_at", "updated_at", "deleted_at"]:
+                    continue
+
+                # generated columns (e.g., search_vector) are maintained by postgres
+                if col.computed is not None:
+                    continue
+
+                new_value = getattr(updated_obj, col.name)
+
+                # None means "unchanged" for columns that cannot be null
+                if new_value is None and not col.nullable:
+                    continue
+
+                values[col.name] = new_value
+
+            if len(values) == 0:
+                raise Exception(f"No changes detected in {updated_obj}.")
+
+            statement = update(tbl).where(
+                tbl.c.id == updated_obj.id,
+                or_(*[tbl.c[col_name].is_distinct_from(value) for col_name, value in values.items()])
+            ).values(
+                **values,
+                updated_at=unix_timestamp()
+            ).returning(tbl.c.id, tbl.c.updated_at)
+
+            row = (await session.execute(statement)).one_or_none()
+
+            if row is None:
+                # nothing was written, only now check why
+                exists = (await session.execute(select(tbl.c.id).where(tbl.c.id == updated_obj.id))).one_or_none()
+
+                if exists is None:
+                    not_found = True
+                    raise Exception(f"{updated_obj.id} does not exist.")
+
+                raise Exception(f"No changes detected in {updated_obj}.")
+
+            await session.commit()
+        except IntegrityError as e:
+            error = Async_Postgres_DB.integrity_error(e=e, obj=updated_obj)
+            log.error("Postgres", "Failed to update", obj=repr(updated_obj), error=str(error))
+            await session.rollback()
+            return False, {
+                'error': error,
+                'conflict': Async_Postgres_DB.is_conflict(e)
+            }
+        except (SQLAlchemyError, Exception) as e:
+            log.error("Postgres", "Failed to update", obj=repr(updated_obj), error=str(e))
+            await session.rollback()
+            return False, {
+                'error': str(e),
+                'not_found': not_found,
+                'retryable': Async_Postgres_DB.is_retryable(e)
+            }
+        else:
+            log.info("Postgres", "Updated", sampled=True, obj=repr(updated_obj))
+            return True, {
+                'id': row.id,
+                'updated_at': row.updated_at
+            }
+
+    @staticmethod
+    @retry_on_serialization_failure
+    async def delete(session: AsyncSession, obj: Base, fk_constraint: bool = False, soft_delete = False) -> Tuple[bool, Dict[str, Any]]:
+        # obj only needs its id, the row is deleted (or soft deleted) with a single statement
+        tbl = obj.__table__
+        deleted_at = unix_timestamp()
+        not_found = False
+
+        try:
+            conditions = [tbl.c.id == obj.id]
+
+            if fk_constraint:
+                # refuse to delete while child rows still reference this row, checked within the same statement
+                for relationship in obj.__mapper__.relationships:
+                    for fk_col in relationship._calculated_foreign_keys:
+                        for fk in fk_col.foreign_keys:
+                            if fk.column.table is tbl:
+                                conditions.append(~exists().where(fk_col == tbl.c[fk.column.name]))
+
+            if soft_delete:
+                statement = update(tbl).where(*conditions, tbl.c.deleted_at.is_(None)).values(deleted_at=deleted_at)
+            else:
+                statement = delete(tbl).where(*conditions)
+
+            row = (await session.execute(statement.returning(tbl.c.id))).one_or_none()
+
+            if row is None:
+                # nothing was deleted, only now check why
+                exists_row = (await session.execute(select(tbl.c.id).where(tbl.c.id == obj.id))).one_or_none()
+
+                if exists_row is None:
+                    not_found = True
+                    raise Exception(f"{obj.id} does not exist.")
+                elif fk_constraint:
+                    raise Exception(f"Referential integrity violation: references still exists to {obj.__class__.__name__} with id={obj.id}.")
+
+                raise Exception(f"{obj.id} is already deleted.")
+
+            await session.commit()
+        except IntegrityError as e:
+            error = Async_Postgres_DB.integrity_error(e=e, obj=obj)
+            log.error("Postgres", "Failed to delete", obj=repr(obj), error=str(error))
+            await session.rollback()
+            return False, {
+                'error': error,
+                'conflict': Async_Postgres_DB.is_conflict(e)
+            }
+        except (SQLAlchemyError, Exception) as e:
+            log.error("Postgres", "Failed to delete", obj=repr(obj), error=str(e))
+            await session.rollback()
+            return False, {
+                'error': str(e),
+                'not_found': not_found,
+                'retryable': Async_Postgres_DB.is_retryable(e)
+            }
+        else:
+            log.info("Postgres", "Deleted", sampled=True, obj=repr(obj))
+            return True, {
+                'id': row.id,
+                'deleted_at': deleted_at
+            }
+
+    @staticmethod
+    def is_retryable(e: Exception) -> bool:
+        if not isinstance(e, DBAPIError):
+            return False
+
+        sqlstate = getattr(e.orig, 'sqlstate', None) or getattr(e.orig, 'pgcode', None)
+
+        return sqlstate in [SERIALIZATION_FAILURE, DEADLOCK_DETECTED]
+
+    @staticmethod
+    def is_conflict(e: IntegrityError) -> bool:
+        # e.g., a username taken by a concurrent request, the client has to pick another value rather than retry
+        sqlstate = getattr(e.orig, 'sqlstate', None) or getattr(e.orig, 'pgcode', None)
+
+        return sqlstate == UNIQUE_VIOLATION
+
+    @staticmethod
+    def integrity_error(e: IntegrityError, obj: Base) -> str:
+        # asyncpg exposes the violated constraint on the original exception, psycopg2 on its diagnostics
+        sqlstate = getattr(e.orig, 'sqlstate', None) or getattr(e.orig, 'pgcode', None)
+        cause = e.orig.__cause__ if e.orig.__cause__ is not None else getattr(e.orig, 'diag', None)
+        constraint_name = getattr(cause, 'constraint_name', None)
+        column_name = getattr(cause, 'column_name', None)
+
+        constraint = next((c for c in obj.__table__.constraints if c.name == constraint_name), None)
+        col_names = [col.name for col in constraint.columns] if constraint is not None else []
+
+        if sqlstate == UNIQUE_VIOLATION and isinstance(constraint, PrimaryKeyConstraint):
+            return f"{obj.id} already exists."
+        elif sqlstate == UNIQUE_VIOLATION and len(col_names) > 0:
+            return f"{', '.join(col_names).capitalize()} already exists!"
+        elif sqlstate == FOREIGN_KEY_VIOLATION and isinstance(constraint, ForeignKeyConstraint):
+            # name the parent by its mapped class, e.g., User instead of users
+            parent_name = next(
+                (relationship.mapper.class_.__name__ for relationship in obj.__mapper__.relationships if relationship.mapper.local_table is constraint.referred_table),
+                constraint.referred_table.name
+            )
+            return f"Referential integrity violation: {parent_name} with id={getattr(obj, col_names[0])} does not exist."
+        elif sqlstate == FOREIGN_KEY_VIOLATION:
+            return f"Referential integrity violation: references still exists to {obj.__class__.__name__} with id={obj.id}."
+        elif sqlstate == NOT_NULL_VIOLATION and column_name is not None:
+            return f"Column {column_name} does not exist in {obj.__tablename__}."
+
+        return str(e.orig)
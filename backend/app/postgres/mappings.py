@@ -1,13 +1,24 @@
 from typing import List, Optional
-from sqlalchemy import ForeignKey, String, CHAR, Integer, Text, Float, ARRAY, Date, BINARY, Uuid, Boolean, DateTime, Enum
+from sqlalchemy import MetaData, ForeignKey, String, CHAR, Integer, BigInteger, Text, LargeBinary, Float, ARRAY, Date, BINARY, Uuid, Boolean, DateTime, Enum, Index, UniqueConstraint, Computed, DDL, event, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from uuid import uuid4, UUID
 
 class Base(DeclarativeBase):
+    # same names postgres generates by default, so that integrity errors can be traced back to their columns
+    metadata = MetaData(naming_convention={
+        "pk": "%(table_name)s_pkey",
+        "uq": "%(table_name)s_%(column_0_name)s_key",
+        "fk": "%(table_name)s_%(column_0_name)s_fkey"
+    })
+
     created_at: Mapped[int] = mapped_column(Integer)
     updated_at: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     deleted_at: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
+# trigram operators and index classes used by the audio file search
+event.listen(Base.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
 # --------------------------------------------------------------------------------------------------------------------------------------
 
 class User(Base):
@@ -21,7 +32,9 @@ class User(Base):
     disabled: Mapped[bool] = mapped_column(Boolean, default=False)
 
     # one-to-many relationship
-    audio_files: Mapped[List["Audio_File"]] = relationship(back_populates='user', cascade='all, delete-orphan')
+    # passive_deletes, children are removed by the ON DELETE CASCADE of the foreign key instead of being loaded first
+    audio_files: Mapped[List["Audio_File"]] = relationship(back_populates='user', cascade='all, delete-orphan', passive_deletes=True)
+    upload_sessions: Mapped[List["Upload_Session"]] = relationship(back_populates='user', cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f'User (Email: {self.email!r}, Name: {self.full_name!r})'
@@ -36,8 +49,151 @@ class Audio_File(Base):
     blob_name: Mapped[UUID] = mapped_column(Uuid)
     content_type: Mapped[str] = mapped_column(String(50))
 
+    # filled in by the worker (app.worker) once the upload has been decoded, null until then
+    duration: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    sample_rate: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    channels: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    # maintained by postgres, deferred so that it is only loaded when explicitly selected
+    search_vector: Mapped[str] = mapped_column(
+        TSVECTOR,
+        Computed("to_tsvector('simple', coalesce(description, '') || ' ' || coalesce(category, ''))", persisted=True),
+        deferred=True
+    )
+
     # many-to-one relationship
     user: Mapped["User"] = relationship(back_populates='audio_files')
 
+    # one-to-many relationship, compact streaming copies made by the transcoding worker (app.worker)
+    renditions: Mapped[List["Audio_Rendition"]] = relationship(back_populates='audio_file', cascade='all, delete-orphan', passive_deletes=True)
+
+    # one-to-many relationship, one waveform per zoom level
+    waveforms: Mapped[List["Audio_Waveform"]] = relationship(back_populates='audio_file', cascade='all, delete-orphan', passive_deletes=True)
+
+    # one-to-one relationship, set on upload so that the job is committed in the same transaction as the file
+    transcode_job: Mapped[Optional["Transcode_Job"]] = relationship(back_populates='audio_file', cascade='all, delete-orphan', passive_deletes=True)
+
+    __table_args__ = (
+        # GET /audio_files/ (keyset pagination, newest first), soft-deleted rows are never listed
+        Index('ix_audio_files_user_id_created_at_id', 'user_id', text('created_at DESC'), text('id DESC'), postgresql_where=text('deleted_at IS NULL')),
+        # per-user lookups by category
+        Index('ix_audio_files_user_id_category', 'user_id', 'category'),
+        # GET /audio_files/search, full-text matches and typo-tolerant trigram matches
+        Index('ix_audio_files_search_vector', 'search_vector', postgresql_using='gin'),
+        Index('ix_audio_files_description_trgm', 'description', postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'}),
+    )
+
+    def __repr__(self):
+        return f'Audio_File (Description: {self.description!r}, Category: {self.category!r})'
+class Audio_Blob(Base):
+    __tablename__ = 'audio_blobs'
+
+    # content-addressed, uuid5 of the sha256 and content type (app.dedup.content_blob_name), shared by every audio file with those bytes
+    blob_name: Mapped[UUID] = mapped_column(Uuid, primary_key=True)
+    sha256: Mapped[str] = mapped_column(CHAR(64))
+    content_type: Mapped[str] = mapped_column(String(50))
+    size: Mapped[int] = mapped_column(BigInteger)
+    # audio_files rows pointing at the blob, the worker deletes the blob some time after this drops to 0
+    ref_count: Mapped[int] = mapped_column(Integer)
+
+    __table_args__ = (
+        # the worker's sweep
+        Index('ix_audio_blobs_unreferenced', 'updated_at', postgresql_where=text('ref_count = 0')),
+    )
+
     def __repr__(self):
-        return f'Audio_File (Description: {self.description!r}, Category: {self.category!r})'
\ No newline at end of file
+        return f'Audio_Blob (SHA-256: {self.sha256!r}, References: {self.ref_count!r})'
+
+class Audio_Rendition(Base):
+    __tablename__ = 'audio_renditions'
+
+    id: Mapped[UUID] = mapped_column(Uuid, primary_key=True, default=uuid4)
+    audio_file_id: Mapped[UUID] = mapped_column(Uuid, ForeignKey(column='audio_files.id', ondelete='CASCADE', onupdate='CASCADE'))
+    # e.g., opus / aac, and the target bitrate in kbit/s
+    format: Mapped[str] = mapped_column(String(10))
+    bitrate: Mapped[int] = mapped_column(Integer)
+    blob_name: Mapped[UUID] = mapped_column(Uuid)
+    content_type: Mapped[str] = mapped_column(String(50))
+    size: Mapped[int] = mapped_column(BigInteger)
+    # integrated loudness (LUFS) the rendition was normalised to, and the one measured on the upload
+    loudness_target: Mapped[float] = mapped_column(Float)
+    source_loudness: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+
+    # many-to-one relationship
+    audio_file: Mapped["Audio_File"] = relationship(back_populates='renditions')
+
+    __table_args__ = (
+        # a retried job inserts the same rendition again, the duplicate is ignored (ON CONFLICT DO NOTHING)
+        UniqueConstraint('audio_file_id', 'format', 'bitrate'),
+    )
+
+    def __repr__(self):
+        return f'Audio_Rendition (Format: {self.format!r}, Bitrate: {self.bitrate!r})'
+
+class Audio_Waveform(Base):
+    __tablename__ = 'audio_waveforms'
+
+    audio_file_id: Mapped[UUID] = mapped_column(Uuid, ForeignKey(column='audio_files.id', ondelete='CASCADE', onupdate='CASCADE'), primary_key=True)
+    samples_per_peak: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # number of (min, max) pairs
+    length: Mapped[int] = mapped_column(Integer)
+    # little-endian int16 min, max pairs (app.waveform.encode_peaks), deferred so that listing the levels does not load them
+    peaks: Mapped[bytes] = mapped_column(LargeBinary, deferred=True)
+
+    # many-to-one relationship
+    audio_file: Mapped["Audio_File"] = relationship(back_populates='waveforms')
+
+    def __repr__(self):
+        return f'Audio_Waveform (Samples per peak: {self.samples_per_peak!r}, Length: {self.length!r})'
+
+class Transcode_Job(Base):
+    __tablename__ = 'transcode_jobs'
+
+    id: Mapped[UUID] = mapped_column(Uuid, primary_key=True, default=uuid4)
+    # at most one job per audio file, enqueueing it again is a no-op
+    audio_file_id: Mapped[UUID] = mapped_column(Uuid, ForeignKey(column='audio_files.id', ondelete='CASCADE', onupdate='CASCADE'), unique=True)
+    # pending -> running -> done, or back to pending with a later run_at until it has failed max attempts times
+    status: Mapped[str] = mapped_column(String(10), default='pending')
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    run_at: Mapped[int] = mapped_column(Integer)
+    # lease of the worker running the job, an expired lease means the worker died and the job is picked up again
+    locked_until: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    # one-to-one relationship
+    audio_file: Mapped["Audio_File"] = relationship(back_populates='transcode_job')
+
+    __table_args__ = (
+        # the worker's claim query, finished jobs are left out of the index
+        Index('ix_transcode_jobs_run_at', 'run_at', postgresql_where=text("status IN ('pending', 'running')")),
+    )
+
+    def __repr__(self):
+        return f'Transcode_Job (Status: {self.status!r}, Attempts: {self.attempts!r})'
+
+class Upload_Session(Base):
+    __tablename__ = 'upload_sessions'
+
+    id: Mapped[UUID] = mapped_column(Uuid, primary_key=True, default=uuid4)
+    user_id: Mapped[UUID] = mapped_column(Uuid, ForeignKey(column='users.id', ondelete='CASCADE', onupdate='CASCADE'))
+    # copied to the audio file once the upload is finalised
+    description: Mapped[str] = mapped_column(String(100))
+    category: Mapped[str] = mapped_column(String(50))
+    content_type: Mapped[str] = mapped_column(String(50))
+    # declared length of the file, and the bytes staged so far (always a block boundary)
+    size: Mapped[int] = mapped_column(BigInteger)
+    offset: Mapped[int] = mapped_column(BigInteger, default=0)
+    # moved forward by every chunk, an abandoned session is deleted by the worker once it has passed
+    expires_at: Mapped[int] = mapped_column(Integer)
+
+    # many-to-one relationship
+    user: Mapped["User"] = relationship(back_populates='upload_sessions')
+
+    __table_args__ = (
+        # the worker's sweep of expired sessions
+        Index('ix_upload_sessions_expires_at', 'expires_at'),
+    )
+
+    def __repr__(self):
+        return f'Upload_Session (Offset: {self.offset!r}, Size: {self.size!r})'
+
@@ -0,0 +1,130 @@
+# Sytem imports
+from typing import Tuple, Dict, Any, List, Callable, Awaitable
+
+# FastAPI-related imports
+from app.postgres.async_postgres_db import Async_Postgres_DB
+from app.postgres.mappings import Base, Audio_File
+from app.postgres.utils import unix_timestamp
+from app import log
+
+# SQLAlchemy-related imports
+from sqlalchemy import text, Column
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncConnection
+
+# any constant shared by everything that migrates this database, concurrent runs (e.g., several replicas starting) wait on it
+MIGRATION_LOCK_ID = 7212405
+
+async def add_columns(conn: AsyncConnection, *columns: Column):
+    # columns mapped after their table was created, create_all never alters a table that already exists
+    # the definition is compiled from the mapping (type, nullability, generated expression), so the two cannot drift apart
+    for column in columns:
+        definition = CreateColumn(column).compile(dialect=conn.dialect)
+        await conn.execute(text(f"ALTER TABLE {column.table.name} ADD COLUMN IF NOT EXISTS {definition}"))
+
+async def add_search_vector(conn: AsyncConnection):
+    # GET /audio_files/search, generated from description and category, adding it rewrites audio_files once
+    await add_columns(conn, Audio_File.__table__.c.search_vector)
+
+async def add_audio_file_metadata(conn: AsyncConnection):
+    # filled in by the worker once the upload is decoded, nullable, so existing rows are not rewritten and read as not decoded yet
+    await add_columns(conn, Audio_File.__table__.c.duration, Audio_File.__table__.c.sample_rate, Audio_File.__table__.c.channels)
+
+async def initial_schema(conn: AsyncConnection):
+    # every table of app.postgres.mappings that does not exist yet, with its indexes, and the pg_trgm extension
+    await conn.run_sync(Base.metadata.create_all)
+    # tables created by earlier versions (which ran create_all on every start) get the columns mapped since,
+    # before their indexes are created, some of which are on those columns
+    await add_search_vector(conn)
+    await add_audio_file_metadata(conn)
+    await conn.run_sync(Async_Postgres_DB.create_missing_indexes)
+
+# users whose row is updated or deleted (e.g., disabled) are announced on this channel, every server process listens on it
+# and drops them from its current_user cache (app.dependencies.listen_for_user_changes)
+USER_CHANGES_CHANNEL = "user_changes"
+
+async def notify_user_changes(conn: AsyncConnection):
+    # a trigger rather than the routes, so that changes made outside the app (e.g., disabling a user by hand) are announced too
+    # pg_notify is only delivered once the transaction commits
+    await conn.execute(text(f"""
+        CREATE OR REPLACE FUNCTION notify_user_changes() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{USER_CHANGES_CHANNEL}', OLD.id::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """))
+    await conn.execute(text("DROP TRIGGER IF EXISTS users_notify_changes ON users"))
+    await conn.execute(text("CREATE TRIGGER users_notify_changes AFTER UPDATE OR DELETE ON users FOR EACH ROW EXECUTE FUNCTION notify_user_changes()"))
+
+# (version, migration), applied in this order and exactly once per database
+# 0001 brings any pre-migration schema (tables created by create_all on start) up to the mappings as they are in this release:
+# every step of it is idempotent (CREATE ... IF NOT EXISTS, ADD COLUMN IF NOT EXISTS), which is why columns mapped before migrations
+# shipped were added to it. Once a database has recorded a version, editing that entry no longer reaches it, so later changes to
+# app.postgres.mappings get a new entry at the end (e.g., ALTER TABLE ... ADD COLUMN)
+MIGRATIONS: List[Tuple[str, Callable[[AsyncConnection], Awaitable[None]]]] = [
+    ("0001_initial_schema", initial_schema),
+    ("0002_notify_user_changes", notify_user_changes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+async def migrate(engine: AsyncEngine) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Applies the pending migrations in one transaction, so that a failed migration leaves the schema as it was.
+
+    Returns:
+        (bool, dict): (True, { "applied": [version, ...], "version": str }), (False, { "error": str })
+    """
+    try:
+        async with engine.begin() as conn:
+            # held until the transaction ends, taken before the table is created since concurrent CREATE TABLE IF NOT EXISTS can still collide
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+            await conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version VARCHAR(100) PRIMARY KEY,
+                    applied_at INTEGER NOT NULL
+                )
+            """))
+
+            applied_versions = set((await conn.execute(text("SELECT version FROM schema_migrations"))).scalars().all())
+            applied = []
+
+            for version, migration in MIGRATIONS:
+                if version in applied_versions:
+                    continue
+
+                await migration(conn)
+                await conn.execute(
+                    text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, :applied_at)"),
+                    {"version": version, "applied_at": unix_timestamp()}
+                )
+                applied.append(version)
+                log.info("Postgres", "Applied migration", version=version)
+
+        return True, {
+            "applied": applied,
+            "version": LATEST_VERSION
+        }
+    except (SQLAlchemyError, Exception) as e:
+        log.error("Postgres", "Failed to migrate", error=str(e))
+        return False, {
+            "error": str(e)
+        }
+
+async def schema_version(engine: AsyncEngine) -> Tuple[bool, Dict[str, Any]]:
+    # the latest applied migration (versions sort by their number), None when the database has never been migrated
+    try:
+        async with engine.connect() as conn:
+            exists = (await conn.execute(text("SELECT to_regclass('schema_migrations') IS NOT NULL"))).scalar_one()
+            version = (await conn.execute(text("SELECT max(version) FROM schema_migrations"))).scalar_one() if exists else None
+
+        return True, {
+            "version": version
+        }
+    except (SQLAlchemyError, Exception) as e:
+        log.error("Postgres", "Failed to read the schema version", error=str(e))
+        return False, {
+            "error": str(e)
+        }
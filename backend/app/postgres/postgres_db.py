@@ -143,6 +143,10 @@ class Postgres_DB:
                 if len(col.foreign_keys) > 0 or col.name in ["created_at", "updated_at", "deleted_at"]:
                     continue
 
+                # generated columns (e.g., search_vector) are maintained by postgres
+                if col.computed is not None:
+                    continue
+
                 col_name = col.name
                 curr_value = getattr(obj, col_name)
                 new_value = getattr(updated_obj, col_name)
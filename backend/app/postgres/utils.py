@@ -1,5 +1,8 @@
 import datetime
 
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
 def unix_timestamp() -> int:
     """
     Returns the current unix timestamp.
@@ -10,4 +13,20 @@ def unix_timestamp() -> int:
     Returns:
         int: The current unix timestamp.
     """
-    return int(datetime.datetime.now(datetime.UTC).timestamp())
\ No newline at end of file
+    return int(datetime.datetime.now(datetime.UTC).timestamp())
+
+class Explain(Executable, ClauseElement):
+    """
+    Wraps a statement in EXPLAIN (FORMAT JSON), keeping its bind parameters.
+
+    Args:
+        statement (Executable): The statement to explain.
+    """
+    inherit_cache = False
+
+    def __init__(self, statement: Executable):
+        self.statement = statement
+
+@compiles(Explain, "postgresql")
+def compile_explain(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
@@ -0,0 +1,50 @@
+# Sytem imports
+import os
+from typing import Dict, List, Union
+from uuid import UUID
+
+# FastAPI-related imports
+from app.postgres.mappings import Upload_Session
+from app.postgres.utils import unix_timestamp
+
+# SQLAlchemy-related imports
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# declared length accepted by POST /audio_files/uploads
+RESUMABLE_UPLOAD_MAX_SIZE = int(os.getenv("RESUMABLE_UPLOAD_MAX_SIZE") or 10 * 1024 * 1024 * 1024)
+# a PATCH body is staged in blocks of this size, the offset a client can resume from moves forward one block at a time
+RESUMABLE_UPLOAD_BLOCK_SIZE = int(os.getenv("RESUMABLE_UPLOAD_BLOCK_SIZE") or 8 * 1024 * 1024)
+# seconds a session is kept after its last chunk, then its blocks are deleted by the worker
+RESUMABLE_UPLOAD_TTL_SECONDS = int(os.getenv("RESUMABLE_UPLOAD_TTL_SECONDS") or 24 * 3600)
+
+def upload_blob_name(upload_id: UUID) -> str:
+    # the blob the blocks are staged to, moved to its content-addressed name once finalised
+    return f"{upload_id}.upload"
+
+def block_id(offset: int) -> str:
+    # named after the offset it starts at, a block staged again after a lost response replaces the first one
+    # instead of adding a second copy, zero-padded because the block ids of a blob must all have the same length
+    return f"{offset:020d}"
+
+def ordered_block_ids(blocks: Dict[str, int], size: int) -> Union[List[str], None]:
+    # walks the staged blocks from offset 0, blocks of abandoned chunks that are off the path are left out
+    block_ids: List[str] = []
+    offset = 0
+
+    while offset < size:
+        if block_id(offset) not in blocks:
+            return None
+
+        block_ids.append(block_id(offset))
+        offset += blocks.get(block_id(offset))
+
+    return block_ids if offset == size else None
+
+async def claim_expired_upload(session: AsyncSession) -> Union[Upload_Session, None]:
+    # locked until the caller commits, a chunk arriving in the meantime fails its offset update instead of reviving it
+    return (await session.execute(
+        select(Upload_Session).where(
+            Upload_Session.expires_at < unix_timestamp()
+        ).limit(1).with_for_update(skip_locked=True)
+    )).scalar_one_or_none()
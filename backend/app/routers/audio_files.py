@@ -1,28 +1,65 @@
 # Sytem imports
 import os
-from typing import Union, Annotated, Tuple, Dict, Any
+import time
+from typing import Union, Annotated, Tuple, Dict, Any, List
 from datetime import datetime, timedelta, timezone
 
 # FastAPI-related imports
-from fastapi import APIRouter, Form, status, Response, Depends, HTTPException, UploadFile, File
-from app.dependencies import get_session, oauth2_scheme, decode_access_token
-from app.postgres.postgres_db import Postgres_DB
-from app.postgres.mappings import Audio_File
+from fastapi import APIRouter, Form, status, Request, Response, Depends, HTTPException, UploadFile, File, Query
+from fastapi.responses import StreamingResponse, JSONResponse
+from app.dependencies import async_read_session, get_session, get_read_session, current_user, UserScheme, get_storage, ACCESS_TOKEN_EXPIRE_MINUTES
+from app.cache import TTLCache
+from app.storage.base import blob_object_name
+from app.storage.streaming import blob_response
+from app.postgres.async_postgres_db import Async_Postgres_DB
+from app.postgres.mappings import Audio_File, Audio_Blob, Audio_Rendition, Audio_Waveform, Transcode_Job
+from app.transcode import new_transcode_job, rendition_rank
+from app.dedup import hash_file, content_blob_name, reference_blob, reference_blobs, release_blob, track_orphan_blobs, select_blob_stats
+from app.postgres.utils import unix_timestamp
+from app.metrics import register_cache
+from app import log
 # from app.routers.base import BaseRouter
 
 # SQLAlchemy-related imports
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel, ConfigDict
 
-# azure imports
-from azure.storage.blob.aio import BlobServiceClient, BlobClient, ContainerClient
-from azure.storage.blob import generate_blob_sas, BlobSasPermissions
-
 # Extra imports
 from uuid import UUID
 import uuid
-from sqlalchemy import and_
-from mimetypes import guess_extension
+from sqlalchemy import and_, or_, select, insert, delete, tuple_, func, literal, Select
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by
+import base64
+import asyncio
+import re
+import shutil
+import zipfile
+import tempfile
+from mimetypes import guess_type
+from typing import BinaryIO
+
+# page sizes for GET /audio_files/, and the number of rows fetched per round trip when streaming
+DEFAULT_PAGE_SIZE = int(os.getenv("AUDIO_FILES_DEFAULT_PAGE_SIZE") or 50)
+MAX_PAGE_SIZE = int(os.getenv("AUDIO_FILES_MAX_PAGE_SIZE") or 500)
+STREAM_BATCH_SIZE = int(os.getenv("AUDIO_FILES_STREAM_BATCH_SIZE") or 1000)
+
+# GET /audio_files/{id}/peaks picks the finest zoom level with at most this many peaks unless one is asked for
+DEFAULT_MAX_PEAKS = int(os.getenv("WAVEFORM_DEFAULT_MAX_PEAKS") or 2000)
+
+# upper bound on the number of ids accepted by POST /audio_files/tokens
+MAX_TOKENS_PER_BATCH = int(os.getenv("MAX_TOKENS_PER_BATCH") or 500)
+
+# POST /audio_files/bulk, files (or archive members) per request, files hashed / uploaded at the same time,
+# and the total uncompressed size of an archive
+BULK_UPLOAD_MAX_FILES = int(os.getenv("BULK_UPLOAD_MAX_FILES") or 500)
+BULK_UPLOAD_CONCURRENCY = int(os.getenv("BULK_UPLOAD_CONCURRENCY") or 8)
+BULK_UPLOAD_MAX_ARCHIVE_BYTES = int(os.getenv("BULK_UPLOAD_MAX_ARCHIVE_BYTES") or 2 * 1024 * 1024 * 1024)
+
+# SAS expiries are rounded up to the end of a fixed-size bucket, so every request for a blob within
+# the same bucket gets the same url and can be served from sas_url_cache
+SAS_URL_EXPIRY_BUCKET_SECONDS = int(os.getenv("SAS_URL_EXPIRY_BUCKET_SECONDS") or 300)
+sas_url_cache = TTLCache(max_size=int(os.getenv("SAS_URL_CACHE_SIZE") or 10000))
+register_cache("sas_url", sas_url_cache)
 
 router = APIRouter(
     prefix="/audio_files",
@@ -35,30 +72,66 @@ class AudioFileScheme(BaseModel):
     id: UUID
     description: str
     category: str
+    # seconds, null until the upload has been processed by the worker
+    duration: Union[float, None] = None
+
+class AudioFilePageScheme(BaseModel):
+    objs: List[AudioFileScheme]
+    next_cursor: Union[str, None] = None
+
+class AudioFileSearchResultScheme(BaseModel):
+    id: UUID
+    description: str
+    category: str
+    rank: float
+
+class AudioFileSearchPageScheme(BaseModel):
+    objs: List[AudioFileSearchResultScheme]
+    total: int
+    facets: Dict[str, int]
+
+class AudioBlobStatsScheme(BaseModel):
+    blobs: int
+    references: int
+    stored_bytes: int
+    logical_bytes: int
+    # logical / stored, 1.0 when nothing is shared
+    dedup_ratio: float
+    bytes_saved: int
+
+class AudioFileIdsScheme(BaseModel):
+    ids: List[UUID]
 
 @router.get("/token/{id}", status_code=status.HTTP_200_OK)
 async def generate_sas_blob_url(
     id: UUID,
     response: Response,
-    session: Annotated[Session, Depends(get_session)],
-    token: Annotated[str, Depends(oauth2_scheme)]
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
 ):
-    user_id = decode_access_token(token)
-
     try:
         # retrieve the audio file
-        success, res = Postgres_DB.retrieve(session=session, tbl=Audio_File, value=id, col_name="id")
+        success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_File, value=id, col_name="id")
 
         if not success:
             raise Exception(res.get("error"))
 
-        audio_file = res.get("objs")[0]
+        audio_file = res.get("objs")[0] if len(res.get("objs")) > 0 else None
+
+        # soft-deleted files are not signed anymore, and other users' files are indistinguishable from missing ones
+        if audio_file is None or audio_file.user_id != user.id or audio_file.deleted_at is not None:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception("Audio file not found")
+
+        success, res = await retrieve_best_renditions(session=session, audio_file_ids=[audio_file.id])
+
+        if not success:
+            raise Exception(res.get("error"))
 
-        if audio_file.user_id != UUID(user_id):
-            raise Exception("You do not have permission to access this audio file")
+        blob_name, content_type = playback_blob(audio_file=audio_file, rendition=res.get("renditions").get(audio_file.id))
 
         # generate a SAS URL for the audio file
-        success, res = await generate_sas_blob_url(blob_name=str(audio_file.blob_name), content_type=audio_file.content_type)
+        success, res = await generate_sas_blob_url(blob_name=blob_name, content_type=content_type)
 
         if not success:
             raise Exception(res.get("error"))
@@ -74,35 +147,282 @@ async def generate_sas_blob_url(
             detail=str(e)
         )
 
+@router.get("/search", status_code=status.HTTP_200_OK)
+async def search_audio_files(
+    q: Annotated[str, Query(min_length=1, max_length=100)],
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)],
+    category: Union[str, None] = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    offset: Annotated[int, Query(ge=0)] = 0
+):
+    try:
+        statement = select_search_page(user_id=user.id, q=q, category=category, limit=limit, offset=offset)
+
+        if statement is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            raise Exception("Search query must contain at least one word")
+
+        # a single row holding the ranked page, the total and the per-category facet counts
+        row = (await session.execute(statement)).one()
+        page = AudioFileSearchPageScheme(objs=row.objs, total=row.total, facets=row.facets)
+
+        return Response(content=page.model_dump_json(), media_type="application/json")
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.get("/stats", status_code=status.HTTP_200_OK)
+async def retrieve_blob_stats(
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        # only the caller's audio files, which blobs other users share is not theirs to know
+        row = (await session.execute(select_blob_stats(user_id=user.id))).one()
+
+        return AudioBlobStatsScheme(
+            blobs=row.blobs,
+            references=row.references,
+            stored_bytes=row.stored_bytes,
+            logical_bytes=row.logical_bytes,
+            dedup_ratio=row.logical_bytes / row.stored_bytes if row.stored_bytes > 0 else 1.0,
+            bytes_saved=row.logical_bytes - row.stored_bytes
+        )
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.post("/tokens", status_code=status.HTTP_200_OK)
+async def generate_sas_blob_urls(
+    body: AudioFileIdsScheme,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        # dict.fromkeys removes duplicates while keeping the order of the request
+        ids = list(dict.fromkeys(body.ids))
+
+        if len(ids) > MAX_TOKENS_PER_BATCH:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            raise Exception(f"At most {MAX_TOKENS_PER_BATCH} audio files can be signed per request")
+
+        # one query for the whole batch, files that do not belong to the user or were deleted are simply not returned
+        success, res = await Async_Postgres_DB.retrieve_any(session=session, tbl=Audio_File, values=ids, col_name="id", where={"user_id": user.id, "deleted_at": None})
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        audio_files = {audio_file.id: audio_file for audio_file in res.get("objs")}
+
+        # and one for their renditions
+        success, res = await retrieve_best_renditions(session=session, audio_file_ids=list(audio_files.keys()))
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        renditions = res.get("renditions")
+        audio_urls = []
+        errors = []
+
+        for id in ids:
+            audio_file = audio_files.get(id)
+
+            if audio_file is None:
+                errors.append({
+                    "audio_id": id,
+                    "error": "Audio file not found"
+                })
+                continue
+
+            blob_name, content_type = playback_blob(audio_file=audio_file, rendition=renditions.get(id))
+            success, res = await generate_sas_blob_url(blob_name=blob_name, content_type=content_type)
+
+            if not success:
+                errors.append({
+                    "audio_id": id,
+                    "error": res.get("error")
+                })
+                continue
+
+            audio_urls.append({
+                "audio_id": id,
+                "audio_url": res.get("audio_url")
+            })
+
+        return {
+            "audio_urls": audio_urls,
+            "errors": errors
+        }
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.get("/{id}/stream", status_code=status.HTTP_200_OK)
+async def stream_audio_file(
+    id: UUID,
+    request: Request,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_File, value=id, col_name="id")
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        audio_file = res.get("objs")[0] if len(res.get("objs")) > 0 else None
+
+        if audio_file is None or audio_file.user_id != user.id or audio_file.deleted_at is not None:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception("Audio file not found")
+
+        blob_name = blob_object_name(blob_name=str(audio_file.blob_name), content_type=audio_file.content_type)
+
+        # the size is needed for Content-Range, this is a metadata request only
+        success, res = await get_storage().stat(blob_name)
+
+        if not success:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception(res.get("error"))
+
+        # the row changes whenever the file does, so its version doubles as the validator
+        last_modified = audio_file.updated_at or audio_file.created_at
+
+        return blob_response(
+            request=request,
+            storage=get_storage(),
+            blob_name=blob_name,
+            size=res.get("size"),
+            content_type=audio_file.content_type,
+            etag=f'"{audio_file.id.hex}-{last_modified:x}"',
+            last_modified=last_modified
+        )
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.get("/{id}/peaks", status_code=status.HTTP_200_OK)
+async def retrieve_audio_file_peaks(
+    id: UUID,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)],
+    samples_per_peak: Union[int, None] = None,
+    max_peaks: Annotated[int, Query(ge=1)] = DEFAULT_MAX_PEAKS,
+    bits: Annotated[int, Query(ge=8, le=16, multiple_of=8)] = 8
+):
+    try:
+        success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_File, value=id, col_name="id")
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        audio_file = res.get("objs")[0] if len(res.get("objs")) > 0 else None
+
+        if audio_file is None or audio_file.user_id != user.id or audio_file.deleted_at is not None:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception("Audio file not found")
+
+        # the levels without their peaks, which are deferred
+        success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_Waveform, value=id, col_name="audio_file_id")
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        waveforms = sorted(res.get("objs"), key=lambda waveform: waveform.samples_per_peak)
+
+        if len(waveforms) == 0:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception("The waveform of this audio file has not been computed yet")
+
+        if samples_per_peak is not None:
+            waveform = next((waveform for waveform in waveforms if waveform.samples_per_peak == samples_per_peak), None)
+
+            if waveform is None:
+                response.status_code = status.HTTP_404_NOT_FOUND
+                raise Exception(f"samples_per_peak must be one of {[waveform.samples_per_peak for waveform in waveforms]}")
+        else:
+            # the coarsest level when even that one has more than max_peaks
+            waveform = next((waveform for waveform in waveforms if waveform.length <= max_peaks), waveforms[-1])
+
+        # only the chosen level's peaks are loaded
+        data = (await session.execute(select(Audio_Waveform.peaks).where(
+            Audio_Waveform.audio_file_id == id,
+            Audio_Waveform.samples_per_peak == waveform.samples_per_peak
+        ))).scalar_one()
+
+        # imported on first use, numpy is the heaviest import of the app and only this route needs it
+        from app.waveform import decode_peaks
+
+        peaks = decode_peaks(data, bits=bits)
+
+        # the json format of audiowaveform, which waveform players such as peaks.js read as is
+        return JSONResponse(
+            content={
+                "version": 2,
+                "channels": 1,
+                "sample_rate": audio_file.sample_rate,
+                "samples_per_pixel": waveform.samples_per_peak,
+                "bits": bits,
+                "length": waveform.length,
+                "duration": audio_file.duration,
+                "data": peaks.tolist()
+            },
+            # the peaks of an upload never change
+            headers={"Cache-Control": "private, max-age=86400"}
+        )
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def upload_audio_file(
     description: Annotated[str, Form()],
     category: Annotated[str, Form()],
     audio_file: Annotated[UploadFile, File()],
     response: Response,
-    session: Annotated[Session, Depends(get_session)],
-    token: Annotated[str, Depends(oauth2_scheme)]
+    session: Annotated[AsyncSession, Depends(get_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
 ):
-    user_id = decode_access_token(token)
-
     try:
-        success, res = await upload_file_to_bucket(audio_file)
+        success, res = await upload_file_to_bucket(session=session, audio_file=audio_file)
 
         if not success:
             raise Exception(res.get("error"))
-        
-        blob_name = res.get("blob_name")
-        content_type = res.get("content_type")
 
-        audio_file = Audio_File(
-            user_id=UUID(user_id),
+        blob = res
+
+        obj = Audio_File(
+            user_id=user.id,
             description=description,
             category=category,
-            blob_name=UUID(blob_name),
-            content_type=content_type
+            blob_name=blob.get("blob_name"),
+            content_type=blob.get("content_type"),
+            # picked up by the transcoding worker (app.worker) once this transaction commits
+            transcode_job=new_transcode_job()
         )
 
-        success, res = Postgres_DB.insert(session=session, obj=audio_file)
+        success, res = await insert_audio_file(session=session, obj=obj, audio_file=audio_file, blob=blob)
 
         if not success:
             raise Exception(res.get("error"))
@@ -117,27 +437,148 @@ async def upload_audio_file(
             detail=str(e)
         )
 
+@router.post("/bulk", status_code=status.HTTP_201_CREATED)
+async def upload_audio_files(
+    category: Annotated[str, Form(max_length=50)],
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_session)],
+    user: Annotated[UserScheme, Depends(current_user)],
+    audio_files: Annotated[Union[List[UploadFile], None], File()] = None,
+    archive: Annotated[Union[UploadFile, None], File()] = None
+):
+    archive_file = None
+    items: List[Dict[str, Any]] = []
+
+    try:
+        # descriptions default to the file names
+        for audio_file in audio_files or []:
+            items.append({
+                "filename": audio_file.filename,
+                "content_type": audio_file.content_type,
+                "file": audio_file
+            })
+
+        if archive is not None:
+            try:
+                # only the central directory is read here, members are extracted one by one as they are uploaded
+                archive_file = await asyncio.to_thread(zipfile.ZipFile, archive.file)
+            except zipfile.BadZipFile as e:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                raise e
+
+            members = [
+                info for info in archive_file.infolist()
+                if not info.is_dir() and not info.filename.startswith("__MACOSX/") and not os.path.basename(info.filename).startswith(".")
+            ]
+
+            if sum(info.file_size for info in members) > BULK_UPLOAD_MAX_ARCHIVE_BYTES:
+                response.status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                raise Exception(f"The archive expands to more than {BULK_UPLOAD_MAX_ARCHIVE_BYTES} bytes")
+
+            for info in members:
+                items.append({
+                    "filename": info.filename,
+                    "content_type": guess_type(info.filename)[0],
+                    "member": info
+                })
+
+        if len(items) == 0 or len(items) > BULK_UPLOAD_MAX_FILES:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            raise Exception(f"Between 1 and {BULK_UPLOAD_MAX_FILES} audio files can be uploaded per request")
+
+        await upload_files_to_bucket(session=session, items=items, archive_file=archive_file)
+        await insert_audio_files(session=session, items=items, user_id=user.id, category=category, archive_file=archive_file)
+
+        results = [
+            {"filename": item.get("filename"), "error": item.get("error")} if "error" in item
+            else {"filename": item.get("filename"), "id": item.get("id"), "created_at": item.get("created_at")}
+            for item in items
+        ]
+
+        return {
+            "created": sum(1 for item in items if "error" not in item),
+            "failed": sum(1 for item in items if "error" in item),
+            "results": results
+        }
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+    finally:
+        # members whose temporary file is still open, when the request failed half way
+        for item in items:
+            close_member(item)
+
+        if archive_file is not None:
+            archive_file.close()
+
+@router.delete("/{id}", status_code=status.HTTP_200_OK)
+async def delete_audio_file(
+    id: UUID,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        # renditions, waveforms and the transcode job go with it (ON DELETE CASCADE)
+        blob_name = (await session.execute(
+            delete(Audio_File).where(
+                Audio_File.id == id,
+                Audio_File.user_id == user.id
+            ).returning(Audio_File.blob_name)
+        )).scalar_one_or_none()
+
+        if blob_name is None:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception("Audio file not found")
+
+        # in the same transaction, the blob itself is deleted by the worker once no audio file points at it
+        await release_blob(session=session, blob_name=blob_name)
+        await session.commit()
+
+        return {
+            "id": id
+        }
+
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
 @router.get("/", status_code=status.HTTP_200_OK)
 async def retrieve_all_audio_files(
     response: Response,
-    session: Annotated[Session, Depends(get_session)],
-    token: Annotated[str, Depends(oauth2_scheme)]
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)],
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    cursor: Union[str, None] = None,
+    stream: bool = False
 ):
-    user_id = decode_access_token(token)
-
     try:
-        # retrieve all audio files for the user
-        success, res = Postgres_DB.retrieve(session=session, tbl=Audio_File, value=UUID(user_id), col_name="user_id")
+        success, res = decode_cursor(cursor)
 
         if not success:
+            response.status_code = status.HTTP_400_BAD_REQUEST
             raise Exception(res.get("error"))
 
-        objs = res.get("objs")
-        objs_json = [AudioFileScheme.model_validate(obj).model_dump_json() for obj in objs]
+        statement = select_audio_files(user_id=user.id, after=res.get("after"))
 
-        return {
-            "objs": objs_json,
-        }
+        if stream:
+            # one json object per line, rows are read from a server-side cursor as the client consumes them
+            return StreamingResponse(stream_audio_files(statement), media_type="application/x-ndjson")
+
+        # fetch one extra row to know whether there is a next page
+        rows = (await session.execute(statement.limit(limit + 1))).all()
+        next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+
+        # serialised once by pydantic, returning a dict would make fastapi encode every row again
+        page = AudioFilePageScheme(objs=rows[:limit], next_cursor=next_cursor)
+
+        return Response(content=page.model_dump_json(), media_type="application/json")
 
     except Exception as e:
         raise HTTPException(
@@ -148,54 +589,499 @@ async def retrieve_all_audio_files(
 # Helper Functions
 # ---------------------------------------------------------------------
 
+def select_audio_files(
+    user_id: UUID,
+    after: Union[Tuple[int, UUID], None] = None
+) -> Select:
+    # newest first, ordered on (created_at, id) so that the order is total and pages never overlap
+    statement = select(
+        Audio_File.id,
+        Audio_File.description,
+        Audio_File.category,
+        Audio_File.duration,
+        Audio_File.created_at
+    ).where(
+        Audio_File.user_id == user_id,
+        # matches the partial index ix_audio_files_user_id_created_at_id
+        Audio_File.deleted_at.is_(None)
+    ).order_by(
+        Audio_File.created_at.desc(),
+        Audio_File.id.desc()
+    )
+
+    if after is not None:
+        # keyset pagination, continue strictly after the last row of the previous page
+        statement = statement.where(tuple_(Audio_File.created_at, Audio_File.id) < tuple_(*after))
+
+    return statement
+
+def select_search_page(
+    user_id: UUID,
+    q: str,
+    category: Union[str, None],
+    limit: int,
+    offset: int
+) -> Union[Select, None]:
+    words = re.findall(r"\w+", q.lower())
+
+    if len(words) == 0:
+        return None
+
+    # every word has to match, the last one may be incomplete, e.g., "drum lo" -> drum:* & lo:*
+    ts_query = func.to_tsquery("simple", " & ".join(f"{word}:*" for word in words))
+
+    # trigram word similarity catches typos that the full-text prefix match misses
+    rank = func.greatest(
+        func.ts_rank(Audio_File.search_vector, ts_query),
+        func.word_similarity(q, Audio_File.description)
+    )
+
+    matches = select(
+        Audio_File.id,
+        Audio_File.description,
+        Audio_File.category,
+        rank.label("rank")
+    ).where(
+        Audio_File.user_id == user_id,
+        Audio_File.deleted_at.is_(None),
+        or_(
+            Audio_File.search_vector.op("@@")(ts_query),
+            literal(q).op("<%")(Audio_File.description)
+        )
+    ).cte("matches")
+
+    # facets are counted before the category filter, so the client can show every category it could narrow down to
+    facets = select(
+        matches.c.category,
+        func.count().label("count")
+    ).group_by(matches.c.category).subquery("facets")
+
+    filtered = select(matches).where(matches.c.category == category) if category is not None else select(matches)
+    filtered = filtered.subquery("filtered")
+
+    page = select(filtered).order_by(filtered.c.rank.desc(), filtered.c.id.desc()).limit(limit).offset(offset).subquery("page")
+
+    return select(
+        select(func.coalesce(func.json_agg(aggregate_order_by(
+            func.json_build_object("id", page.c.id, "description", page.c.description, "category", page.c.category, "rank", page.c.rank),
+            page.c.rank.desc(),
+            page.c.id.desc()
+        )), func.json_build_array()).cast(JSON)).scalar_subquery().label("objs"),
+        select(func.count()).select_from(filtered).scalar_subquery().label("total"),
+        select(func.coalesce(func.json_object_agg(facets.c.category, facets.c.count), func.json_build_object()).cast(JSON)).scalar_subquery().label("facets")
+    )
+
+def encode_cursor(row) -> str:
+    return base64.urlsafe_b64encode(f"{row.created_at}:{row.id}".encode()).decode()
+
+def decode_cursor(cursor: Union[str, None]) -> Tuple[bool, Dict[str, Any]]:
+    if cursor is None:
+        return True, {
+            "after": None
+        }
+
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+
+        return True, {
+            "after": (int(created_at), UUID(id))
+        }
+    except Exception:
+        return False, {
+            "error": "Invalid cursor"
+        }
+
+async def stream_audio_files(
+    statement: Select
+):
+    # the request's session is closed before a streaming response is sent, so the stream opens its own
+    async with async_read_session() as session:
+        res = await session.stream(statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+
+        async for rows in res.partitions():
+            yield "".join(AudioFileScheme.model_validate(row).model_dump_json() + "\n" for row in rows)
+
 async def upload_file_to_bucket(
+    session: AsyncSession,
     audio_file: UploadFile
 ) -> Tuple[bool, Dict[str, Any]]:
-    file_ext = os.path.splitext(audio_file.filename)[1]
-    blob_name = str(uuid.uuid4())
-    blob_name_with_ext = f"{blob_name}{file_ext}"
+    """
+    Stores the upload under its content-addressed name, unless a blob with the same content is already known.
+
+    The reference to the blob is taken by insert_audio_file, in the transaction of the audio file.
+
+    Returns:
+        (bool, dict): (True, { "blob_name", "sha256", "content_type", "size", "uploaded" }), (False, { "error": str })
+    """
     content_type = audio_file.content_type
 
-    # https://learn.microsoft.com/en-us/dotnet/api/azure.storage.blobs.blobserviceclient.-ctor?view=azure-dotnet#azure-storage-blobs-blobserviceclient-ctor(system-string)
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AZ_STORAGE_CONNECTION_STRING"))
+    # hashed from the spooled upload before anything is sent, a duplicate is never uploaded
+    sha256 = await asyncio.to_thread(hash_file, audio_file.file)
+    blob_name = content_blob_name(sha256=sha256, content_type=content_type)
+    # named after the content type, the same name generate_sas_blob_url and the worker derive from the row
+    blob_name_with_ext = blob_object_name(blob_name=str(blob_name), content_type=content_type)
+
+    success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_Blob, value=blob_name, col_name="blob_name")
+
+    if not success:
+        return False, {
+            "error": res.get("error")
+        }
+
+    uploaded = False
 
-    async with blob_service_client:
-        container_client: ContainerClient = blob_service_client.get_container_client(os.getenv("AZ_STORAGE_CONTAINER_NAME"))
-        try:
-            blob_client: BlobClient = container_client.get_blob_client(blob_name_with_ext)
-            audio_data: bytes = await audio_file.read()
-            await blob_client.upload_blob(audio_data)
-        except Exception as e:
+    # a blob that has a row but no references may be being swept, it is uploaded by insert_audio_file once its row is locked
+    if len(res.get("objs")) == 0:
+        # streamed to the configured backend (azure or local disk) chunk by chunk
+        success, res = await get_storage().upload(blob_name=blob_name_with_ext, file=audio_file, content_type=content_type)
+
+        if not success:
             return False, {
-                "error": str(e)
+                "error": res.get("error")
             }
-        
+
+        uploaded = True
+
     return True, {
         "blob_name": blob_name,
+        "sha256": sha256,
         "content_type": content_type,
+        "size": audio_file.size,
+        "uploaded": uploaded
     }
 
+async def insert_audio_file(
+    session: AsyncSession,
+    obj: Audio_File,
+    audio_file: UploadFile,
+    blob: Dict[str, Any]
+) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Inserts an audio file with the reference to its blob (see upload_file_to_bucket), in one transaction.
+
+    The blob row is locked from the reference to the commit, so the worker's sweep cannot delete the blob in between.
+    """
+    try:
+        success, res = await reference_blob(session=session, blob_name=blob.get("blob_name"), sha256=blob.get("sha256"), content_type=blob.get("content_type"), size=blob.get("size"))
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        # no references before this one, the blob was swept (or is about to be) since it was last stored
+        # a blob stored by this request had no row then, and is younger than the sweep's grace period
+        if res.get("created") and not blob.get("uploaded"):
+            await asyncio.to_thread(audio_file.file.seek, 0)
+            success, res = await get_storage().upload(blob_name=blob_object_name(blob_name=str(blob.get("blob_name")), content_type=blob.get("content_type")), file=audio_file, content_type=blob.get("content_type"))
+
+            if not success:
+                raise Exception(res.get("error"))
+
+            blob["uploaded"] = True
+
+        obj.created_at = unix_timestamp()
+        session.add(obj)
+        await session.commit()
+    except Exception as e:
+        log.error("Postgres", "Failed to insert audio file", blob_name=str(blob.get("blob_name")), error=str(e))
+        await session.rollback()
+
+        if blob.get("uploaded"):
+            # no row points at the blob this request stored, the worker's sweep deletes it
+            await track_orphan_blobs(session=session, blobs=[{key: blob.get(key) for key in ["blob_name", "sha256", "content_type", "size"]}])
+
+        return False, {
+            "error": str(e)
+        }
+
+    return True, {
+        "id": obj.id,
+        "created_at": obj.created_at
+    }
+
+def extract_member(
+    archive_file: zipfile.ZipFile,
+    info: zipfile.ZipInfo
+) -> BinaryIO:
+    # blocking, run in a thread, decompressed chunk by chunk to a temporary file
+    f = tempfile.TemporaryFile()
+
+    with archive_file.open(info) as member:
+        shutil.copyfileobj(member, f)
+
+    f.seek(0)
+    return f
+
+def close_member(item: Dict[str, Any]):
+    # the temporary file of an archive member, as soon as it is not needed any more rather than at the end of the request
+    if "member" in item and "file" in item:
+        item.pop("file").file.close()
+
+async def upload_item(
+    item: Dict[str, Any],
+    archive_file: Union[zipfile.ZipFile, None]
+) -> Tuple[bool, Dict[str, Any]]:
+    # archive members whose temporary file was already closed are extracted again
+    if "file" not in item:
+        f = await asyncio.to_thread(extract_member, archive_file, item.get("member"))
+        item["file"] = UploadFile(file=f, size=item.get("member").file_size, filename=item.get("filename"))
+
+    try:
+        await asyncio.to_thread(item.get("file").file.seek, 0)
+
+        return await get_storage().upload(
+            blob_name=blob_object_name(blob_name=str(item.get("blob_name")), content_type=item.get("content_type")),
+            file=item.get("file"),
+            content_type=item.get("content_type")
+        )
+    finally:
+        close_member(item)
+
+async def upload_files_to_bucket(
+    session: AsyncSession,
+    items: List[Dict[str, Any]],
+    archive_file: Union[zipfile.ZipFile, None]
+):
+    """
+    Bulk version of upload_file_to_bucket, without taking the references (see insert_audio_files).
+
+    Sets "blob_name", "sha256", "size" and "uploaded" on every item, or "error" when it cannot be uploaded.
+    """
+    # bounds the files being extracted, hashed or uploaded at the same time
+    slots = asyncio.Semaphore(BULK_UPLOAD_CONCURRENCY)
+
+    async def prepare(item: Dict[str, Any]):
+        async with slots:
+            try:
+                if not (item.get("content_type") or "").startswith("audio/"):
+                    raise Exception("Not an audio file")
+
+                if "member" in item:
+                    f = await asyncio.to_thread(extract_member, archive_file, item.get("member"))
+                    item["file"] = UploadFile(file=f, size=item.get("member").file_size, filename=item.get("filename"))
+
+                item["sha256"] = await asyncio.to_thread(hash_file, item.get("file").file)
+                item["blob_name"] = content_blob_name(sha256=item.get("sha256"), content_type=item.get("content_type"))
+                item["size"] = item.get("file").size
+                item["uploaded"] = False
+            except Exception as e:
+                item["error"] = str(e)
+                close_member(item)
+
+    async with asyncio.TaskGroup() as tg:
+        for item in items:
+            tg.create_task(prepare(item))
+
+    prepared = [item for item in items if "error" not in item]
+
+    if len(prepared) == 0:
+        return
+
+    # one query for the blobs that are already known
+    success, res = await Async_Postgres_DB.retrieve_any(session=session, tbl=Audio_Blob, values=list({item.get("blob_name") for item in prepared}), col_name="blob_name")
+
+    if not success:
+        raise Exception(res.get("error"))
+
+    # as in upload_file_to_bucket, a blob that has a row but no references is stored by insert_audio_files once its row is locked
+    known = {blob.blob_name for blob in res.get("objs")}
+
+    # files with the same content in one request are uploaded once
+    to_upload: Dict[UUID, Dict[str, Any]] = {}
+
+    for item in prepared:
+        if item.get("blob_name") not in known:
+            to_upload.setdefault(item.get("blob_name"), item)
+
+    for item in prepared:
+        if to_upload.get(item.get("blob_name")) is not item:
+            close_member(item)
+
+    errors: Dict[UUID, str] = {}
+
+    async def upload(item: Dict[str, Any]):
+        async with slots:
+            success, res = await upload_item(item=item, archive_file=archive_file)
+
+            if not success:
+                errors[item.get("blob_name")] = res.get("error")
+
+    async with asyncio.TaskGroup() as tg:
+        for item in to_upload.values():
+            tg.create_task(upload(item))
+
+    for item in prepared:
+        if item.get("blob_name") in errors:
+            item["error"] = errors.get(item.get("blob_name"))
+        elif item.get("blob_name") in to_upload:
+            item["uploaded"] = True
+
+async def insert_audio_files(
+    session: AsyncSession,
+    items: List[Dict[str, Any]],
+    user_id: UUID,
+    category: str,
+    archive_file: Union[zipfile.ZipFile, None]
+):
+    """
+    Inserts the audio files of the uploaded items, with their blob references and transcode jobs, in one transaction.
+
+    Sets "id" and "created_at" on every inserted item, or "error" on the items whose blob cannot be stored, and on all of them
+    when the transaction fails.
+    """
+    uploaded = [item for item in items if "error" not in item]
+
+    if len(uploaded) == 0:
+        return
+
+    now = unix_timestamp()
+    uploaded_blob_names = {item.get("blob_name") for item in uploaded if item.get("uploaded")}
+
+    # one row per blob, with as many references as files pointing at it
+    blobs: Dict[UUID, Dict[str, Any]] = {}
+
+    for item in uploaded:
+        blob = blobs.setdefault(item.get("blob_name"), {
+            "blob_name": item.get("blob_name"),
+            "sha256": item.get("sha256"),
+            "content_type": item.get("content_type"),
+            "size": item.get("size"),
+            "ref_count": 0
+        })
+        blob["ref_count"] += 1
+
+    try:
+        # the rows stay locked until the commit, the worker's sweep cannot delete the blobs in between
+        ref_counts = await reference_blobs(session=session, blobs=list(blobs.values()))
+
+        # no references before these, the blob was swept (or is about to be) since it was last stored, it is stored again
+        # before anything points at it, the items of a blob that cannot be stored fail and give their references back
+        for blob_name, blob in blobs.items():
+            if ref_counts.get(blob_name) != blob.get("ref_count") or blob_name in uploaded_blob_names:
+                continue
+
+            blob_items = [item for item in uploaded if item.get("blob_name") == blob_name]
+            success, res = await upload_item(item=blob_items[0], archive_file=archive_file)
+
+            if not success:
+                log.error("Storage", "Failed to store swept blob again", blob_name=str(blob_name), error=res.get("error"))
+                await release_blob(session=session, blob_name=blob_name, count=len(blob_items))
+
+                for item in blob_items:
+                    item["error"] = res.get("error")
+
+                continue
+
+            uploaded_blob_names.add(blob_name)
+
+        inserted = [item for item in uploaded if "error" not in item]
+
+        for item in inserted:
+            item["id"] = uuid.uuid4()
+
+        if len(inserted) > 0:
+            # a single multi-row INSERT ... RETURNING
+            rows = (await session.execute(
+                insert(Audio_File).values([
+                    {
+                        "id": item.get("id"),
+                        "user_id": user_id,
+                        "description": os.path.splitext(os.path.basename(item.get("filename")))[0][:100],
+                        "category": category,
+                        "blob_name": item.get("blob_name"),
+                        "content_type": item.get("content_type"),
+                        "created_at": now
+                    }
+                    for item in inserted
+                ]).returning(Audio_File.id, Audio_File.created_at)
+            )).all()
+
+            await session.execute(
+                insert(Transcode_Job).values([
+                    {"id": uuid.uuid4(), "audio_file_id": row.id, "status": "pending", "attempts": 0, "run_at": now, "created_at": now}
+                    for row in rows
+                ])
+            )
+
+        await session.commit()
+    except Exception as e:
+        log.error("Postgres", "Failed to insert audio files", count=len(uploaded), error=str(e))
+        await session.rollback()
+
+        # no rows point at the blobs this request stored, the worker's sweep deletes them
+        await track_orphan_blobs(session=session, blobs=[
+            {key: blob.get(key) for key in ["blob_name", "sha256", "content_type", "size"]}
+            for blob_name, blob in blobs.items()
+            if blob_name in uploaded_blob_names
+        ])
+
+        for item in uploaded:
+            item.pop("id", None)
+            item["error"] = str(e)
+
+        return
+
+    for item in inserted:
+        item["created_at"] = now
+
+async def retrieve_best_renditions(
+    session: AsyncSession,
+    audio_file_ids: List[UUID]
+) -> Tuple[bool, Dict[str, Any]]:
+    success, res = await Async_Postgres_DB.retrieve_any(session=session, tbl=Audio_Rendition, values=audio_file_ids, col_name="audio_file_id")
+
+    if not success:
+        return False, {
+            "error": res.get("error")
+        }
+
+    # audio_file_id -> most preferred rendition, in the order of TRANSCODE_RENDITIONS
+    renditions: Dict[UUID, Audio_Rendition] = {}
+
+    for rendition in sorted(res.get("objs"), key=lambda rendition: rendition_rank(rendition.format, rendition.bitrate), reverse=True):
+        renditions[rendition.audio_file_id] = rendition
+
+    return True, {
+        "renditions": renditions
+    }
+
+def playback_blob(
+    audio_file: Audio_File,
+    rendition: Union[Audio_Rendition, None]
+) -> Tuple[str, str]:
+    # the upload itself is served until the worker has transcoded it
+    if rendition is None:
+        return str(audio_file.blob_name), audio_file.content_type
+
+    return str(rendition.blob_name), rendition.content_type
+
 async def generate_sas_blob_url(
     blob_name: str,
     content_type: str
 ) -> Tuple[bool, Dict[str, Any]]:
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AZ_STORAGE_CONNECTION_STRING"))
-
-        file_ext = guess_extension(content_type)
-        blob_name = blob_name if file_ext is None else blob_name + file_ext
-
-        async with blob_service_client:
-            sas_token = generate_blob_sas(
-                account_name=blob_service_client.account_name,
-                container_name=os.getenv("AZ_STORAGE_CONTAINER_NAME"),
-                blob_name=blob_name,
-                account_key=blob_service_client.credential.account_key,
-                permission=BlobSasPermissions(read=True),
-                expiry=datetime.now(timezone.utc)+ timedelta(minutes=float(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")))
-            )
+        # a url is reused until the end of its bucket, and is signed to stay valid for a full token lifetime after that
+        bucket = int(time.time()) // SAS_URL_EXPIRY_BUCKET_SECONDS
+        bucket_end = (bucket + 1) * SAS_URL_EXPIRY_BUCKET_SECONDS
+        cache_key = (blob_name, content_type, bucket)
 
-            audio_url = f"https://{blob_service_client.account_name}.blob.core.windows.net/{os.getenv('AZ_STORAGE_CONTAINER_NAME')}/{blob_name}?{sas_token}"
+        audio_url = sas_url_cache.get(cache_key)
+
+        if audio_url is not None:
+            return True, {
+                "audio_url": audio_url
+            }
+
+        blob_name = blob_object_name(blob_name=blob_name, content_type=content_type)
+
+        # signed locally by the backend, no request is made to the storage service
+        success, res = get_storage().sign_url(blob_name=blob_name, expires_at=bucket_end + int(ACCESS_TOKEN_EXPIRE_MINUTES * 60))
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        audio_url = res.get("url")
+
+        sas_url_cache.set(cache_key, audio_url, expires_at=bucket_end)
 
         return True, {
             "audio_url": audio_url
@@ -203,4 +1089,4 @@ async def generate_sas_blob_url(
     except Exception as e:
         return False, {
             "error": str(e)
-        }
\ No newline at end of file
+        }
@@ -1,18 +1,21 @@
 # Sytem imports
-from typing import Union, Dict, Any, Callable, Tuple
+from typing import Union, Dict, Any, Callable, Tuple, Awaitable
 
 # FastAPI-related imports
 from fastapi import status, Response, HTTPException
-from app.postgres.postgres_db import Postgres_DB
+from app.postgres.async_postgres_db import Async_Postgres_DB
 from app.postgres.mappings import Base
 
 # SQLAlchemy-related imports
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 
 # Extra imports
 from uuid import UUID
 
+async def no_validation(session: AsyncSession, obj: Base) -> Tuple[bool, Dict[str, Any]]:
+    return True, None
+
 class BaseRouter:
     @staticmethod
     async def update(
@@ -20,8 +23,8 @@ class BaseRouter:
         cls: Base,
         fields: Dict[str, Any],
         response: Response,
-        session: Session,
-        validate: Callable[[Session, Base], Tuple[bool, Dict[str, Any]]] = lambda session, obj: (True, None)
+        session: AsyncSession,
+        validate: Callable[[AsyncSession, Base], Awaitable[Tuple[bool, Dict[str, Any]]]] = no_validation
     ):
         try:
             # ensure all form fields do not have leading or trailing whitespaces
@@ -32,14 +35,17 @@ class BaseRouter:
                 **fields
             )
 
-            success, res = validate(session=session, obj=obj)
+            success, res = await validate(session=session, obj=obj)
             
             if not success:
                 raise Exception(res.get("error"))
 
-            success, res = Postgres_DB.update(session=session, updated_obj=obj)
+            success, res = await Async_Postgres_DB.update(session=session, updated_obj=obj)
 
             if not success:
+                if res.get("retryable") or res.get("conflict"):
+                    # still conflicting with concurrent writes after every retry, or a unique value already taken
+                    response.status_code = status.HTTP_409_CONFLICT
                 raise Exception(res.get("error"))
 
             return {
@@ -58,22 +64,16 @@ class BaseRouter:
         id: Union[str, UUID],
         cls: Base,
         response: Response,
-        session: Session
+        session: AsyncSession
     ):
         try:
-            success, res = Postgres_DB.retrieve(session=session, tbl=cls, value=id)
-
-            if not success:
-                raise Exception(res.get("error"))
-            elif len(res.get("objs")) == 0:
-                response.status_code = status.HTTP_404_NOT_FOUND
-                raise Exception(f"No objects with {id} found")
-
-            obj = res.get("objs")[0]
-
-            success, res = Postgres_DB.delete(session=session, obj=obj)
+            # only the id is needed, the row is deleted without being loaded first
+            success, res = await Async_Postgres_DB.delete(session=session, obj=cls(id=id))
 
             if not success:
+                if res.get("not_found"):
+                    response.status_code = status.HTTP_404_NOT_FOUND
+                    raise Exception(f"No objects with {id} found")
                 raise Exception(res.get("error"))
 
             return {
@@ -92,10 +92,10 @@ class BaseRouter:
         cls: Base,
         scheme: BaseModel,
         response: Response,
-        session: Session
+        session: AsyncSession
     ):
         try:
-            success, res = Postgres_DB.retrieve(session=session, tbl=cls, value=id)
+            success, res = await Async_Postgres_DB.retrieve(session=session, tbl=cls, value=id)
 
             if not success:
                 raise Exception(res.get("error"))
@@ -121,8 +121,8 @@ class BaseRouter:
         cls: BaseModel,
         fields: Dict[str, Any],
         response: Response,
-        session: Session,
-        validate: Callable[[Session, Base], Tuple[bool, Dict[str, Any]]] = lambda session, obj: (True, None)
+        session: AsyncSession,
+        validate: Callable[[AsyncSession, Base], Awaitable[Tuple[bool, Dict[str, Any]]]] = no_validation
     ):
         try:
             fields = {key: value.strip() if isinstance(value, str) else value for key, value in fields.items()}
@@ -131,14 +131,17 @@ class BaseRouter:
                 **fields
             )
 
-            success, res = validate(session=session, obj=obj)
+            success, res = await validate(session=session, obj=obj)
             
             if not success:
                 raise Exception(res.get("error"))
 
-            success, res = Postgres_DB.insert(session=session, obj=obj)
+            success, res = await Async_Postgres_DB.insert(session=session, obj=obj)
 
             if not success:
+                if res.get("retryable") or res.get("conflict"):
+                    # still conflicting with concurrent writes after every retry, or a unique value already taken
+                    response.status_code = status.HTTP_409_CONFLICT
                 raise Exception(res.get("error"))
 
             return {
@@ -157,10 +160,10 @@ class BaseRouter:
         cls: Base,
         scheme: BaseModel,
         response: Response,
-        session: Session
+        session: AsyncSession
     ):
         try:
-            success, res = Postgres_DB.retrieve(session=session, tbl=cls)
+            success, res = await Async_Postgres_DB.retrieve(session=session, tbl=cls)
 
             if not success:
                 raise Exception(res.get("error"))
@@ -0,0 +1,71 @@
+# Sytem imports
+import time
+
+# FastAPI-related imports
+from fastapi import APIRouter, status, Request, Response, HTTPException
+from fastapi.responses import FileResponse
+from app.dependencies import get_storage
+from app.storage.local import LocalStorage
+from app.storage.streaming import blob_response
+
+# only included by main.py when STORAGE_BACKEND=local
+router = APIRouter(
+    prefix="/storage",
+    tags=["storage"],
+    responses={404: {"description": "Not found"}}
+)
+
+@router.get("/{blob_name}", status_code=status.HTTP_200_OK)
+async def serve_blob(
+    blob_name: str,
+    expires: int,
+    signature: str,
+    request: Request,
+    response: Response
+):
+    try:
+        storage = get_storage()
+
+        if not isinstance(storage, LocalStorage):
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception("Blobs are not served by this app")
+
+        # the signature is the authorisation, as with an azure SAS url
+        if not storage.verify_url(blob_name=blob_name, expires_at=expires, signature=signature, now=int(time.time())):
+            response.status_code = status.HTTP_403_FORBIDDEN
+            raise Exception("Invalid or expired signature")
+
+        success, res = await storage.stat(blob_name)
+
+        if not success:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception(f"Blob {blob_name} not found")
+
+        if storage.sendfile_header is not None:
+            # an empty response, the proxy replaces it with the file and keeps its content type and cache control
+            return Response(
+                headers={storage.sendfile_header: storage.sendfile_location(blob_name), "Cache-Control": "private, max-age=3600"},
+                media_type=res.get("content_type")
+            )
+
+        # seeks and conditional requests only read the bytes they need
+        if any(header in request.headers for header in ["range", "if-none-match", "if-modified-since"]):
+            return blob_response(
+                request=request,
+                storage=storage,
+                blob_name=blob_name,
+                size=res.get("size"),
+                content_type=res.get("content_type"),
+                etag=f'"{res.get("etag")}"',
+                last_modified=res.get("last_modified"),
+                cache_control="private, max-age=3600"
+            )
+
+        # read and sent in chunks by the app, LOCAL_STORAGE_SENDFILE_HEADER moves this to the proxy
+        return FileResponse(storage.path(blob_name), media_type=res.get("content_type"))
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
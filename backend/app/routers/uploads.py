@@ -0,0 +1,420 @@
+# Sytem imports
+import hashlib
+import asyncio
+from typing import Annotated, Tuple, Dict, Any
+from uuid import UUID
+
+# FastAPI-related imports
+from fastapi import APIRouter, Form, Header, status, Request, Response, Depends, HTTPException
+from starlette.requests import ClientDisconnect
+from app.dependencies import async_session, get_session, get_read_session, current_user, UserScheme, get_storage
+from app.storage.base import blob_object_name
+from app.postgres.async_postgres_db import Async_Postgres_DB
+from app.postgres.mappings import Audio_File, Upload_Session
+from app.transcode import new_transcode_job
+from app.dedup import content_blob_name, reference_blob, track_orphan_blobs
+from app.resumable import RESUMABLE_UPLOAD_MAX_SIZE, RESUMABLE_UPLOAD_BLOCK_SIZE, RESUMABLE_UPLOAD_TTL_SECONDS, upload_blob_name, block_id, ordered_block_ids
+from app.postgres.utils import unix_timestamp
+from app import log
+
+# SQLAlchemy-related imports
+from sqlalchemy import update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# resumable uploads, for large files over connections that drop:
+# POST /audio_files/uploads declares the file, PATCH /audio_files/uploads/{id} sends it in any number of chunks from the
+# offset the server reports, POST /audio_files/uploads/{id}/finalize turns it into an audio file
+router = APIRouter(
+    prefix="/audio_files/uploads",
+    tags=["audio_files"],
+    responses={404: {"description": "Not found"}}
+)
+
+@router.post("", status_code=status.HTTP_201_CREATED)
+async def create_upload(
+    description: Annotated[str, Form(max_length=100)],
+    category: Annotated[str, Form(max_length=50)],
+    content_type: Annotated[str, Form(max_length=50, pattern=r"^audio/")],
+    size: Annotated[int, Form(ge=1, le=RESUMABLE_UPLOAD_MAX_SIZE)],
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        upload = Upload_Session(
+            user_id=user.id,
+            description=description,
+            category=category,
+            content_type=content_type,
+            size=size,
+            offset=0,
+            expires_at=unix_timestamp() + RESUMABLE_UPLOAD_TTL_SECONDS
+        )
+
+        success, res = await Async_Postgres_DB.insert(session=session, obj=upload)
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        response.headers["Location"] = f"{router.prefix}/{res.get('id')}"
+        response.headers["Upload-Offset"] = "0"
+
+        return {
+            "id": res.get("id"),
+            "offset": 0,
+            "size": size,
+            "expires_at": upload.expires_at
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.get("/{id}", status_code=status.HTTP_200_OK)
+async def retrieve_upload(
+    id: UUID,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_read_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        success, res = await retrieve_upload_session(session=session, id=id, user_id=user.id)
+
+        if not success:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception(res.get("error"))
+
+        upload: Upload_Session = res.get("upload")
+
+        # where a client resumes from after a dropped connection
+        response.headers["Upload-Offset"] = str(upload.offset)
+
+        return {
+            "id": upload.id,
+            "offset": upload.offset,
+            "size": upload.size,
+            "expires_at": upload.expires_at
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.patch("/{id}", status_code=status.HTTP_200_OK)
+async def append_upload(
+    id: UUID,
+    upload_offset: Annotated[int, Header(alias="Upload-Offset", ge=0)],
+    request: Request,
+    response: Response,
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        # short-lived sessions, no connection is held while the body trickles in
+        async with async_session() as session:
+            success, res = await retrieve_upload_session(session=session, id=id, user_id=user.id)
+
+        if not success:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception(res.get("error"))
+
+        upload: Upload_Session = res.get("upload")
+
+        if upload_offset != upload.offset:
+            response.status_code = status.HTTP_409_CONFLICT
+            raise Exception(f"The upload is at offset {upload.offset}, not {upload_offset}")
+
+        offset = upload.offset
+        buffer = bytearray()
+
+        async def stage(length: int):
+            nonlocal offset
+
+            success, res = await get_storage().stage_block(blob_name=upload_blob_name(id), block_id=block_id(offset), data=bytes(buffer[:length]))
+
+            if not success:
+                raise Exception(res.get("error"))
+
+            success, res = await advance_upload(id=id, offset=offset, length=length)
+
+            if not success:
+                response.status_code = status.HTTP_409_CONFLICT
+                raise Exception(res.get("error"))
+
+            offset += length
+            del buffer[:length]
+
+        try:
+            async for chunk in request.stream():
+                if offset + len(buffer) + len(chunk) > upload.size:
+                    response.status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                    raise Exception(f"The chunk goes past the declared size of {upload.size} bytes")
+
+                buffer += chunk
+
+                # only one block is held in memory, whatever the size of the chunk
+                while len(buffer) >= RESUMABLE_UPLOAD_BLOCK_SIZE:
+                    await stage(RESUMABLE_UPLOAD_BLOCK_SIZE)
+        except ClientDisconnect:
+            # the bytes that did arrive are kept, the client resumes after them
+            if len(buffer) > 0:
+                await stage(len(buffer))
+
+            log.info("Uploads", "Client disconnected", upload_id=str(id), offset=offset)
+            return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+        if len(buffer) > 0:
+            await stage(len(buffer))
+
+        response.headers["Upload-Offset"] = str(offset)
+
+        return {
+            "id": id,
+            "offset": offset,
+            "size": upload.size
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.post("/{id}/finalize", status_code=status.HTTP_201_CREATED)
+async def finalize_upload(
+    id: UUID,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        success, res = await retrieve_upload_session(session=session, id=id, user_id=user.id)
+
+        if not success:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception(res.get("error"))
+
+        upload: Upload_Session = res.get("upload")
+
+        if upload.offset != upload.size:
+            response.status_code = status.HTTP_409_CONFLICT
+            raise Exception(f"The upload is at offset {upload.offset} of {upload.size}")
+
+        # kept away from the worker's sweep while the blocks are committed and hashed
+        await session.execute(
+            update(Upload_Session).where(Upload_Session.id == id).values(expires_at=unix_timestamp() + RESUMABLE_UPLOAD_TTL_SECONDS)
+        )
+        await session.commit()
+
+        success, res = await commit_upload(upload=upload)
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        sha256 = res.get("sha256")
+        blob_name = content_blob_name(sha256=sha256, content_type=upload.content_type)
+
+        # the reference, the removal of the session and the audio file are one transaction, the blob row is locked until it commits
+        moved = False
+
+        try:
+            success, res = await reference_blob(session=session, blob_name=blob_name, sha256=sha256, content_type=upload.content_type, size=upload.size)
+
+            if not success:
+                raise Exception(res.get("error"))
+
+            if res.get("created"):
+                # the first (or only live) reference, the staged blob becomes the content-addressed one
+                success, res = await get_storage().move(
+                    src_blob_name=upload_blob_name(id),
+                    dst_blob_name=blob_object_name(blob_name=str(blob_name), content_type=upload.content_type)
+                )
+
+                if not success:
+                    raise Exception(res.get("error"))
+
+                moved = True
+
+            # a second finalize of the session finds nothing to delete
+            deleted = (await session.execute(
+                delete(Upload_Session).where(Upload_Session.id == id).returning(Upload_Session.id)
+            )).scalar_one_or_none()
+
+            if deleted is None:
+                response.status_code = status.HTTP_409_CONFLICT
+                raise Exception("The upload has already been finalised")
+
+            audio_file = Audio_File(
+                user_id=user.id,
+                description=upload.description,
+                category=upload.category,
+                blob_name=blob_name,
+                content_type=upload.content_type,
+                created_at=unix_timestamp(),
+                # picked up by the transcoding worker (app.worker) once this transaction commits
+                transcode_job=new_transcode_job()
+            )
+
+            session.add(audio_file)
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+
+            if moved:
+                # no row points at the blob, the worker's sweep deletes it
+                await track_orphan_blobs(session=session, blobs=[{"blob_name": blob_name, "sha256": sha256, "content_type": upload.content_type, "size": upload.size}])
+
+            raise e
+
+        if not moved:
+            # the same content is already stored, the staged copy is dropped
+            success, res = await get_storage().delete(upload_blob_name(id))
+
+            if not success:
+                log.warning("Uploads", "Could not delete the staged blob", upload_id=str(id), error=res.get("error"))
+
+        return {
+            "id": audio_file.id,
+            "created_at": audio_file.created_at
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+@router.delete("/{id}", status_code=status.HTTP_200_OK)
+async def abort_upload(
+    id: UUID,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
+):
+    try:
+        deleted = (await session.execute(
+            delete(Upload_Session).where(
+                Upload_Session.id == id,
+                Upload_Session.user_id == user.id
+            ).returning(Upload_Session.id)
+        )).scalar_one_or_none()
+
+        if deleted is None:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            raise Exception("Upload not found")
+
+        success, res = await get_storage().discard_blocks(upload_blob_name(id))
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        await session.commit()
+
+        return {
+            "id": id
+        }
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR if response.status_code is None else response.status_code,
+            detail=str(e)
+        )
+
+async def retrieve_upload_session(
+    session: AsyncSession,
+    id: UUID,
+    user_id: UUID
+) -> Tuple[bool, Dict[str, Any]]:
+    success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Upload_Session, value=id, col_name="id")
+
+    if not success:
+        return False, res
+
+    upload = res.get("objs")[0] if len(res.get("objs")) > 0 else None
+
+    # an expired session may be in the middle of being swept
+    if upload is None or upload.user_id != user_id or upload.expires_at < unix_timestamp():
+        return False, {
+            "error": "Upload not found"
+        }
+
+    return True, {
+        "upload": upload
+    }
+
+async def advance_upload(
+    id: UUID,
+    offset: int,
+    length: int
+) -> Tuple[bool, Dict[str, Any]]:
+    # compare-and-set on the offset, of two requests sending the same chunk only one moves the upload forward
+    async with async_session() as session:
+        now = unix_timestamp()
+
+        res = await session.execute(
+            update(Upload_Session).where(
+                Upload_Session.id == id,
+                Upload_Session.offset == offset,
+                Upload_Session.expires_at >= now
+            ).values(
+                offset=offset + length,
+                expires_at=now + RESUMABLE_UPLOAD_TTL_SECONDS,
+                updated_at=now
+            )
+        )
+        await session.commit()
+
+    if res.rowcount == 0:
+        return False, {
+            "error": f"The upload is no longer at offset {offset}"
+        }
+
+    return True, {
+        "offset": offset + length
+    }
+
+async def commit_upload(upload: Upload_Session) -> Tuple[bool, Dict[str, Any]]:
+    # commits the staged blocks in offset order and hashes the result, returns { "sha256": str }
+    storage = get_storage()
+    blob_name = upload_blob_name(upload.id)
+
+    success, res = await storage.list_blocks(blob_name)
+
+    if not success:
+        return False, res
+
+    if len(res.get("blocks")) > 0:
+        block_ids = ordered_block_ids(blocks=res.get("blocks"), size=upload.size)
+
+        if block_ids is None:
+            return False, {
+                "error": "The staged blocks do not add up to the declared size"
+            }
+
+        success, res = await storage.commit_blocks(blob_name=blob_name, block_ids=block_ids, content_type=upload.content_type)
+
+        if not success:
+            return False, res
+    else:
+        # committed by an earlier finalize that failed further on
+        success, res = await storage.stat(blob_name)
+
+        if not success or res.get("size") != upload.size:
+            return False, {
+                "error": "The upload has no staged blocks"
+            }
+
+    # the hash of a file sent over many requests is only known once it is whole, it is read back in one pass
+    sha256 = hashlib.sha256()
+
+    try:
+        async for chunk in storage.read(blob_name=blob_name, offset=0, length=upload.size):
+            # hashlib releases the GIL while it hashes the chunk
+            await asyncio.to_thread(sha256.update, chunk)
+    except Exception as e:
+        return False, {
+            "error": str(e)
+        }
+
+    return True, {
+        "sha256": sha256.hexdigest()
+    }
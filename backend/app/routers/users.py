@@ -3,18 +3,18 @@ from typing import Union, Annotated, Tuple, Dict, Any
 
 # FastAPI-related imports
 from fastapi import APIRouter, Form, status, Response, Depends, HTTPException
-from app.dependencies import get_session, oauth2_scheme, decode_access_token, create_access_token, verify_password, get_password_hash
-from app.postgres.postgres_db import Postgres_DB
+from app.dependencies import get_session, get_serializable_session, current_user, invalidate_current_user, create_access_token, verify_and_update_password, get_password_hash, UserScheme
+from app.postgres.async_postgres_db import Async_Postgres_DB
 from app.postgres.mappings import User
 from app.routers.base import BaseRouter
+from app.dedup import release_user_blobs
+from app import log
 
 # SQLAlchemy-related imports
-from sqlalchemy.orm import Session
-from pydantic import BaseModel, ConfigDict
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # Extra imports
 from uuid import UUID
-from sqlalchemy import or_
 
 router = APIRouter(
     prefix="/users",
@@ -25,28 +25,24 @@ router = APIRouter(
 # User-related functions
 # ---------------------------------------------------------------------
 
-class UserScheme(BaseModel):
-    model_config = ConfigDict(from_attributes=True)
-    id: UUID
-    username: str
-    email: str
-    full_name: str
-    disabled: bool
-
 # Invoked from main.py's /token route
 async def login_for_access_token(
     username: str,
     password: str,
-    session: Session,
+    session: AsyncSession,
 ):
     try:
-        success, res = authenticate_user(username, password, session)
+        success, res = await authenticate_user(username, password, session)
 
         if not success:
             raise Exception(res.get("error"))
         
         user: User = res.get("user")
 
+        if res.get("new_password_hash") is not None:
+            # password was hashed with outdated parameters, a failed rehash is retried on the next login
+            await Async_Postgres_DB.update(session=session, updated_obj=User(id=user.id, password_hash=res.get("new_password_hash")))
+
         success, res = create_access_token(
             data = {
                 "sub": str(user.id)
@@ -56,12 +52,16 @@ async def login_for_access_token(
         if not success:
             raise Exception(res.get("error"))
         
-        print(res)
+        # the token itself is never logged
+        log.info("Users", "Issued access token", sampled=True, user_id=str(user.id))
 
         return res
     
+    except HTTPException:
+        # e.g., 429 when the password workers are saturated
+        raise
     except Exception as e:
-        print(e)
+        log.warning("Users", "Login failed", username=username, error=str(e))
         raise HTTPException(
             status_code = status.HTTP_401_UNAUTHORIZED,
             detail = str(e),
@@ -72,19 +72,12 @@ async def login_for_access_token(
 
 @router.get("/", status_code=status.HTTP_200_OK)
 async def get_current_user(
-    response: Response,
-    session: Annotated[Session, Depends(get_session)],
-    token: Annotated[str, Depends(oauth2_scheme)]
+    user: Annotated[UserScheme, Depends(current_user)]
 ):
-    user_id = decode_access_token(token)
-
-    return await BaseRouter.retrieve(
-        id=UUID(user_id),
-        cls=User,
-        scheme=UserScheme,
-        response=response,
-        session=session
-    )
+    # resolved (and cached) by the current_user dependency, no query needed here
+    return {
+        "obj": user.model_dump_json()
+    }
 
 # put wildcard routes last
 @router.put("/", status_code=status.HTTP_202_ACCEPTED)
@@ -93,38 +86,51 @@ async def update_user(
     email: Annotated[str, Form()],
     full_name: Annotated[str, Form()],
     response: Response,
-    session: Annotated[Session, Depends(get_session)],
-    token: Annotated[str, Depends(oauth2_scheme)]
+    session: Annotated[AsyncSession, Depends(get_serializable_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
 ):
-    user_id = decode_access_token(token)
-
-    return await BaseRouter.update(
-        id=UUID(user_id),
-        cls=User,
-        fields={
-            "username": username,
-            "email": email,
-            "full_name": full_name,
-        },
-        response=response,
-        session=session,
-        validate=validate_user
-    )
+    try:
+        return await BaseRouter.update(
+            id=user.id,
+            cls=User,
+            fields={
+                "username": username,
+                "email": email,
+                "full_name": full_name,
+            },
+            response=response,
+            session=session
+        )
+    finally:
+        # the cached snapshot is outdated, reload it on the next request
+        invalidate_current_user(user.id)
 
 @router.delete("/", status_code=status.HTTP_202_ACCEPTED)
 async def delete_user(
     response: Response,
-    session: Annotated[Session, Depends(get_session)],
-    token: Annotated[str, Depends(oauth2_scheme)]
+    session: Annotated[AsyncSession, Depends(get_session)],
+    user: Annotated[UserScheme, Depends(current_user)]
 ):
-    user_id = decode_access_token(token)
+    try:
+        # their audio files are deleted with them (ON DELETE CASCADE), in the transaction BaseRouter.delete commits
+        await release_user_blobs(session=session, user_id=user.id)
+    except Exception as e:
+        log.error("Postgres", "Failed to release the user's blobs", user_id=str(user.id), error=str(e))
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
 
-    return await BaseRouter.delete(
-        id=UUID(user_id),
-        cls=User,
-        response=response,
-        session=session
-    )
+    try:
+        return await BaseRouter.delete(
+            id=user.id,
+            cls=User,
+            response=response,
+            session=session
+        )
+    finally:
+        invalidate_current_user(user.id)
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def create_user(
@@ -133,60 +139,34 @@ async def create_user(
     password: Annotated[str, Form()],
     full_name: Annotated[str, Form()],
     response: Response,
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_serializable_session)]
 ):
     return await BaseRouter.create(
         cls=User,
         fields={
             "username": username,
             "email": email,
-            "password_hash": get_password_hash(password),
+            "password_hash": await get_password_hash(password),
             "full_name": full_name,
             "disabled": False
         },
         response=response,
-        session=session,
-        validate=validate_user
+        session=session
     )
 
 # Helper Functions
 # ---------------------------------------------------------------------
 
-# Validation Functions
-# --------------------
-def validate_user(session: Session, obj: User) -> Tuple[bool, Dict[str, Any]]:
-    try:
-        res = session.query(User).filter(
-            User.id != obj.id,
-            or_(
-                User.email == obj.email,
-                User.username == obj.username
-            )
-        ).all()
-
-        if len(res) > 0:
-            raise Exception("Email or username already exists!")
-
-        return True, {
-            "error": ""
-        }
-
-    except Exception as e:
-        return False, {
-            "error": str(e)
-        }
-
-
 # Authentication Functions
 # ------------------------
 
-def authenticate_user(
+async def authenticate_user(
     username: str,
     password: str,
-    session: Session
+    session: AsyncSession
 ) -> Tuple[bool, Union[str, Any]]:
     try:
-        success, res = Postgres_DB.retrieve(session=session, tbl=User, value=username, col_name="username")
+        success, res = await Async_Postgres_DB.retrieve(session=session, tbl=User, value=username, col_name="username")
         if not success:
             raise Exception(res.get("error"))
         elif len(res.get("objs")) == 0:
@@ -194,13 +174,18 @@ def authenticate_user(
         
         user: User = res.get("objs")[0]
 
-        if not verify_password(password, user.password_hash):
+        valid, new_password_hash = await verify_and_update_password(password, user.password_hash)
+
+        if not valid:
             raise Exception("Incorrect username or password")
         
         return True, {
-            "user": user
+            "user": user,
+            "new_password_hash": new_password_hash
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         return False, {
             "error": str(e)
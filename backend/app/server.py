@@ -0,0 +1,143 @@
+# Sytem imports
+import os
+import math
+import shutil
+import tempfile
+from typing import Dict, Any
+
+# server-related imports
+from gunicorn.app.base import BaseApplication
+from uvicorn_worker import UvicornWorker
+
+# FastAPI-related imports
+from app import log
+
+PORT = int(os.getenv("PORT") or 8000)
+# requests a worker serves before it is replaced, plus up to MAX_REQUESTS_JITTER so that workers are not all replaced at once,
+# caps the memory a worker can accumulate (fragmentation, caches); 0 never replaces them
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS") or 10000)
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER") or MAX_REQUESTS // 10)
+# seconds in-flight requests (e.g., uploads) get to finish after SIGTERM before their worker is killed,
+# the container's stop timeout has to be longer than this (stop_grace_period in docker-compose.yaml)
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT") or 120)
+# of the graceful timeout, kept for the lifespan shutdown (closing the pool and the storage clients) once requests are cut off
+LIFESPAN_SHUTDOWN_SECONDS = 5
+# a worker whose event loop has not checked in for this long is considered stuck and restarted
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT") or 30)
+KEEPALIVE = int(os.getenv("KEEPALIVE") or 5)
+# proxies whose X-Forwarded-* headers are trusted
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS") or "127.0.0.1"
+# counters and histograms of every worker are written there, the master adds them up when it is scraped (app.metrics.start_metrics_server)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.path.join(tempfile.gettempdir(), "prometheus-multiproc")
+
+def available_cpus() -> float:
+    # cpus this process may use, a container limited with a cgroup quota (e.g., docker --cpus 2) still reports the host's in os.cpu_count()
+    cpus = float(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+
+    try:
+        # cgroup v2, "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+
+        if quota != "max":
+            cpus = min(cpus, int(quota) / int(period))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1, a quota of -1 is unlimited
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+
+            if quota > 0:
+                cpus = min(cpus, quota / period)
+        except (OSError, ValueError):
+            pass
+
+    return cpus
+
+def worker_count(cpus: float) -> int:
+    # one worker per whole cpu, rounded down so that a fractional quota is not exceeded and throttled
+    return int(os.getenv("WEB_CONCURRENCY") or max(math.floor(cpus), 1))
+
+class DrainingUvicornWorker(UvicornWorker):
+    """
+    Stops accepting connections on SIGTERM and lets in-flight requests finish, cancelling whatever is left shortly
+    before gunicorn would kill the worker, so that the lifespan shutdown still runs.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(self.cfg.graceful_timeout - LIFESPAN_SHUTDOWN_SECONDS, 1)
+
+def on_starting(server):
+    # files of a previous run would be added to this one's counters
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR)
+
+def when_ready(server):
+    # the master serves the metrics of every worker on METRICS_PORT, imported here once PROMETHEUS_MULTIPROC_DIR is set
+    from app.metrics import start_metrics_server
+
+    start_metrics_server()
+
+def child_exit(server, worker):
+    # gauges of the worker are dropped, its counters and histograms keep counting towards the totals
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+    log.info("Server", "Worker exited", pid=worker.pid)
+
+class Server(BaseApplication):
+    """
+    gunicorn with uvicorn workers, python -m app.server.
+
+    The app is imported by every worker after it is forked (no preload), so each worker runs its own lifespan:
+    its own connection pool and blob storage clients, nothing is shared across the fork.
+    """
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app.main import app
+
+        return app
+
+def main():
+    cpus = available_cpus()
+    workers = worker_count(cpus)
+
+    # read by the workers when they import the app: pools are sized from the worker count (app.dependencies),
+    # bcrypt threads share the cpus, and prometheus_client switches to multiprocess mode
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(math.ceil(cpus / workers), 1)))
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = PROMETHEUS_MULTIPROC_DIR
+
+    log.info("Server", "Starting", cpus=round(cpus, 2), workers=workers, port=PORT)
+
+    Server({
+        "bind": f"0.0.0.0:{PORT}",
+        "workers": workers,
+        "worker_class": DrainingUvicornWorker,
+        "preload_app": False,
+        "max_requests": MAX_REQUESTS,
+        "max_requests_jitter": MAX_REQUESTS_JITTER,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "timeout": WORKER_TIMEOUT,
+        "keepalive": KEEPALIVE,
+        "forwarded_allow_ips": FORWARDED_ALLOW_IPS,
+        # the app writes its own structured access log (app.metrics.MetricsMiddleware)
+        "accesslog": None,
+        "on_starting": on_starting,
+        "when_ready": when_ready,
+        "child_exit": child_exit
+    }).run()
+
+if __name__ == "__main__":
+    # python -m app.server
+    main()
@@ -0,0 +1,289 @@
+# Sytem imports
+import os
+import asyncio
+from typing import Tuple, Dict, Any, List, Union, AsyncIterator
+from datetime import datetime, timezone
+
+# FastAPI-related imports
+from fastapi import UploadFile
+from app.storage.base import BaseStorage
+from app.metrics import observe_storage, observe_storage_read
+from app import log
+
+# azure-related imports
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient, BlobClient, ContainerClient
+from azure.storage.blob import generate_blob_sas, BlobSasPermissions, ContentSettings
+from azure.core.exceptions import ResourceNotFoundError
+
+# uploads are staged to azure in blocks of this size, with at most UPLOAD_MAX_CONCURRENCY blocks in flight,
+# so the memory held per upload is bounded by UPLOAD_CHUNK_SIZE * (UPLOAD_MAX_CONCURRENCY + 1) regardless of the file size
+UPLOAD_CHUNK_SIZE = int(os.getenv("AZ_STORAGE_UPLOAD_CHUNK_SIZE") or 4 * 1024 * 1024)
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("AZ_STORAGE_UPLOAD_MAX_CONCURRENCY") or 4)
+# seconds between polls of a server-side copy (move), copies within an account usually finish on the first one
+COPY_POLL_INTERVAL = float(os.getenv("AZ_STORAGE_COPY_POLL_INTERVAL") or 1)
+
+class AzureStorage(BaseStorage):
+    name = "azure"
+
+    def __init__(self):
+        self.connection_string = os.getenv("AZ_STORAGE_CONNECTION_STRING")
+        self.container_name = os.getenv("AZ_STORAGE_CONTAINER_NAME")
+        self.pool_size = int(os.getenv("AZ_STORAGE_POOL_SIZE") or 100)
+        self.keepalive_timeout = float(os.getenv("AZ_STORAGE_KEEPALIVE_TIMEOUT") or 30)
+
+        # process-wide client, so that every request reuses the same parsed connection string,
+        # aiohttp session and pool of keep-alive connections
+        self.blob_service_client: Union[BlobServiceClient, None] = None
+        self.http_session: Union[aiohttp.ClientSession, None] = None
+
+        # account credentials, read once so that SAS tokens are signed without going through a client
+        self.account: Union[Dict[str, str], None] = None
+
+    async def initialise(self) -> bool:
+        try:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self.http_session = aiohttp.ClientSession(connector=connector)
+
+            # session_owner=False, the session outlives the client's transport and is closed in dispose
+            self.blob_service_client = BlobServiceClient.from_connection_string(
+                self.connection_string,
+                transport=AioHttpTransport(session=self.http_session, session_owner=False)
+            )
+            await self.blob_service_client.__aenter__()
+
+            self.account = {
+                "account_name": self.blob_service_client.account_name,
+                "account_key": self.blob_service_client.credential.account_key,
+                # primary endpoint, e.g. https://<account>.blob.core.windows.net
+                "url": self.blob_service_client.url.rstrip("/")
+            }
+
+            return True
+        except Exception as e:
+            log.error("Azure", "Could not create blob client", error=str(e))
+            return False
+
+    async def dispose(self):
+        if self.blob_service_client is not None:
+            await self.blob_service_client.close()
+            self.blob_service_client = None
+
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
+    def get_blob_client(self, blob_name: str) -> BlobClient:
+        if self.blob_service_client is None:
+            raise Exception("Blob storage has not been initialised")
+
+        # child clients reuse the connection pool of the shared client
+        container_client: ContainerClient = self.blob_service_client.get_container_client(self.container_name)
+
+        return container_client.get_blob_client(blob_name)
+
+    @observe_storage("upload")
+    async def upload(self, blob_name: str, file: UploadFile, content_type: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            blob_client = self.get_blob_client(blob_name)
+            block_ids, size = await self.stage_blocks(blob_client=blob_client, file=file)
+            await blob_client.commit_block_list(block_ids, content_settings=ContentSettings(content_type=content_type))
+
+            return True, {
+                "size": size
+            }
+        except ExceptionGroup as eg:
+            # raised by the TaskGroup in stage_blocks, report the first block that failed
+            return False, {
+                "error": str(eg.exceptions[0])
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @staticmethod
+    async def stage_blocks(
+        blob_client: BlobClient,
+        file: UploadFile
+    ) -> Tuple[List[str], int]:
+        # reads the spooled upload chunk by chunk and stages each chunk as an uncommitted block
+        block_ids: List[str] = []
+        size = 0
+        # a slot is taken before a chunk is read and freed once it is staged, this caps the chunks held in memory
+        slots = asyncio.Semaphore(UPLOAD_MAX_CONCURRENCY)
+
+        async def stage_block(block_id: str, chunk: bytes):
+            try:
+                await blob_client.stage_block(block_id=block_id, data=chunk, length=len(chunk))
+            finally:
+                slots.release()
+
+        async with asyncio.TaskGroup() as tg:
+            while True:
+                await slots.acquire()
+                chunk: bytes = await file.read(UPLOAD_CHUNK_SIZE)
+
+                if not chunk:
+                    slots.release()
+                    break
+
+                # block ids must all have the same length, zero-pad so that they also sort in upload order
+                block_id = f"{len(block_ids):08d}"
+                block_ids.append(block_id)
+                size += len(chunk)
+                tg.create_task(stage_block(block_id, chunk))
+
+        return block_ids, size
+
+    def sign_url(self, blob_name: str, expires_at: int) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            if self.account is None:
+                raise Exception("Blob storage has not been initialised")
+
+            # signing is done locally with the account key, no request is made to azure
+            sas_token = generate_blob_sas(
+                account_name=self.account.get("account_name"),
+                container_name=self.container_name,
+                blob_name=blob_name,
+                account_key=self.account.get("account_key"),
+                permission=BlobSasPermissions(read=True),
+                expiry=datetime.fromtimestamp(expires_at, timezone.utc)
+            )
+
+            return True, {
+                "url": f"{self.account.get('url')}/{self.container_name}/{blob_name}?{sas_token}"
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage_read
+    async def read(self, blob_name: str, offset: int, length: int) -> AsyncIterator[bytes]:
+        # a ranged download, azure is only asked for the requested bytes
+        downloader = await self.get_blob_client(blob_name).download_blob(offset=offset, length=length)
+
+        async for chunk in downloader.chunks():
+            yield chunk
+
+    @observe_storage("delete")
+    async def delete(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            await self.get_blob_client(blob_name).delete_blob()
+
+            return True, {
+                "blob_name": blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("stat")
+    async def stat(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            properties = await self.get_blob_client(blob_name).get_blob_properties()
+
+            return True, {
+                "size": properties.size,
+                "content_type": properties.content_settings.content_type,
+                "last_modified": int(properties.last_modified.timestamp()),
+                "etag": properties.etag.strip('"')
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("stage_block")
+    async def stage_block(self, blob_name: str, block_id: str, data: bytes) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            await self.get_blob_client(blob_name).stage_block(block_id=block_id, data=data, length=len(data))
+
+            return True, {
+                "block_id": block_id,
+                "size": len(data)
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("list_blocks")
+    async def list_blocks(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            _, uncommitted = await self.get_blob_client(blob_name).get_block_list("uncommitted")
+        except ResourceNotFoundError:
+            # nothing was staged yet
+            uncommitted = []
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+        return True, {
+            "blocks": {block.id: block.size for block in uncommitted}
+        }
+
+    @observe_storage("commit_blocks")
+    async def commit_blocks(self, blob_name: str, block_ids: List[str], content_type: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            await self.get_blob_client(blob_name).commit_block_list(block_ids, content_settings=ContentSettings(content_type=content_type))
+
+            return True, {
+                "blob_name": blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("discard_blocks")
+    async def discard_blocks(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            blob_client = self.get_blob_client(blob_name)
+
+            # azure has no call to drop uncommitted blocks (it does so itself after a week),
+            # committing an empty list drops them at once and leaves an empty blob to delete
+            await blob_client.commit_block_list([])
+            await blob_client.delete_blob()
+
+            return True, {
+                "blob_name": blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("move")
+    async def move(self, src_blob_name: str, dst_blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            src_client = self.get_blob_client(src_blob_name)
+            dst_client = self.get_blob_client(dst_blob_name)
+
+            # a server-side copy, the source is in the same account so the shared key authorises reading it
+            copy = await dst_client.start_copy_from_url(src_client.url)
+            copy_status = copy.get("copy_status")
+
+            while copy_status == "pending":
+                await asyncio.sleep(COPY_POLL_INTERVAL)
+                copy_status = (await dst_client.get_blob_properties()).copy.status
+
+            if copy_status != "success":
+                raise Exception(f"Copy of {src_blob_name} to {dst_blob_name} ended with status {copy_status}")
+
+            await src_client.delete_blob()
+
+            return True, {
+                "blob_name": dst_blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
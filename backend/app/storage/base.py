@@ -0,0 +1,79 @@
+# Sytem imports
+import abc
+from typing import Tuple, Dict, Any, List, AsyncIterator
+from mimetypes import guess_extension
+
+# FastAPI-related imports
+from fastapi import UploadFile
+
+def blob_object_name(blob_name: str, content_type: str) -> str:
+    # blobs are stored under their uuid plus the extension of their content type
+    file_ext = guess_extension(content_type)
+
+    return blob_name if file_ext is None else blob_name + file_ext
+
+class BaseStorage(abc.ABC):
+    """
+    Interface shared by the blob storage backends (see app.dependencies.initialise_storage).
+
+    Every method returns (success, res) like Postgres_DB, with res["error"] set on failure.
+    Blob names are flat object names, e.g. "<uuid>.wav". A backend missing any of the abstract methods fails when it is instantiated.
+    """
+    # backend label of the storage metrics (app.metrics)
+    name = "base"
+
+    async def initialise(self) -> bool:
+        return True
+
+    async def dispose(self):
+        pass
+
+    @abc.abstractmethod
+    async def upload(self, blob_name: str, file: UploadFile, content_type: str) -> Tuple[bool, Dict[str, Any]]:
+        # streams file into the blob, returns { "size": int }
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sign_url(self, blob_name: str, expires_at: int) -> Tuple[bool, Dict[str, Any]]:
+        # signs a read-only url that stays valid until expires_at (unix time), returns { "url": str }
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self, blob_name: str, offset: int, length: int) -> AsyncIterator[bytes]:
+        # yields the bytes [offset, offset + length) of the blob in chunks, only that range is fetched
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def stat(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        # returns { "size": int, "content_type": str, "last_modified": int, "etag": str }
+        raise NotImplementedError
+
+    # resumable uploads (app.routers.uploads), a blob is staged block by block across requests and committed at the end
+    @abc.abstractmethod
+    async def stage_block(self, blob_name: str, block_id: str, data: bytes) -> Tuple[bool, Dict[str, Any]]:
+        # staging a block id again replaces it, block ids of a blob all have the same length
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def list_blocks(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        # returns { "blocks": { block_id: size } } of the uncommitted blocks, empty when none were staged
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def commit_blocks(self, blob_name: str, block_ids: List[str], content_type: str) -> Tuple[bool, Dict[str, Any]]:
+        # the blob becomes the blocks in this order, staged blocks that are left out are discarded
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def discard_blocks(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        # drops the uncommitted blocks, and the blob if they were committed
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def move(self, src_blob_name: str, dst_blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        # replaces dst with src, within the backend (no bytes go through the app) and removes src
+        raise NotImplementedError
@@ -0,0 +1,282 @@
+# Sytem imports
+import os
+import hmac
+import uuid
+import asyncio
+import shutil
+import hashlib
+from typing import Tuple, Dict, Any, List, AsyncIterator
+from mimetypes import guess_type
+from urllib.parse import quote
+
+# FastAPI-related imports
+from fastapi import UploadFile
+from app.storage.base import BaseStorage
+from app.metrics import observe_storage, observe_storage_read
+from app import log
+
+# files are written to / read from disk in chunks of this size, only one chunk per request is held in memory
+UPLOAD_CHUNK_SIZE = int(os.getenv("LOCAL_STORAGE_CHUNK_SIZE") or 1024 * 1024)
+
+class LocalStorage(BaseStorage):
+    """
+    Stores blobs as files in one directory, for on-prem / edge deployments and load tests without a cloud account.
+
+    Playback urls point at this app (app.routers.storage) and are signed with an HMAC of the blob name and expiry.
+    """
+    name = "local"
+
+    def __init__(self):
+        self.root = os.path.abspath(os.getenv("LOCAL_STORAGE_PATH") or "storage")
+        # prefix of the signed urls, e.g. https://api.example.com, relative to the API when empty
+        self.public_url = (os.getenv("LOCAL_STORAGE_PUBLIC_URL") or "").rstrip("/")
+        self.signing_key = (os.getenv("LOCAL_STORAGE_SIGNING_KEY") or os.getenv("SECRET_KEY") or "").encode()
+        # X-Accel-Redirect (nginx) or X-Sendfile (apache, lighttpd): the proxy in front of the app sends the file with sendfile(2),
+        # ranges and conditional requests included, the app only checks the signature. unset, the app reads and streams the file itself
+        self.sendfile_header = os.getenv("LOCAL_STORAGE_SENDFILE_HEADER") or None
+        # what the header points at, an internal nginx location aliased to LOCAL_STORAGE_PATH (e.g. /_blobs/), the path of the file when empty
+        self.sendfile_prefix = (os.getenv("LOCAL_STORAGE_SENDFILE_PREFIX") or "").rstrip("/")
+
+    async def initialise(self) -> bool:
+        try:
+            if len(self.signing_key) == 0:
+                raise Exception("LOCAL_STORAGE_SIGNING_KEY (or SECRET_KEY) is not set")
+
+            await asyncio.to_thread(os.makedirs, self.root, exist_ok=True)
+            return True
+        except Exception as e:
+            log.error("Storage", "Could not initialise local storage", error=str(e))
+            return False
+
+    def path(self, blob_name: str) -> str:
+        # blob names are flat, anything that could escape the storage directory is rejected
+        if blob_name in ["", ".", ".."] or os.path.basename(blob_name) != blob_name:
+            raise Exception(f"Invalid blob name {blob_name!r}")
+
+        return os.path.join(self.root, blob_name)
+
+    def sendfile_location(self, blob_name: str) -> str:
+        if not self.sendfile_prefix:
+            return self.path(blob_name)
+
+        return f"{self.sendfile_prefix}/{quote(os.path.basename(self.path(blob_name)))}"
+
+    def blocks_path(self, blob_name: str, block_id: str = "") -> str:
+        # staged blocks are files in a hidden directory per blob, .blocks/<blob name>/<block id>
+        if block_id in [".", ".."] or os.path.basename(block_id) != block_id:
+            raise Exception(f"Invalid block id {block_id!r}")
+
+        return os.path.join(self.root, ".blocks", os.path.basename(self.path(blob_name)), block_id)
+
+    @observe_storage("upload")
+    async def upload(self, blob_name: str, file: UploadFile, content_type: str) -> Tuple[bool, Dict[str, Any]]:
+        tmp_path = None
+
+        try:
+            path = self.path(blob_name)
+            # written next to the final path and renamed once complete, readers never see a partial file
+            tmp_path = os.path.join(self.root, f".{blob_name}.{uuid.uuid4()}.part")
+            size = 0
+
+            f = await asyncio.to_thread(open, tmp_path, "wb")
+
+            try:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+                    size += len(chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+
+            await asyncio.to_thread(os.replace, tmp_path, path)
+            tmp_path = None
+
+            return True, {
+                "size": size
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                await asyncio.to_thread(os.remove, tmp_path)
+
+    def signature(self, blob_name: str, expires_at: int) -> str:
+        return hmac.new(self.signing_key, f"{blob_name}:{expires_at}".encode(), hashlib.sha256).hexdigest()
+
+    def sign_url(self, blob_name: str, expires_at: int) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            self.path(blob_name)
+
+            return True, {
+                "url": f"{self.public_url}/storage/{quote(blob_name)}?expires={expires_at}&signature={self.signature(blob_name, expires_at)}"
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    def verify_url(self, blob_name: str, expires_at: int, signature: str, now: int) -> bool:
+        if expires_at < now:
+            return False
+
+        return hmac.compare_digest(self.signature(blob_name, expires_at), signature)
+
+    @observe_storage_read
+    async def read(self, blob_name: str, offset: int, length: int) -> AsyncIterator[bytes]:
+        f = await asyncio.to_thread(open, self.path(blob_name), "rb")
+
+        try:
+            await asyncio.to_thread(f.seek, offset)
+
+            while length > 0:
+                chunk = await asyncio.to_thread(f.read, min(UPLOAD_CHUNK_SIZE, length))
+
+                if not chunk:
+                    break
+
+                length -= len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+    @observe_storage("delete")
+    async def delete(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            await asyncio.to_thread(os.remove, self.path(blob_name))
+
+            return True, {
+                "blob_name": blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("stat")
+    async def stat(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            stat = await asyncio.to_thread(os.stat, self.path(blob_name))
+
+            return True, {
+                "size": stat.st_size,
+                "content_type": guess_type(blob_name)[0] or "application/octet-stream",
+                "last_modified": int(stat.st_mtime),
+                "etag": f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("stage_block")
+    async def stage_block(self, blob_name: str, block_id: str, data: bytes) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            path = self.blocks_path(blob_name, block_id)
+            tmp_path = f"{path}.{uuid.uuid4()}.part"
+
+            def write():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+
+                # a block staged again is replaced in one step, list_blocks never sees half of it
+                os.replace(tmp_path, path)
+
+            await asyncio.to_thread(write)
+
+            return True, {
+                "block_id": block_id,
+                "size": len(data)
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("list_blocks")
+    async def list_blocks(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        def list_dir() -> Dict[str, int]:
+            path = self.blocks_path(blob_name)
+
+            if not os.path.isdir(path):
+                return {}
+
+            return {
+                entry.name: entry.stat().st_size
+                for entry in os.scandir(path) if not entry.name.endswith(".part")
+            }
+
+        try:
+            return True, {
+                "blocks": await asyncio.to_thread(list_dir)
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("commit_blocks")
+    async def commit_blocks(self, blob_name: str, block_ids: List[str], content_type: str) -> Tuple[bool, Dict[str, Any]]:
+        tmp_path = None
+
+        try:
+            path = self.path(blob_name)
+            tmp_path = os.path.join(self.root, f".{blob_name}.{uuid.uuid4()}.part")
+
+            def concatenate():
+                with open(tmp_path, "wb") as f:
+                    for block_id in block_ids:
+                        with open(self.blocks_path(blob_name, block_id), "rb") as block:
+                            shutil.copyfileobj(block, f, UPLOAD_CHUNK_SIZE)
+
+                os.replace(tmp_path, path)
+                shutil.rmtree(self.blocks_path(blob_name), ignore_errors=True)
+
+            await asyncio.to_thread(concatenate)
+            tmp_path = None
+
+            return True, {
+                "blob_name": blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                await asyncio.to_thread(os.remove, tmp_path)
+
+    @observe_storage("discard_blocks")
+    async def discard_blocks(self, blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        def remove():
+            shutil.rmtree(self.blocks_path(blob_name), ignore_errors=True)
+
+            if os.path.exists(self.path(blob_name)):
+                os.remove(self.path(blob_name))
+
+        try:
+            await asyncio.to_thread(remove)
+
+            return True, {
+                "blob_name": blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
+
+    @observe_storage("move")
+    async def move(self, src_blob_name: str, dst_blob_name: str) -> Tuple[bool, Dict[str, Any]]:
+        try:
+            # a rename, readers of dst see either the old or the new file
+            await asyncio.to_thread(os.replace, self.path(src_blob_name), self.path(dst_blob_name))
+
+            return True, {
+                "blob_name": dst_blob_name
+            }
+        except Exception as e:
+            return False, {
+                "error": str(e)
+            }
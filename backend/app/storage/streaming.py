@@ -0,0 +1,135 @@
+# Sytem imports
+import re
+from typing import Tuple, Dict, Any, Union
+from email.utils import formatdate, parsedate_to_datetime
+
+# FastAPI-related imports
+from fastapi import Request, Response, status
+from fastapi.responses import StreamingResponse
+from app.storage.base import BaseStorage
+
+# a single byte range, e.g. bytes=0-1023, bytes=1024- or bytes=-500 (the last 500 bytes)
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(
+    range_header: Union[str, None],
+    size: int
+) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Parses a Range header against a blob of the given size.
+
+    Args:
+        range_header (str): The Range header, or None.
+        size (int): The size of the blob in bytes.
+
+    Returns:
+        (bool, dict): (True, { "range": (start, end) }) with an inclusive end, or { "range": None } to send the whole blob.
+                      (False, { "error": str }) when the range cannot be satisfied.
+    """
+    if range_header is None:
+        return True, {
+            "range": None
+        }
+
+    match = RANGE_PATTERN.match(range_header.strip())
+
+    # multiple ranges or other units, these are allowed to be ignored (RFC 9110)
+    if match is None or match.group(1) == match.group(2) == "":
+        return True, {
+            "range": None
+        }
+
+    if match.group(1) == "":
+        # suffix range, the last n bytes
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) != "" else size - 1
+
+    if start >= size or start > end:
+        return False, {
+            "error": f"Range {range_header} not satisfiable for {size} bytes"
+        }
+
+    return True, {
+        "range": (start, end)
+    }
+
+def not_modified(
+    request: Request,
+    etag: str,
+    last_modified: int
+) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+
+    # If-None-Match takes precedence over If-Modified-Since
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+    if_modified_since = request.headers.get("if-modified-since")
+
+    if if_modified_since is not None:
+        try:
+            return last_modified <= int(parsedate_to_datetime(if_modified_since).timestamp())
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+def blob_response(
+    request: Request,
+    storage: BaseStorage,
+    blob_name: str,
+    size: int,
+    content_type: str,
+    etag: str,
+    last_modified: int,
+    cache_control: str = "private, no-cache"
+) -> Response:
+    """
+    Serves a blob with support for Range (206), If-Range, If-None-Match and If-Modified-Since (304).
+
+    Only the requested bytes are read from the storage backend, so a seek does not download the whole file.
+    """
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": cache_control
+    }
+
+    if not_modified(request=request, etag=etag, last_modified=last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+
+    # the client's partial copy is outdated, send the whole blob instead of the range
+    if if_range is not None and if_range.strip() != etag:
+        range_header = None
+
+    success, res = parse_range(range_header=range_header, size=size)
+
+    if not success:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={**headers, "Content-Range": f"bytes */{size}"}
+        )
+
+    if res.get("range") is None:
+        return StreamingResponse(
+            storage.read(blob_name=blob_name, offset=0, length=size),
+            status_code=status.HTTP_200_OK,
+            media_type=content_type,
+            headers={**headers, "Content-Length": str(size)}
+        )
+
+    start, end = res.get("range")
+
+    return StreamingResponse(
+        storage.read(blob_name=blob_name, offset=start, length=end - start + 1),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=content_type,
+        headers={**headers, "Content-Length": str(end - start + 1), "Content-Range": f"bytes {start}-{end}/{size}"}
+    )
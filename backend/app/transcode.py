@@ -0,0 +1,152 @@
+# Sytem imports
+import os
+import re
+import json
+import asyncio
+from typing import Tuple, Dict, Any, List
+from uuid import UUID, uuid5
+
+# FastAPI-related imports
+from app.postgres.mappings import Transcode_Job
+from app.postgres.utils import unix_timestamp
+
+# renditions made for every upload, in order of preference when a url is signed, e.g. "opus:96,aac:128"
+TRANSCODE_RENDITIONS: List[Tuple[str, int]] = [
+    (fmt.strip(), int(bitrate))
+    for fmt, bitrate in (rendition.split(":") for rendition in (os.getenv("TRANSCODE_RENDITIONS") or "opus:96,aac:128").split(","))
+]
+
+# EBU R128 loudness normalisation, -16 LUFS integrated / -1.5 dBTP is the usual target for streaming
+LOUDNESS_TARGET = float(os.getenv("TRANSCODE_LOUDNESS_TARGET") or -16)
+TRUE_PEAK_TARGET = float(os.getenv("TRANSCODE_TRUE_PEAK_TARGET") or -1.5)
+LOUDNESS_RANGE_TARGET = float(os.getenv("TRANSCODE_LOUDNESS_RANGE_TARGET") or 11)
+
+FFMPEG_PATH = os.getenv("FFMPEG_PATH") or "ffmpeg"
+
+# format -> ffmpeg encoder, ffmpeg container, content type of the rendition
+FORMATS: Dict[str, Tuple[str, str, str]] = {
+    "opus": ("libopus", "ogg", "audio/ogg"),
+    "aac": ("aac", "ipod", "audio/mp4"),
+    "mp3": ("libmp3lame", "mp3", "audio/mpeg")
+}
+
+for fmt, _ in TRANSCODE_RENDITIONS:
+    if fmt not in FORMATS:
+        raise Exception(f"Unknown rendition format {fmt!r} in TRANSCODE_RENDITIONS")
+
+def new_transcode_job() -> Transcode_Job:
+    # attached to a new Audio_File before it is inserted, Async_Postgres_DB.insert only stamps the parent
+    now = unix_timestamp()
+
+    return Transcode_Job(status="pending", attempts=0, run_at=now, created_at=now)
+
+def rendition_blob_name(source_blob_name: UUID, fmt: str, bitrate: int) -> UUID:
+    # derived from the source, a retried job overwrites the blob of its previous attempt instead of leaking a new one
+    return uuid5(source_blob_name, f"{fmt}:{bitrate}")
+
+def rendition_rank(fmt: str, bitrate: int) -> int:
+    # lower is better, renditions that are no longer configured come last
+    try:
+        return TRANSCODE_RENDITIONS.index((fmt, bitrate))
+    except ValueError:
+        return len(TRANSCODE_RENDITIONS)
+
+async def run_ffmpeg(*args: str) -> Tuple[bool, Dict[str, Any]]:
+    # runs in its own process, the event loop only waits on the pipe
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-hide_banner", "-nostdin", "-y", *args,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    stderr = stderr.decode(errors="replace")
+
+    if process.returncode != 0:
+        return False, {
+            "error": f"ffmpeg exited with {process.returncode}: {stderr[-500:]}"
+        }
+
+    return True, {
+        "stderr": stderr
+    }
+
+async def measure_loudness(path: str) -> Tuple[bool, Dict[str, Any]]:
+    """
+    First pass of the loudnorm filter, measures the integrated loudness, true peak and loudness range of a file.
+
+    Args:
+        path (str): Path of the source file.
+
+    Returns:
+        (bool, dict): (True, { "measured": dict }) with the values printed by loudnorm, or (False, { "error": str }).
+    """
+    success, res = await run_ffmpeg(
+        "-i", path,
+        "-af", f"loudnorm=I={LOUDNESS_TARGET}:TP={TRUE_PEAK_TARGET}:LRA={LOUDNESS_RANGE_TARGET}:print_format=json",
+        "-f", "null", "-"
+    )
+
+    if not success:
+        return False, res
+
+    # loudnorm prints its measurement as a json block to stderr, between ffmpeg's own log lines
+    blocks = re.findall(r"\{[^{}]*\"input_i\"[^{}]*\}", res.get("stderr"))
+
+    if len(blocks) == 0:
+        return False, {
+            "error": "Could not read the loudness measurement"
+        }
+
+    measured = json.loads(blocks[-1])
+
+    # silence measures as -inf, it cannot be normalised
+    if measured.get("input_i") in ["-inf", "inf"]:
+        return True, {
+            "measured": None
+        }
+
+    return True, {
+        "measured": measured
+    }
+
+async def encode(
+    path: str,
+    out_path: str,
+    fmt: str,
+    bitrate: int,
+    measured: Dict[str, Any]
+) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Second pass, normalises the source to the loudness target and encodes it as one rendition.
+
+    Args:
+        path (str): Path of the source file.
+        out_path (str): Path the rendition is written to.
+        fmt (str): Key of FORMATS.
+        bitrate (int): Target bitrate in kbit/s.
+        measured (dict): Output of measure_loudness, or None to encode without normalising.
+
+    Returns:
+        (bool, dict): (True, { "stderr": str }) or (False, { "error": str }).
+    """
+    codec, container, _ = FORMATS.get(fmt)
+    filters = []
+
+    if measured is not None:
+        # linear normalisation with the first pass values, a constant gain instead of dynamic compression
+        filters.append(
+            f"loudnorm=I={LOUDNESS_TARGET}:TP={TRUE_PEAK_TARGET}:LRA={LOUDNESS_RANGE_TARGET}"
+            f":measured_I={measured.get('input_i')}:measured_TP={measured.get('input_tp')}"
+            f":measured_LRA={measured.get('input_lra')}:measured_thresh={measured.get('input_thresh')}"
+            f":offset={measured.get('target_offset')}:linear=true"
+        )
+
+    return await run_ffmpeg(
+        "-i", path,
+        "-vn", "-map_metadata", "-1",
+        *(["-af", ",".join(filters)] if len(filters) > 0 else []),
+        # loudnorm resamples to 192 kHz internally, 48 kHz is what opus / aac are encoded at
+        "-ar", "48000",
+        "-c:a", codec, "-b:a", f"{bitrate}k",
+        "-f", container, out_path
+    )
@@ -0,0 +1,200 @@
+# Sytem imports
+import os
+import struct
+import asyncio
+from typing import Tuple, Dict, Any, List
+
+# waveform-related imports
+import numpy as np
+from app.transcode import FFMPEG_PATH
+
+# zoom levels, in frames per (min, max) peak, each one a multiple of the first so that they are all reduced from it
+WAVEFORM_SAMPLES_PER_PEAK: List[int] = sorted(int(level) for level in (os.getenv("WAVEFORM_SAMPLES_PER_PEAK") or "512,4096,32768").split(","))
+
+for level in WAVEFORM_SAMPLES_PER_PEAK:
+    if level % WAVEFORM_SAMPLES_PER_PEAK[0] != 0:
+        raise Exception(f"WAVEFORM_SAMPLES_PER_PEAK {level} is not a multiple of {WAVEFORM_SAMPLES_PER_PEAK[0]}")
+
+# decoded pcm is read from ffmpeg in chunks of this size, only one chunk is held in memory
+DECODE_CHUNK_SIZE = 1024 * 1024
+# of ffmpeg's log, the end is kept for the error message
+STDERR_TAIL_SIZE = 4096
+
+class PeakAccumulator:
+    """
+    Min / max of every block of samples_per_peak frames, fed with 16 bit pcm as it is decoded.
+
+    Channels are merged, a peak is the min / max over all channels of its block.
+
+    Args:
+        channels (int): Interleaved channels of the pcm.
+        samples_per_peak (int): Frames per peak.
+    """
+    def __init__(self, channels: int, samples_per_peak: int):
+        self.channels = channels
+        self.block_size = channels * samples_per_peak
+        self.pending = np.empty(0, dtype=np.int16)
+        self.mins: List[np.ndarray] = []
+        self.maxs: List[np.ndarray] = []
+        self.samples = 0
+
+    def feed(self, samples: np.ndarray):
+        self.samples += len(samples)
+
+        if len(self.pending) > 0:
+            samples = np.concatenate([self.pending, samples])
+
+        # one vectorised min / max over all the complete blocks of the chunk
+        blocks = len(samples) // self.block_size
+
+        if blocks > 0:
+            samples_in_blocks = samples[:blocks * self.block_size].reshape(blocks, self.block_size)
+            self.mins.append(samples_in_blocks.min(axis=1))
+            self.maxs.append(samples_in_blocks.max(axis=1))
+
+        # copied, so that the chunk it was sliced from can be freed
+        self.pending = samples[blocks * self.block_size:].copy()
+
+    def finish(self) -> np.ndarray:
+        # the last, partial block
+        if len(self.pending) > 0:
+            self.mins.append(self.pending.min(keepdims=True))
+            self.maxs.append(self.pending.max(keepdims=True))
+            self.pending = np.empty(0, dtype=np.int16)
+
+        if len(self.mins) == 0:
+            return np.empty((0, 2), dtype=np.int16)
+
+        return np.stack([np.concatenate(self.mins), np.concatenate(self.maxs)], axis=1)
+
+    @property
+    def frames(self) -> int:
+        return self.samples // self.channels
+
+def downsample_peaks(peaks: np.ndarray, factor: int) -> np.ndarray:
+    # merges every factor peaks into one, the last group is padded with values that do not change its min / max
+    length = -(-len(peaks) // factor)
+    padding = length * factor - len(peaks)
+
+    mins = np.pad(peaks[:, 0], (0, padding), constant_values=np.iinfo(np.int16).max).reshape(length, factor).min(axis=1)
+    maxs = np.pad(peaks[:, 1], (0, padding), constant_values=np.iinfo(np.int16).min).reshape(length, factor).max(axis=1)
+
+    return np.stack([mins, maxs], axis=1)
+
+def encode_peaks(peaks: np.ndarray) -> bytes:
+    # little-endian int16 min, max pairs, the layout of audiowaveform's .dat files
+    return peaks.astype("<i2").tobytes()
+
+def decode_peaks(data: bytes, bits: int = 16) -> np.ndarray:
+    peaks = np.frombuffer(data, dtype="<i2")
+
+    # 8 bit peaks are half the size and are enough for drawing
+    if bits == 8:
+        return (peaks >> 8).astype(np.int8)
+
+    return peaks
+
+async def read_wav_header(stream: asyncio.StreamReader) -> Tuple[int, int]:
+    # RIFF chunks up to the start of the data chunk, returns (channels, sample_rate)
+    riff = await stream.readexactly(12)
+
+    if riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+        raise Exception("ffmpeg did not write a wav stream")
+
+    channels = sample_rate = None
+
+    while True:
+        chunk_id, chunk_size = struct.unpack("<4sI", await stream.readexactly(8))
+
+        if chunk_id == b"data":
+            break
+
+        # chunks are padded to an even size
+        chunk = await stream.readexactly(chunk_size + chunk_size % 2)
+
+        if chunk_id == b"fmt ":
+            _, channels, sample_rate = struct.unpack("<HHI", chunk[:8])
+
+    if channels is None or channels == 0:
+        raise Exception("ffmpeg did not write a fmt chunk")
+
+    return channels, sample_rate
+
+async def read_tail(stream: asyncio.StreamReader) -> str:
+    # reads the stream to its end, keeping only the last STDERR_TAIL_SIZE bytes
+    tail = b""
+
+    while chunk := await stream.read(DECODE_CHUNK_SIZE):
+        tail = (tail + chunk)[-STDERR_TAIL_SIZE:]
+
+    return tail.decode(errors="replace")
+
+async def compute_waveform(path: str) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Decodes a file once, streaming, and computes its peaks at every level of WAVEFORM_SAMPLES_PER_PEAK.
+
+    Args:
+        path (str): Path of the source file, any format ffmpeg can decode.
+
+    Returns:
+        (bool, dict): (True, { "duration": float, "sample_rate": int, "channels": int, "peaks": { samples_per_peak: np.ndarray } }),
+                      with (n, 2) int16 arrays of (min, max) peaks, or (False, { "error": str }).
+    """
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-hide_banner", "-nostdin", "-loglevel", "error",
+        "-i", path,
+        "-vn", "-map_metadata", "-1",
+        "-c:a", "pcm_s16le", "-f", "wav", "-",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # drained while stdout is read, ffmpeg blocks once it has written a pipe buffer of warnings (e.g., for damaged input)
+    stderr_tail = asyncio.create_task(read_tail(process.stderr))
+
+    try:
+        channels, sample_rate = await read_wav_header(process.stdout)
+        accumulator = PeakAccumulator(channels=channels, samples_per_peak=WAVEFORM_SAMPLES_PER_PEAK[0])
+        # a chunk can end in the middle of a sample
+        carry = b""
+
+        while chunk := await process.stdout.read(DECODE_CHUNK_SIZE):
+            chunk = carry + chunk
+            usable = len(chunk) - len(chunk) % 2
+            carry = chunk[usable:]
+
+            accumulator.feed(np.frombuffer(chunk[:usable], dtype="<i2"))
+
+        stderr = await stderr_tail
+        await process.wait()
+
+        if process.returncode != 0:
+            raise Exception(f"ffmpeg exited with {process.returncode}: {stderr[-500:]}")
+
+        finest = accumulator.finish()
+
+        return True, {
+            "duration": accumulator.frames / sample_rate,
+            "sample_rate": sample_rate,
+            "channels": channels,
+            "peaks": {
+                level: finest if level == WAVEFORM_SAMPLES_PER_PEAK[0] else downsample_peaks(finest, level // WAVEFORM_SAMPLES_PER_PEAK[0])
+                for level in WAVEFORM_SAMPLES_PER_PEAK
+            }
+        }
+    except Exception as e:
+        # e.g., an IncompleteReadError of the header, the reason is in ffmpeg's log
+        if process.returncode is None:
+            process.kill()
+
+        stderr = await stderr_tail
+        await process.wait()
+
+        return False, {
+            "error": f"{e} {stderr[-500:]}".strip()
+        }
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+        stderr_tail.cancel()
@@ -0,0 +1,442 @@
+# Sytem imports
+import os
+import signal
+import random
+import asyncio
+import tempfile
+from typing import Union, Tuple, Dict, Any
+
+# FastAPI-related imports
+from fastapi import UploadFile
+from app.dependencies import async_session, initialise_storage, dispose_storage, dispose_db, get_storage
+from app.postgres.async_postgres_db import Async_Postgres_DB
+from app.postgres.mappings import Audio_File, Audio_Rendition, Audio_Waveform, Transcode_Job
+from app.postgres.utils import unix_timestamp
+from app.storage.base import blob_object_name
+from app.transcode import TRANSCODE_RENDITIONS, FORMATS, LOUDNESS_TARGET, rendition_blob_name, measure_loudness, encode
+from app.waveform import compute_waveform, encode_peaks
+from app.dedup import claim_unreferenced_blob, forget_blob, postpone_blob
+from app.resumable import upload_blob_name, claim_expired_upload
+from app import log
+
+# SQLAlchemy-related imports
+from sqlalchemy import select, update, or_, and_, Row
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# jobs run at the same time in this process, each one is an ffmpeg process so this is bounded by the cpu count
+TRANSCODE_WORKER_CONCURRENCY = int(os.getenv("TRANSCODE_WORKER_CONCURRENCY") or os.cpu_count() or 1)
+# seconds between polls of an empty queue
+TRANSCODE_POLL_INTERVAL = float(os.getenv("TRANSCODE_POLL_INTERVAL") or 5)
+# a job whose worker has not finished it within the lease is picked up by another worker
+TRANSCODE_LEASE_SECONDS = int(os.getenv("TRANSCODE_LEASE_SECONDS") or 900)
+TRANSCODE_MAX_ATTEMPTS = int(os.getenv("TRANSCODE_MAX_ATTEMPTS") or 5)
+TRANSCODE_BACKOFF_BASE = float(os.getenv("TRANSCODE_BACKOFF_BASE") or 30)
+TRANSCODE_BACKOFF_MAX = float(os.getenv("TRANSCODE_BACKOFF_MAX") or 3600)
+# seconds between sweeps of unreferenced (deduplicated) blobs and of abandoned resumable uploads
+BLOB_SWEEP_INTERVAL = float(os.getenv("BLOB_SWEEP_INTERVAL") or 300)
+
+async def claim_job(session: AsyncSession) -> Union[Row, None]:
+    # FOR UPDATE SKIP LOCKED, concurrent workers each claim a different job without waiting on each other
+    now = unix_timestamp()
+
+    candidate = select(Transcode_Job.id).where(
+        or_(
+            and_(Transcode_Job.status == "pending", Transcode_Job.run_at <= now),
+            # the worker holding the lease died
+            and_(Transcode_Job.status == "running", Transcode_Job.locked_until < now)
+        )
+    ).order_by(Transcode_Job.run_at).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+
+    statement = update(Transcode_Job).where(
+        Transcode_Job.id == candidate
+    ).values(
+        status="running",
+        attempts=Transcode_Job.attempts + 1,
+        locked_until=now + TRANSCODE_LEASE_SECONDS,
+        updated_at=now
+    ).returning(
+        Transcode_Job.id,
+        Transcode_Job.audio_file_id,
+        Transcode_Job.attempts
+    )
+
+    job = (await session.execute(statement)).one_or_none()
+    await session.commit()
+
+    return job
+
+async def finish_job(session: AsyncSession, job: Row, error: Union[str, None] = None):
+    now = unix_timestamp()
+    values: Dict[str, Any] = {"locked_until": None, "updated_at": now, "error": error}
+
+    if error is None:
+        values["status"] = "done"
+    elif job.attempts >= TRANSCODE_MAX_ATTEMPTS:
+        values["status"] = "failed"
+    else:
+        # full jitter, so that jobs failing together (e.g., storage outage) are not all retried at once
+        values["status"] = "pending"
+        values["run_at"] = now + int(random.uniform(0, min(TRANSCODE_BACKOFF_MAX, TRANSCODE_BACKOFF_BASE * 2 ** (job.attempts - 1))))
+
+    # only while the lease is still ours, another worker may have taken over an expired one
+    await session.execute(
+        update(Transcode_Job).where(
+            Transcode_Job.id == job.id,
+            Transcode_Job.attempts == job.attempts
+        ).values(**values)
+    )
+    await session.commit()
+
+async def download(blob_name: str, path: str) -> Tuple[bool, Dict[str, Any]]:
+    success, res = await get_storage().stat(blob_name)
+
+    if not success:
+        return False, res
+
+    try:
+        with open(path, "wb") as f:
+            async for chunk in get_storage().read(blob_name=blob_name, offset=0, length=res.get("size")):
+                await asyncio.to_thread(f.write, chunk)
+
+        return True, {
+            "size": res.get("size")
+        }
+    except Exception as e:
+        return False, {
+            "error": str(e)
+        }
+
+async def reuse_processed(session: AsyncSession, audio_file: Audio_File):
+    # another audio file shares the (deduplicated) blob and has been processed, its results are copied instead of decoding it again
+    other_id = (await session.execute(
+        select(Audio_File.id).where(
+            Audio_File.blob_name == audio_file.blob_name,
+            Audio_File.id != audio_file.id,
+            Audio_File.duration.is_not(None)
+        ).limit(1)
+    )).scalar_one_or_none()
+
+    if other_id is None:
+        return
+
+    now = unix_timestamp()
+
+    success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_Rendition, value=other_id, col_name="audio_file_id")
+
+    if not success:
+        return
+
+    # rendition blobs are named after the source blob, so the copies point at the same blobs
+    for rendition in res.get("objs"):
+        await session.execute(
+            insert(Audio_Rendition).values(
+                audio_file_id=audio_file.id,
+                format=rendition.format,
+                bitrate=rendition.bitrate,
+                blob_name=rendition.blob_name,
+                content_type=rendition.content_type,
+                size=rendition.size,
+                loudness_target=rendition.loudness_target,
+                source_loudness=rendition.source_loudness,
+                created_at=now
+            ).on_conflict_do_nothing(index_elements=["audio_file_id", "format", "bitrate"])
+        )
+
+    waveforms = (await session.execute(
+        select(Audio_Waveform.samples_per_peak, Audio_Waveform.length, Audio_Waveform.peaks).where(Audio_Waveform.audio_file_id == other_id)
+    )).all()
+
+    for waveform in waveforms:
+        await session.execute(
+            insert(Audio_Waveform).values(
+                audio_file_id=audio_file.id,
+                samples_per_peak=waveform.samples_per_peak,
+                length=waveform.length,
+                peaks=waveform.peaks,
+                created_at=now
+            ).on_conflict_do_nothing(index_elements=["audio_file_id", "samples_per_peak"])
+        )
+
+    other = (await session.execute(
+        select(Audio_File.duration, Audio_File.sample_rate, Audio_File.channels).where(Audio_File.id == other_id)
+    )).one()
+
+    await session.execute(
+        update(Audio_File).where(
+            Audio_File.id == audio_file.id
+        ).values(
+            duration=other.duration,
+            sample_rate=other.sample_rate,
+            channels=other.channels
+        )
+    )
+    await session.commit()
+
+    audio_file.duration = other.duration
+    log.info("Worker", "Reused the renditions and waveform of another audio file", audio_file_id=str(audio_file.id), source_audio_file_id=str(other_id))
+
+async def transcode(session: AsyncSession, audio_file: Audio_File) -> Tuple[bool, Dict[str, Any]]:
+    await reuse_processed(session=session, audio_file=audio_file)
+
+    # renditions that a previous attempt already finished are not made again
+    success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_Rendition, value=audio_file.id, col_name="audio_file_id")
+
+    if not success:
+        return False, res
+
+    existing = {(rendition.format, rendition.bitrate) for rendition in res.get("objs")}
+    missing = [rendition for rendition in TRANSCODE_RENDITIONS if rendition not in existing]
+    # the duration is written together with the peaks
+    missing_waveform = audio_file.duration is None
+
+    if len(missing) == 0 and not missing_waveform:
+        return True, {}
+
+    with tempfile.TemporaryDirectory(prefix="transcode-") as tmp_dir:
+        source_path = os.path.join(tmp_dir, "source")
+
+        success, res = await download(blob_name=blob_object_name(str(audio_file.blob_name), audio_file.content_type), path=source_path)
+
+        if not success:
+            return False, res
+
+        source_size = res.get("size")
+
+        if missing_waveform:
+            success, res = await compute_waveform(source_path)
+
+            if not success:
+                return False, res
+
+            await store_waveform(session=session, audio_file=audio_file, waveform=res)
+
+        success, res = await measure_loudness(source_path)
+
+        if not success:
+            return False, res
+
+        measured = res.get("measured")
+
+        for fmt, bitrate in missing:
+            _, _, content_type = FORMATS.get(fmt)
+            blob_name = rendition_blob_name(audio_file.blob_name, fmt, bitrate)
+            out_path = os.path.join(tmp_dir, f"{fmt}-{bitrate}")
+
+            success, res = await encode(path=source_path, out_path=out_path, fmt=fmt, bitrate=bitrate, measured=measured)
+
+            if not success:
+                return False, res
+
+            size = os.path.getsize(out_path)
+
+            # the upload is already compact (e.g., a low bitrate mp3), a bigger copy would only cost egress
+            if size >= source_size:
+                log.info("Worker", "Skipped a rendition bigger than the upload", audio_file_id=str(audio_file.id), rendition=f"{fmt}:{bitrate}", size=size, source_size=source_size)
+                continue
+
+            with open(out_path, "rb") as f:
+                success, res = await get_storage().upload(
+                    blob_name=blob_object_name(str(blob_name), content_type),
+                    file=UploadFile(file=f, size=size),
+                    content_type=content_type
+                )
+
+            if not success:
+                return False, res
+
+            # committed one by one, a retry after a later failure keeps the renditions made so far
+            await session.execute(
+                insert(Audio_Rendition).values(
+                    audio_file_id=audio_file.id,
+                    format=fmt,
+                    bitrate=bitrate,
+                    blob_name=blob_name,
+                    content_type=content_type,
+                    size=size,
+                    loudness_target=LOUDNESS_TARGET,
+                    source_loudness=None if measured is None else float(measured.get("input_i")),
+                    created_at=unix_timestamp()
+                ).on_conflict_do_nothing(index_elements=["audio_file_id", "format", "bitrate"])
+            )
+            await session.commit()
+
+    return True, {}
+
+async def store_waveform(session: AsyncSession, audio_file: Audio_File, waveform: Dict[str, Any]):
+    now = unix_timestamp()
+
+    for samples_per_peak, peaks in waveform.get("peaks").items():
+        statement = insert(Audio_Waveform).values(
+            audio_file_id=audio_file.id,
+            samples_per_peak=samples_per_peak,
+            length=len(peaks),
+            peaks=encode_peaks(peaks),
+            created_at=now
+        )
+
+        # a retry replaces the peaks of an earlier attempt
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=["audio_file_id", "samples_per_peak"],
+            set_={"length": statement.excluded.length, "peaks": statement.excluded.peaks, "updated_at": now}
+        ))
+
+    await session.execute(
+        update(Audio_File).where(
+            Audio_File.id == audio_file.id
+        ).values(
+            duration=waveform.get("duration"),
+            sample_rate=waveform.get("sample_rate"),
+            channels=waveform.get("channels")
+        )
+    )
+    await session.commit()
+
+async def run_job(job: Row):
+    async with async_session() as session:
+        try:
+            if job.attempts > TRANSCODE_MAX_ATTEMPTS:
+                raise Exception(f"Lease expired {job.attempts - 1} times")
+
+            success, res = await Async_Postgres_DB.retrieve(session=session, tbl=Audio_File, value=job.audio_file_id, col_name="id")
+
+            if not success:
+                raise Exception(res.get("error"))
+
+            audio_file = res.get("objs")[0] if len(res.get("objs")) > 0 else None
+
+            # deleted while the job was queued, nothing left to do
+            if audio_file is not None and audio_file.deleted_at is None:
+                success, res = await transcode(session=session, audio_file=audio_file)
+
+                if not success:
+                    raise Exception(res.get("error"))
+
+            await finish_job(session=session, job=job)
+            log.info("Worker", "Transcoded", audio_file_id=str(job.audio_file_id), attempt=job.attempts)
+        except Exception as e:
+            log.error("Worker", "Failed to transcode", audio_file_id=str(job.audio_file_id), attempt=job.attempts, error=str(e))
+            await session.rollback()
+            await finish_job(session=session, job=job, error=str(e))
+
+async def sweep_blobs():
+    # deletes blobs that no audio file has pointed at for BLOB_SWEEP_GRACE_SECONDS, one row lock at a time
+    while True:
+        async with async_session() as session:
+            blob = await claim_unreferenced_blob(session)
+
+            if blob is None:
+                return
+
+            content_type = blob.content_type
+            # the source and the renditions made from it (app.transcode.rendition_blob_name)
+            blob_names = [blob_object_name(str(blob.blob_name), content_type)] + [
+                blob_object_name(str(rendition_blob_name(blob.blob_name, fmt, bitrate)), FORMATS.get(fmt)[2])
+                for fmt, bitrate in TRANSCODE_RENDITIONS
+            ]
+
+            error = None
+
+            for blob_name in blob_names:
+                success, res = await get_storage().delete(blob_name)
+
+                # only fine when the blob is not there, e.g., a rendition that was never made
+                if not success and (await get_storage().stat(blob_name))[0]:
+                    error = res.get("error")
+                    break
+
+            if error is not None:
+                # the row is kept for another attempt, the next one is claimed instead of this one again
+                log.error("Worker", "Failed to delete unreferenced blob", blob_name=str(blob.blob_name), error=error)
+                await postpone_blob(session=session, blob_name=blob.blob_name)
+                await session.commit()
+                continue
+
+            await forget_blob(session=session, blob_name=blob.blob_name)
+            await session.commit()
+            log.info("Worker", "Deleted unreferenced blob", blob_name=str(blob.blob_name))
+
+async def sweep_uploads():
+    # deletes the staged blocks and the session of resumable uploads that have had no chunk for RESUMABLE_UPLOAD_TTL_SECONDS
+    while True:
+        async with async_session() as session:
+            upload = await claim_expired_upload(session)
+
+            if upload is None:
+                return
+
+            success, res = await get_storage().discard_blocks(upload_blob_name(upload.id))
+
+            if not success:
+                raise Exception(res.get("error"))
+
+            await session.delete(upload)
+            await session.commit()
+            log.info("Worker", "Deleted abandoned upload", upload_id=str(upload.id), offset=upload.offset, size=upload.size)
+
+async def run_sweeper(stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            await sweep_blobs()
+        except Exception as e:
+            log.error("Worker", "Could not sweep unreferenced blobs", error=str(e))
+
+        try:
+            await sweep_uploads()
+        except Exception as e:
+            log.error("Worker", "Could not sweep abandoned uploads", error=str(e))
+
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=BLOB_SWEEP_INTERVAL)
+        except TimeoutError:
+            pass
+
+async def run_worker(stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            async with async_session() as session:
+                job = await claim_job(session)
+        except Exception as e:
+            log.error("Worker", "Could not claim a job", error=str(e))
+            job = None
+
+        if job is None:
+            # the queue is empty, sleep until the next poll or until asked to stop
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=TRANSCODE_POLL_INTERVAL)
+            except TimeoutError:
+                pass
+            continue
+
+        try:
+            await run_job(job)
+        except Exception as e:
+            # the job could not be marked as finished, its lease expires and it is picked up again
+            log.error("Worker", "Could not finish job", job_id=str(job.id), error=str(e))
+
+async def main():
+    await initialise_storage()
+
+    # SIGTERM / SIGINT stop claiming new jobs, the ones in progress are finished first
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(sig, stopping.set)
+
+    log.info("Worker", "Started", concurrency=TRANSCODE_WORKER_CONCURRENCY)
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(TRANSCODE_WORKER_CONCURRENCY):
+                tg.create_task(run_worker(stopping))
+
+            tg.create_task(run_sweeper(stopping))
+    finally:
+        await dispose_storage()
+        await dispose_db()
+        log.info("Worker", "Stopped")
+
+if __name__ == "__main__":
+    # python -m app.worker
+    asyncio.run(main())
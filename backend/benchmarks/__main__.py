@@ -0,0 +1,320 @@
+# Sytem imports
+import os
+import sys
+import json
+import shutil
+import asyncio
+import secrets
+import argparse
+import statistics
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Union
+
+# benchmark-related imports
+import httpx
+import benchmarks
+from benchmarks.environment import ThrowawayPostgres, AppServer, BACKEND_DIR
+from benchmarks.load import scrape_pool_checkouts, pool_checkout_summary
+from benchmarks.scenarios import SCENARIOS, Scenario_Context
+from benchmarks.seed import seed
+from benchmarks.plans import explain_queries
+
+def git_commit() -> Union[str, None]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def app_environment(work_dir: str, bcrypt_rounds: int) -> Dict[str, str]:
+    return {
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_PATH": os.path.join(work_dir, "storage"),
+        "SECRET_KEY": secrets.token_hex(32),
+        "JWT_SIGNING_ALGORITHM": "HS256",
+        "BCRYPT_ROUNDS": str(bcrypt_rounds),
+        # the access log of every request would otherwise be part of what is measured
+        "LOG_SAMPLE_RATE": os.getenv("LOG_SAMPLE_RATE") or "0.01"
+    }
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    scenarios = args.scenarios.split(",") if args.scenarios else list(SCENARIOS.keys())
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+
+    if len(unknown) > 0:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}, available: {', '.join(SCENARIOS.keys())}")
+
+    # the run order of SCENARIOS, so that the write scenarios never run before the read ones
+    scenarios = [name for name in SCENARIOS if name in scenarios]
+
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    bcrypt_rounds = int(os.getenv("BCRYPT_ROUNDS") or 12)
+    app_env = app_environment(work_dir=work_dir, bcrypt_rounds=bcrypt_rounds)
+
+    postgres = ThrowawayPostgres(admin_url=os.getenv("BENCH_POSTGRES_URL"))
+    server: Union[AppServer, None] = None
+    results: Dict[str, Any] = {
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "users": args.users,
+            "audio_files": args.audio_files,
+            "bcrypt_rounds": bcrypt_rounds,
+            "workers": args.workers,
+            "cpu_count": os.cpu_count()
+        },
+        "scenarios": {}
+    }
+
+    try:
+        postgres_env = await postgres.start()
+        results["config"]["postgres"] = postgres.mode
+
+        print(f"Seeding {args.users} users and {args.audio_files} audio files", file=sys.stderr)
+        results["seed"] = await seed(
+            database_url=postgres.url,
+            storage_path=app_env.get("LOCAL_STORAGE_PATH"),
+            users=args.users,
+            audio_files=args.audio_files,
+            bcrypt_rounds=bcrypt_rounds
+        )
+
+        server = AppServer(env={**postgres_env, **app_env}, log_path=os.path.join(work_dir, "app.log"), workers=args.workers)
+        await server.start()
+
+        context = Scenario_Context(
+            base_url=server.base_url,
+            users=args.users,
+            audio_files=args.audio_files,
+            secret_key=app_env.get("SECRET_KEY"),
+            algorithm=app_env.get("JWT_SIGNING_ALGORITHM")
+        )
+
+        for name in scenarios:
+            scenario, requests, concurrency = SCENARIOS.get(name)
+            print(f"Running {name}", file=sys.stderr)
+
+            server.reset_peak_rss()
+            checkouts = await scrape_pool_checkouts(server.metrics_url)
+            result = await scenario(context, args.requests or requests, args.concurrency or concurrency)
+            result["peak_rss_bytes"] = server.peak_rss()
+            result["pool_checkout"] = pool_checkout_summary(checkouts, await scrape_pool_checkouts(server.metrics_url))
+
+            results["scenarios"][name] = result
+            print(f"  {format_result(result)}", file=sys.stderr)
+
+        results["plans"] = await explain_queries(database_url=postgres.url, users=args.users, audio_files=args.audio_files)
+    finally:
+        if server is not None:
+            server.stop()
+
+            if args.keep_app_log:
+                shutil.copy(os.path.join(work_dir, "app.log"), args.keep_app_log)
+
+        await postgres.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+async def startup(args: argparse.Namespace) -> Dict[str, Any]:
+    # cold starts against an already migrated and seeded database, from exec to the first authenticated request that reads from postgres
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    bcrypt_rounds = int(os.getenv("BCRYPT_ROUNDS") or 12)
+    app_env = app_environment(work_dir=work_dir, bcrypt_rounds=bcrypt_rounds)
+
+    postgres = ThrowawayPostgres(admin_url=os.getenv("BENCH_POSTGRES_URL"))
+    results: Dict[str, Any] = {
+        "commit": git_commit(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "users": args.users,
+            "audio_files": args.audio_files,
+            "runs": args.runs,
+            "workers": args.workers,
+            "cpu_count": os.cpu_count()
+        },
+        "startup": {}
+    }
+
+    try:
+        postgres_env = await postgres.start()
+        results["config"]["postgres"] = postgres.mode
+        results["seed"] = await seed(
+            database_url=postgres.url,
+            storage_path=app_env.get("LOCAL_STORAGE_PATH"),
+            users=args.users,
+            audio_files=args.audio_files,
+            bcrypt_rounds=bcrypt_rounds
+        )
+
+        context = Scenario_Context(
+            base_url=None,
+            users=args.users,
+            audio_files=args.audio_files,
+            secret_key=app_env.get("SECRET_KEY"),
+            algorithm=app_env.get("JWT_SIGNING_ALGORITHM")
+        )
+
+        async def probe(client: httpx.AsyncClient) -> bool:
+            return (await client.get("/audio_files/", params={"limit": 1}, headers=context.headers(1))).status_code == 200
+
+        # a single uvicorn process, and the production entry point when --workers is given
+        for mode, workers in [("uvicorn", None)] + ([("app.server", args.workers)] if args.workers else []):
+            samples = []
+
+            for _ in range(args.runs):
+                server = AppServer(env={**postgres_env, **app_env}, log_path=os.path.join(work_dir, "app.log"), workers=workers)
+
+                try:
+                    samples.append(await server.start(probe=probe))
+                finally:
+                    server.stop()
+
+            results["startup"][mode] = {
+                "median_s": round(statistics.median(samples), 3),
+                "min_s": round(min(samples), 3),
+                "max_s": round(max(samples), 3),
+                "samples_s": [round(sample, 3) for sample in samples]
+            }
+            print(f"{mode}: median {results['startup'][mode]['median_s']} s to the first request", file=sys.stderr)
+    finally:
+        await postgres.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+def format_result(result: Dict[str, Any]) -> str:
+    latency = result.get("latency_ms") or {}
+    peak_rss = result.get("peak_rss_bytes")
+    line = (
+        f"{result.get('throughput_rps')} req/s, p50 {latency.get('p50')} ms, p95 {latency.get('p95')} ms, p99 {latency.get('p99')} ms, "
+        f"errors {sum(result.get('errors', {}).values())}"
+    )
+
+    if result.get("error_rate"):
+        successful = result.get("successful")
+        line += (
+            f" ({result.get('error_rate') * 100:.1f}%, successful only {successful.get('throughput_rps')} req/s, "
+            f"p50 {(successful.get('latency_ms') or {}).get('p50')} ms, p99 {(successful.get('latency_ms') or {}).get('p99')} ms)"
+        )
+
+    line += f", peak rss {'-' if peak_rss is None else f'{peak_rss / 1024 / 1024:.0f} MiB'}"
+
+    if "pool_checkout" in result:
+        line += f", checkout stalls {result.get('pool_checkout').get('stalls')}, checkout timeouts {result.get('pool_checkout').get('timeouts')}"
+
+    if "upload_mb_per_s" in result:
+        line += f", {result.get('upload_mb_per_s')} MB/s"
+
+    return line
+
+def percent_change(before: Union[float, None], after: Union[float, None]) -> str:
+    if before is None or after is None or before == 0:
+        return "-"
+
+    return f"{(after - before) / before * 100:+.1f}%"
+
+# above this share of errors a scenario's throughput and latency mostly measure the errors, compare warns about it
+COMPARE_MAX_ERROR_RATE = float(os.getenv("BENCH_COMPARE_MAX_ERROR_RATE") or 0.02)
+
+def compare(baseline: Dict[str, Any], candidate: Dict[str, Any]) -> List[str]:
+    # higher throughput is better, lower latency / rss is better, of successful requests where the reports have them
+    lines = [f"baseline {baseline.get('commit')}, candidate {candidate.get('commit')}"]
+
+    if baseline.get("config", {}).get("audio_files") != candidate.get("config", {}).get("audio_files"):
+        lines.append("warning: the runs were seeded with a different number of audio files")
+
+    lines.append(f"{'scenario':<20} {'throughput':>11} {'p50':>9} {'p95':>9} {'p99':>9} {'peak rss':>9}")
+    warnings: List[str] = []
+
+    for name, before in baseline.get("scenarios", {}).items():
+        after = candidate.get("scenarios", {}).get(name)
+
+        if after is None:
+            continue
+
+        for side, result in [("baseline", before), ("candidate", after)]:
+            error_rate = result.get("error_rate", sum(result.get("errors", {}).values()) / (result.get("requests") or 1))
+
+            if error_rate > COMPARE_MAX_ERROR_RATE:
+                warnings.append(f"warning: {name} failed {error_rate * 100:.1f}% of its requests in the {side}, {result.get('errors')}")
+
+        # reports written before successful-only figures were added have the totals only
+        before, after = {**before, **(before.get("successful") or {})}, {**after, **(after.get("successful") or {})}
+        before_latency = before.get("latency_ms") or {}
+        after_latency = after.get("latency_ms") or {}
+
+        lines.append(
+            f"{name:<20} "
+            f"{percent_change(before.get('throughput_rps'), after.get('throughput_rps')):>11} "
+            f"{percent_change(before_latency.get('p50'), after_latency.get('p50')):>9} "
+            f"{percent_change(before_latency.get('p95'), after_latency.get('p95')):>9} "
+            f"{percent_change(before_latency.get('p99'), after_latency.get('p99')):>9} "
+            f"{percent_change(before.get('peak_rss_bytes'), after.get('peak_rss_bytes')):>9}"
+        )
+
+    for mode, before in baseline.get("startup", {}).items():
+        after = candidate.get("startup", {}).get(mode)
+
+        if after is not None:
+            lines.append(f"startup {mode:<12} {percent_change(before.get('median_s'), after.get('median_s')):>11} (median, {before.get('median_s')} s -> {after.get('median_s')} s)")
+
+    lines += warnings
+
+    for name, after in candidate.get("scenarios", {}).items():
+        if after.get("pool_checkout", {}).get("stalls") or after.get("pool_checkout", {}).get("timeouts"):
+            lines.append(f"warning: {name} stalled on connection pool checkouts, {after.get('pool_checkout')}")
+
+    for name, plan in candidate.get("plans", {}).items():
+        if len(plan.get("seq_scans", [])) > len(baseline.get("plans", {}).get(name, {}).get("seq_scans", [])):
+            lines.append(f"warning: {name} now scans {', '.join(plan.get('seq_scans'))} sequentially")
+
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=benchmarks.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Seed a throwaway database, start the app and run the scenarios")
+    run_parser.add_argument("--scenarios", help=f"Comma-separated, default: {','.join(SCENARIOS.keys())}")
+    run_parser.add_argument("--users", type=int, default=10000)
+    run_parser.add_argument("--audio-files", type=int, default=1000000)
+    run_parser.add_argument("--requests", type=int, help="Requests per scenario, instead of each scenario's default")
+    run_parser.add_argument("--concurrency", type=int, help="Virtual users per scenario, instead of each scenario's default")
+    run_parser.add_argument("--workers", type=int, help="Run the app with python -m app.server and this many workers, instead of a single uvicorn process")
+    run_parser.add_argument("--output", help="Results json, printed to stdout when omitted")
+    run_parser.add_argument("--keep-app-log", help="Copy the app's log there once the run ends")
+
+    startup_parser = subparsers.add_parser("startup", help="Time cold starts, from exec to the first successful request")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--users", type=int, default=100)
+    startup_parser.add_argument("--audio-files", type=int, default=10000)
+    startup_parser.add_argument("--workers", type=int, help="Time python -m app.server with this many workers as well")
+    startup_parser.add_argument("--output", help="Results json, printed to stdout when omitted")
+
+    compare_parser = subparsers.add_parser("compare", help="Change per scenario between two results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args()
+
+    if args.command in ["run", "startup"]:
+        results = asyncio.run(run(args) if args.command == "run" else startup(args))
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2, default=str)
+        else:
+            print(json.dumps(results, indent=2, default=str))
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+
+        print("\n".join(compare(baseline, candidate)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# Sytem imports
+import time
+import asyncio
+import itertools
+from typing import Dict, Any, List, Callable, Awaitable
+
+# benchmark-related imports
+import httpx
+import numpy as np
+from prometheus_client.parser import text_string_to_metric_families
+
+# a checkout waiting longer than this counts as a stall, one of the bucket bounds of db_pool_checkout_wait_seconds
+CHECKOUT_STALL_SECONDS = 0.1
+
+# a request of a scenario, gets the client and the index of the request, returns the response
+Request = Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+async def run_closed_loop(
+    base_url: str,
+    request: Request,
+    concurrency: int,
+    requests: int,
+    timeout: float = 60
+) -> Dict[str, Any]:
+    """
+    Sends requests from concurrency virtual users, each sending its next request once the previous one was answered,
+    so that throughput is what the server sustains rather than what the load generator offers.
+
+    Returns:
+        dict: summary() of the latencies, plus the bytes sent and received. Errors (status >= 400, transport errors) are
+              counted in the totals, "successful" is the summary() of the other requests alone, see error_rate.
+    """
+    counter = itertools.count()
+    latencies: List[float] = []
+    successful_latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    transferred = {"sent": 0, "received": 0}
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        async def virtual_user():
+            while (index := next(counter)) < requests:
+                start = time.perf_counter()
+
+                try:
+                    res = await request(client, index)
+                    latencies.append(time.perf_counter() - start)
+
+                    transferred["sent"] += int(res.request.headers.get("content-length") or 0)
+                    transferred["received"] += len(res.content)
+
+                    if res.status_code >= 400:
+                        errors[str(res.status_code)] = errors.get(str(res.status_code), 0) + 1
+                    else:
+                        successful_latencies.append(latencies[-1])
+                except httpx.HTTPError as e:
+                    latencies.append(time.perf_counter() - start)
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[virtual_user() for _ in range(concurrency)])
+        duration = time.perf_counter() - start
+
+    return {
+        **summary(latencies=latencies, duration=duration),
+        # a server turning requests away quickly (e.g., 429) looks fast in the totals
+        "successful": summary(latencies=successful_latencies, duration=duration),
+        "error_rate": round(sum(errors.values()) / len(latencies), 4) if latencies else 0.0,
+        "concurrency": concurrency,
+        "errors": errors,
+        "bytes_sent": transferred.get("sent"),
+        "bytes_received": transferred.get("received")
+    }
+
+async def scrape_pool_checkouts(metrics_url: str) -> Dict[str, float]:
+    # counters of the app's connection pool, see app.metrics, a scenario reports the difference before / after it ran
+    samples = {}
+
+    async with httpx.AsyncClient() as client:
+        res = await client.get(metrics_url)
+        res.raise_for_status()
+
+    for family in text_string_to_metric_families(res.text):
+        for sample in family.samples:
+            if sample.name == "db_pool_checkout_wait_seconds_bucket" and sample.labels.get("le") == str(CHECKOUT_STALL_SECONDS):
+                samples["fast"] = sample.value
+            elif sample.name in ["db_pool_checkout_wait_seconds_count", "db_pool_checkout_wait_seconds_sum", "db_pool_checkout_timeouts_total"]:
+                samples[sample.name] = sample.value
+
+    return {
+        "checkouts": samples.get("db_pool_checkout_wait_seconds_count", 0),
+        "wait_seconds": samples.get("db_pool_checkout_wait_seconds_sum", 0),
+        "fast": samples.get("fast", 0),
+        "timeouts": samples.get("db_pool_checkout_timeouts_total", 0)
+    }
+
+def pool_checkout_summary(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, Any]:
+    checkouts = after.get("checkouts") - before.get("checkouts")
+
+    return {
+        "checkouts": int(checkouts),
+        "mean_wait_ms": round((after.get("wait_seconds") - before.get("wait_seconds")) / checkouts * 1000, 3) if checkouts else 0.0,
+        # checkouts that waited longer than CHECKOUT_STALL_SECONDS, any at all means the pool is too small for the concurrency
+        "stalls": int(checkouts - (after.get("fast") - before.get("fast"))),
+        "timeouts": int(after.get("timeouts") - before.get("timeouts"))
+    }
+
+def summary(latencies: List[float], duration: float) -> Dict[str, Any]:
+    if len(latencies) == 0:
+        return {
+            "requests": 0,
+            "duration_s": round(duration, 3),
+            "throughput_rps": 0.0,
+            "latency_ms": None
+        }
+
+    latencies_ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+
+    return {
+        "requests": len(latencies),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 1),
+        "latency_ms": {
+            "p50": round(float(p50), 2),
+            "p95": round(float(p95), 2),
+            "p99": round(float(p99), 2),
+            "max": round(float(latencies_ms.max()), 2),
+            "mean": round(float(latencies_ms.mean()), 2)
+        }
+    }
@@ -0,0 +1,67 @@
+# Sytem imports
+from typing import Dict, Any
+
+# FastAPI-related imports
+from app.postgres.async_postgres_db import Async_Postgres_DB
+from app.postgres.mappings import Audio_File, User
+from app.routers.audio_files import select_audio_files, select_search_page, DEFAULT_PAGE_SIZE
+from app.dedup import select_blob_stats
+from benchmarks.seed import user_id, audio_file_ids_of
+
+# SQLAlchemy-related imports
+from sqlalchemy import select, any_, bindparam, ARRAY
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+async def explain_queries(database_url: str, users: int, audio_files: int) -> Dict[str, Any]:
+    """
+    EXPLAINs the statements behind the hot endpoints against the seeded data, a sequential scan of audio_files
+    or users at this size is a missing or unusable index (tests/test_query_plans.py fails on it).
+
+    Returns:
+        dict: { <query>: { "seq_scans": [<table>, ...], "total_cost": float } } or { <query>: { "error": str } }
+    """
+    engine = create_async_engine(database_url.replace("postgresql://", "postgresql+asyncpg://", 1))
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    # the busiest user, the one the seeded libraries are largest for
+    owner = user_id(1)
+    ids = audio_file_ids_of(1, users=users, audio_files=audio_files)[:50]
+
+    statements = {
+        # login (users.authenticate_user) and the current_user dependency
+        "user_by_username": select(User).where(User.username == "bench1"),
+        "user_by_id": select(User).where(User.id == owner),
+        # GET /audio_files/{id}/stream, /peaks and /token/{id} (Async_Postgres_DB.retrieve)
+        "audio_file_by_id": select(Audio_File).where(Audio_File.id == (ids[0] if len(ids) > 0 else owner)),
+        "library_first_page": select_audio_files(user_id=owner).limit(DEFAULT_PAGE_SIZE + 1),
+        "library_next_page": select_audio_files(user_id=owner, after=(0, ids[-1] if len(ids) > 0 else owner)).limit(DEFAULT_PAGE_SIZE + 1),
+        # the page, its total and the facet counts are one statement
+        "search": select_search_page(user_id=owner, q="groove", category=None, limit=DEFAULT_PAGE_SIZE, offset=0),
+        "search_with_category": select_search_page(user_id=owner, q="kick", category="drums", limit=DEFAULT_PAGE_SIZE, offset=0),
+        # the ANY(:ids) lookup of POST /audio_files/tokens (Async_Postgres_DB.retrieve_any)
+        "playlist_tokens": select(Audio_File).where(
+            Audio_File.id == any_(bindparam("id_values", value=ids, type_=ARRAY(Audio_File.id.type))),
+            Audio_File.user_id == owner
+        ),
+        # GET /audio_files/stats
+        "blob_stats": select_blob_stats(user_id=owner)
+    }
+
+    plans = {}
+
+    try:
+        async with session_maker() as session:
+            for name, statement in statements.items():
+                success, res = await Async_Postgres_DB.explain(session=session, statement=statement)
+
+                if not success:
+                    plans[name] = {"error": res.get("error")}
+                    continue
+
+                plans[name] = {
+                    "seq_scans": Async_Postgres_DB.find_seq_scans(res.get("plan")),
+                    "total_cost": res.get("plan").get("Total Cost")
+                }
+    finally:
+        await engine.dispose()
+
+    return plans
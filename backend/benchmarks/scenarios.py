@@ -0,0 +1,241 @@
+# Sytem imports
+import io
+import os
+import zipfile
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Tuple, Callable, Awaitable
+
+# benchmark-related imports
+import jwt
+import httpx
+from benchmarks.load import run_closed_loop
+from benchmarks.seed import SEED_PASSWORD, SEED_BLOB_SECONDS, WORDS, CATEGORIES, wav_file, user_id, audio_file_ids_of, audio_file_id
+
+# seconds of audio per uploaded file, 30 s of 16 bit mono 44.1 kHz is about 2.6 MB
+UPLOAD_SECONDS = int(os.getenv("BENCH_UPLOAD_SECONDS") or 30)
+# files per POST /audio_files/bulk
+BULK_UPLOAD_FILES = int(os.getenv("BENCH_BULK_UPLOAD_FILES") or 20)
+# ids per POST /audio_files/tokens, a playlist
+PLAYLIST_SIZE = int(os.getenv("BENCH_PLAYLIST_SIZE") or 50)
+LIBRARY_PAGE_SIZE = int(os.getenv("BENCH_LIBRARY_PAGE_SIZE") or 50)
+# bytes per Range request of stream_seek, a player seeking and buffering
+SEEK_RANGE_SIZE = int(os.getenv("BENCH_SEEK_RANGE_SIZE") or 256 * 1024)
+# concurrent requests the deployment is sized for, pool_saturation runs at this concurrency
+TARGET_CONCURRENCY = int(os.getenv("BENCH_TARGET_CONCURRENCY") or 200)
+
+class Scenario_Context:
+    """
+    What a scenario needs to know about the run.
+
+    Args:
+        base_url (str): The app under test.
+        users (int): Seeded users, bench1 ... bench<users>.
+        audio_files (int): Seeded audio files.
+        secret_key (str): SECRET_KEY of the app, tokens are minted directly so that only login_storm pays for bcrypt.
+        algorithm (str): JWT_SIGNING_ALGORITHM of the app.
+    """
+    def __init__(self, base_url: str, users: int, audio_files: int, secret_key: str, algorithm: str):
+        self.base_url = base_url
+        self.users = users
+        self.audio_files = audio_files
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.tokens: Dict[int, str] = {}
+
+    def user_index(self, index: int) -> int:
+        # requests are spread round-robin over the users
+        return 1 + index % self.users
+
+    def headers(self, user_index: int) -> Dict[str, str]:
+        if user_index not in self.tokens:
+            self.tokens[user_index] = jwt.encode(
+                {"sub": str(user_id(user_index)), "exp": datetime.now(timezone.utc) + timedelta(hours=6)},
+                self.secret_key,
+                algorithm=self.algorithm
+            )
+
+        return {"Authorization": f"Bearer {self.tokens[user_index]}"}
+
+def unique_wav(base: bytes, index: int) -> bytes:
+    # a copy of base with the first samples overwritten, every upload has its own sha256 so that dedup does not short-circuit it
+    payload = bytearray(base)
+    payload[44:52] = index.to_bytes(8, "little")
+
+    return bytes(payload)
+
+# --------------------------------------------------------------------------------------------------------------------------------------
+# Read scenarios
+
+async def login_storm(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # POST /token, dominated by bcrypt and the password executor
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        return await client.post("/token", data={"username": f"bench{context.user_index(index)}", "password": SEED_PASSWORD})
+
+    return await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests)
+
+async def library_listing(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # GET /audio_files/, every user pages through their library newest first, following next_cursor
+    cursors: Dict[int, str] = {}
+
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        user_index = context.user_index(index)
+        params = {"limit": LIBRARY_PAGE_SIZE}
+
+        if cursors.get(user_index) is not None:
+            params["cursor"] = cursors.get(user_index)
+
+        res = await client.get("/audio_files/", params=params, headers=context.headers(user_index))
+
+        if res.status_code == 200:
+            cursors[user_index] = res.json().get("next_cursor")
+
+        return res
+
+    return await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests)
+
+async def playlist_signing(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # POST /audio_files/tokens, a playlist worth of playback urls per request
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        user_index = context.user_index(index)
+        ids = audio_file_ids_of(user_index, users=context.users, audio_files=context.audio_files)[:PLAYLIST_SIZE]
+
+        return await client.post("/audio_files/tokens", json={"ids": [str(id) for id in ids]}, headers=context.headers(user_index))
+
+    return await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests)
+
+async def search(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # GET /audio_files/search, prefixes as typed into a search box, every other one filtered by category
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        user_index = context.user_index(index)
+        word = WORDS[index % len(WORDS)]
+        params = {"q": word[:max(3, len(word) - index % 3)]}
+
+        if index % 2 == 1:
+            params["category"] = CATEGORIES[index % len(CATEGORIES)]
+
+        return await client.get("/audio_files/search", params=params, headers=context.headers(user_index))
+
+    return await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests)
+
+async def stream_seek(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # GET /audio_files/{id}/stream with a Range header at a different position each time
+    blob_size = 44 + SEED_BLOB_SECONDS * 44100 * 2
+
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        # file i belongs to user 1 + i % users
+        file_index = (index * 7919) % context.audio_files
+        start = (index * 104729) % max(blob_size - SEEK_RANGE_SIZE, 1)
+
+        return await client.get(
+            f"/audio_files/{audio_file_id(file_index)}/stream",
+            headers={**context.headers(1 + file_index % context.users), "Range": f"bytes={start}-{start + SEEK_RANGE_SIZE - 1}"}
+        )
+
+    return await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests)
+
+async def pool_saturation(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # short read-only requests at the target concurrency, every one of them holds a pooled connection for a round trip or two,
+    # the pool_checkout stats reported with it should show no stalls and no timeouts
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        user_index = context.user_index(index)
+
+        if index % 2 == 0:
+            return await client.get("/audio_files/", params={"limit": 10}, headers=context.headers(user_index))
+
+        ids = audio_file_ids_of(user_index, users=context.users, audio_files=context.audio_files)[:10]
+
+        return await client.post("/audio_files/tokens", json={"ids": [str(id) for id in ids]}, headers=context.headers(user_index))
+
+    return await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests)
+
+# --------------------------------------------------------------------------------------------------------------------------------------
+# Write scenarios, they add rows and blobs so they run after the read ones
+
+async def concurrent_uploads(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # POST /audio_files/, one multipart upload per request
+    base = wav_file(UPLOAD_SECONDS, seed=b"upload")
+
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        user_index = context.user_index(index)
+
+        return await client.post(
+            "/audio_files/",
+            data={"description": f"upload {index}", "category": CATEGORIES[index % len(CATEGORIES)]},
+            files={"audio_file": (f"upload-{index}.wav", unique_wav(base, index), "audio/wav")},
+            headers=context.headers(user_index)
+        )
+
+    return with_bandwidth(await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests))
+
+async def resumable_upload(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # POST /audio_files/uploads, one PATCH with the whole file, then finalize, timed together
+    base = wav_file(UPLOAD_SECONDS, seed=b"resumable")
+    # the closed loop only sees the finalize response, whose request has no body, the file itself went with the PATCH
+    sent = {"bytes": 0}
+
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        headers = context.headers(context.user_index(index))
+        payload = unique_wav(base, index)
+
+        res = await client.post(
+            "/audio_files/uploads",
+            data={"description": f"resumable {index}", "category": CATEGORIES[index % len(CATEGORIES)], "content_type": "audio/wav", "size": len(payload)},
+            headers=headers
+        )
+
+        if res.status_code != 201:
+            return res
+
+        location = res.headers.get("Location")
+        res = await client.patch(location, content=payload, headers={**headers, "Upload-Offset": "0", "Content-Type": "application/offset+octet-stream"})
+
+        if res.status_code != 200:
+            return res
+
+        sent["bytes"] += len(payload)
+
+        return await client.post(f"{location}/finalize", headers=headers)
+
+    result = await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests)
+    result["bytes_sent"] = sent.get("bytes")
+
+    return with_bandwidth(result)
+
+async def bulk_upload(context: Scenario_Context, requests: int, concurrency: int) -> Dict[str, Any]:
+    # POST /audio_files/bulk, BULK_UPLOAD_FILES files in one zip archive per request
+    base = wav_file(UPLOAD_SECONDS, seed=b"bulk")
+
+    async def request(client: httpx.AsyncClient, index: int) -> httpx.Response:
+        archive = io.BytesIO()
+
+        # stored, wav barely compresses and deflate would only measure the load generator
+        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as zip_file:
+            for member in range(BULK_UPLOAD_FILES):
+                zip_file.writestr(f"bulk-{index}-{member}.wav", unique_wav(base, index * BULK_UPLOAD_FILES + member))
+
+        return await client.post(
+            "/audio_files/bulk",
+            data={"category": CATEGORIES[index % len(CATEGORIES)]},
+            files={"archive": (f"bulk-{index}.zip", archive.getvalue(), "application/zip")},
+            headers=context.headers(context.user_index(index))
+        )
+
+    return with_bandwidth(await run_closed_loop(context.base_url, request, concurrency=concurrency, requests=requests))
+
+def with_bandwidth(result: Dict[str, Any]) -> Dict[str, Any]:
+    result["upload_mb_per_s"] = round(result.get("bytes_sent") / 1024 / 1024 / result.get("duration_s"), 1) if result.get("duration_s") else 0.0
+
+    return result
+
+# name -> (scenario, default requests, default concurrency), in the order they run
+SCENARIOS: Dict[str, Tuple[Callable[[Scenario_Context, int, int], Awaitable[Dict[str, Any]]], int, int]] = {
+    "login_storm": (login_storm, 500, 50),
+    "library_listing": (library_listing, 5000, 50),
+    "playlist_signing": (playlist_signing, 2000, 50),
+    "search": (search, 2000, 50),
+    "stream_seek": (stream_seek, 5000, 50),
+    "pool_saturation": (pool_saturation, 20000, TARGET_CONCURRENCY),
+    "concurrent_uploads": (concurrent_uploads, 500, 20),
+    "resumable_upload": (resumable_upload, 200, 10),
+    "bulk_upload": (bulk_upload, 20, 4)
+}
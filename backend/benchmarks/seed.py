@@ -0,0 +1,151 @@
+# Sytem imports
+import os
+import time
+import uuid
+import struct
+import hashlib
+from typing import Dict, Any, List
+
+# FastAPI-related imports
+from app.postgres.migrations import migrate
+from app.storage.base import blob_object_name
+from app.dedup import content_blob_name
+
+# SQLAlchemy-related imports
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# Security-related imports
+from passlib.hash import bcrypt
+
+# every seeded user logs in with this password
+SEED_PASSWORD = "benchmark"
+# rows per INSERT ... SELECT generate_series, each batch is its own transaction
+SEED_BATCH_SIZE = int(os.getenv("BENCH_SEED_BATCH_SIZE") or 100000)
+# distinct blobs the seeded audio files point at, they are real files so that they can be streamed
+SEED_BLOBS = int(os.getenv("BENCH_SEED_BLOBS") or 16)
+SEED_BLOB_SECONDS = int(os.getenv("BENCH_SEED_BLOB_SECONDS") or 10)
+
+CATEGORIES = ["drums", "bass", "vocals", "fx", "ambient", "keys", "guitar", "loops"]
+WORDS = [
+    "kick", "snare", "hat", "clap", "groove", "deep", "warm", "bright", "vintage", "analog",
+    "lofi", "chill", "dark", "punchy", "wide", "vocal", "chop", "riser", "drop", "pad",
+    "pluck", "stab", "sub", "bassline", "melody", "chord", "loop", "break", "swing", "texture"
+]
+
+def user_id(index: int) -> uuid.UUID:
+    # the same ids the seed sql derives, md5('user' || i)::uuid, so the load generator knows them without a query
+    return uuid.UUID(hashlib.md5(f"user{index}".encode()).hexdigest())
+
+def audio_file_id(index: int) -> uuid.UUID:
+    return uuid.UUID(hashlib.md5(f"file{index}".encode()).hexdigest())
+
+def audio_file_ids_of(user_index: int, users: int, audio_files: int) -> List[uuid.UUID]:
+    # file i belongs to user 1 + i % users
+    return [audio_file_id(index) for index in range(user_index - 1, audio_files, users)]
+
+def wav_file(seconds: int, seed: bytes) -> bytes:
+    # 16 bit mono 44.1 kHz, pseudo-random samples derived from seed so that every blob has its own content
+    data = b"".join(hashlib.sha512(seed + i.to_bytes(8, "little")).digest() for i in range(seconds * 44100 * 2 // 64 + 1))[:seconds * 44100 * 2]
+    header = b"RIFF" + struct.pack("<I", 36 + len(data)) + b"WAVE"
+    header += b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, 44100, 44100 * 2, 2, 16)
+    header += b"data" + struct.pack("<I", len(data))
+
+    return header + data
+
+async def seed(database_url: str, storage_path: str, users: int, audio_files: int, bcrypt_rounds: int) -> Dict[str, Any]:
+    """
+    Migrates the database and fills it with users and audio files spread evenly over the users, straight in sql.
+
+    Args:
+        database_url (str): postgresql:// url of the benchmark database.
+        storage_path (str): LOCAL_STORAGE_PATH of the app, the blobs are written there.
+        users (int): Users to create, bench1 ... bench<users>.
+        audio_files (int): Audio files to create.
+        bcrypt_rounds (int): BCRYPT_ROUNDS of the app, so that logins do not rehash.
+
+    Returns:
+        dict: { "users", "audio_files", "blobs", "seconds" }
+    """
+    start = time.perf_counter()
+    engine = create_async_engine(database_url.replace("postgresql://", "postgresql+asyncpg://", 1))
+    now = int(time.time())
+
+    try:
+        # the schema the app checks for on start, as python -m app.migrate creates it
+        success, res = await migrate(engine=engine)
+
+        if not success:
+            raise Exception(res.get("error"))
+
+        os.makedirs(storage_path, exist_ok=True)
+        blobs = []
+
+        for index in range(SEED_BLOBS):
+            data = wav_file(SEED_BLOB_SECONDS, seed=f"blob{index}".encode())
+            sha256 = hashlib.sha256(data).hexdigest()
+            blob_name = content_blob_name(sha256=sha256, content_type="audio/wav")
+
+            with open(os.path.join(storage_path, blob_object_name(str(blob_name), "audio/wav")), "wb") as f:
+                f.write(data)
+
+            blobs.append({"blob_name": blob_name, "sha256": sha256, "size": len(data), "ref_count": len(range(index, audio_files, SEED_BLOBS))})
+
+        # one hash for everyone, bcrypt is what the login storm measures, not what seeding should spend its time on
+        password_hash = bcrypt.using(rounds=bcrypt_rounds).hash(SEED_PASSWORD)
+
+        async with engine.begin() as conn:
+            await conn.execute(text("""
+                INSERT INTO users (id, username, email, password_hash, full_name, disabled, created_at)
+                SELECT md5('user' || i)::uuid, 'bench' || i, 'bench' || i || '@example.com', CAST(:password_hash AS varchar), 'Bench User ' || i, false, CAST(:now AS integer)
+                FROM generate_series(1, CAST(:users AS integer)) AS i
+            """), {"password_hash": password_hash, "now": now, "users": users})
+
+            await conn.execute(text("""
+                INSERT INTO audio_blobs (blob_name, sha256, content_type, size, ref_count, created_at)
+                VALUES (:blob_name, :sha256, 'audio/wav', :size, :ref_count, :now)
+            """), [{**blob, "now": now} for blob in blobs])
+
+        for batch_start in range(0, audio_files, SEED_BATCH_SIZE):
+            async with engine.begin() as conn:
+                # newest first in every library, the descriptions are a few words of WORDS so that search has something to rank
+                await conn.execute(text("""
+                    INSERT INTO audio_files (id, user_id, description, category, blob_name, content_type, duration, sample_rate, channels, created_at)
+                    SELECT
+                        md5('file' || i)::uuid,
+                        md5('user' || (1 + i % CAST(:users AS integer)))::uuid,
+                        words[1 + (i * 7) % cardinality(words)] || ' ' || words[1 + (i * 13) % cardinality(words)] || ' ' || i,
+                        categories[1 + (i * 3) % cardinality(categories)],
+                        blob_names[1 + i % cardinality(blob_names)],
+                        'audio/wav',
+                        CAST(:duration AS double precision),
+                        44100,
+                        1,
+                        CAST(:now AS integer) - i
+                    FROM generate_series(CAST(:batch_start AS integer), CAST(:batch_end AS integer)) AS i, (
+                        SELECT CAST(:words AS text[]) AS words, CAST(:categories AS text[]) AS categories, CAST(:blob_names AS uuid[]) AS blob_names
+                    ) AS params
+                """), {
+                    "users": users,
+                    "words": WORDS,
+                    "categories": CATEGORIES,
+                    "blob_names": [blob.get("blob_name") for blob in blobs],
+                    "duration": float(SEED_BLOB_SECONDS),
+                    "now": now,
+                    "batch_start": batch_start,
+                    "batch_end": min(batch_start + SEED_BATCH_SIZE, audio_files) - 1
+                })
+
+        # statistics for the planner, as autovacuum would eventually gather them
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("ANALYZE"))
+    finally:
+        await engine.dispose()
+
+    return {
+        "users": users,
+        "audio_files": audio_files,
+        "blobs": len(blobs),
+        "seconds": round(time.perf_counter() - start, 1)
+    }
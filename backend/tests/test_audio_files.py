@@ -0,0 +1,83 @@
+# Sytem imports
+import uuid
+
+# test-related imports
+import pytest
+import asyncpg
+
+# FastAPI-related imports
+from app.postgres.async_postgres_db import Async_Postgres_DB
+from app.postgres.mappings import Audio_File
+
+# benchmark-related imports
+from benchmarks.seed import wav_file
+
+async def upload(client, user, data: bytes) -> uuid.UUID:
+    res = await client.post(
+        "/audio_files/",
+        data={"description": "test upload", "category": "tests"},
+        files={"audio_file": ("test.wav", data, "audio/wav")},
+        headers=user.get("headers")
+    )
+    assert res.status_code == 201, res.text
+
+    return uuid.UUID(res.json().get("id"))
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/audio_files/{id}/stream", "/audio_files/token/{id}", "/audio_files/{id}/peaks"])
+async def test_unknown_audio_file_is_not_found(client, new_user, path):
+    user = await new_user()
+
+    res = await client.get(path.format(id=uuid.uuid4()), headers=user.get("headers"))
+
+    assert res.status_code == 404, res.text
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/audio_files/{id}/stream", "/audio_files/{id}/peaks"])
+async def test_failed_lookup_is_a_server_error(client, new_user, monkeypatch, path):
+    # a database error is not a missing file
+    user = await new_user()
+    retrieve = Async_Postgres_DB.retrieve
+
+    async def failing_retrieve(session, tbl, value=None, col_name="id"):
+        if tbl is Audio_File:
+            return False, {"error": "connection lost"}
+
+        return await retrieve(session=session, tbl=tbl, value=value, col_name=col_name)
+
+    monkeypatch.setattr(Async_Postgres_DB, "retrieve", failing_retrieve)
+
+    res = await client.get(path.format(id=uuid.uuid4()), headers=user.get("headers"))
+
+    assert res.status_code == 500, res.text
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/audio_files/{id}/stream", "/audio_files/token/{id}"])
+async def test_other_users_audio_file_is_not_found(client, new_user, path):
+    owner = await new_user()
+    other = await new_user()
+    id = await upload(client, owner, wav_file(1, seed=uuid.uuid4().bytes))
+
+    assert (await client.get(path.format(id=id), headers=owner.get("headers"))).status_code == 200
+    assert (await client.get(path.format(id=id), headers=other.get("headers"))).status_code == 404
+
+@pytest.mark.anyio
+async def test_soft_deleted_audio_file_is_not_signed(client, new_user, postgres_url):
+    user = await new_user()
+    id = await upload(client, user, wav_file(1, seed=uuid.uuid4().bytes))
+
+    conn = await asyncpg.connect(postgres_url)
+
+    try:
+        await conn.execute("UPDATE audio_files SET deleted_at = 1 WHERE id = $1", id)
+    finally:
+        await conn.close()
+
+    assert (await client.get(f"/audio_files/token/{id}", headers=user.get("headers"))).status_code == 404
+    assert (await client.get(f"/audio_files/{id}/stream", headers=user.get("headers"))).status_code == 404
+
+    res = await client.post("/audio_files/tokens", json={"ids": [str(id)]}, headers=user.get("headers"))
+
+    assert res.status_code == 200, res.text
+    assert res.json().get("audio_urls") == []
+    assert [error.get("audio_id") for error in res.json().get("errors")] == [str(id)]
@@ -0,0 +1,130 @@
+# Sytem imports
+import io
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+import zipfile
+
+# test-related imports
+import pytest
+import asyncpg
+
+# FastAPI-related imports
+from app.dependencies import get_storage
+from app.dedup import content_blob_name
+from app.storage.base import blob_object_name
+from app.routers import audio_files
+
+# benchmark-related imports
+from benchmarks.seed import wav_file
+
+def archive(members) -> bytes:
+    buffer = io.BytesIO()
+
+    with zipfile.ZipFile(buffer, "w") as f:
+        for name, data in members.items():
+            f.writestr(name, data)
+
+    return buffer.getvalue()
+
+def blob_name_of(data: bytes) -> uuid.UUID:
+    return content_blob_name(sha256=hashlib.sha256(data).hexdigest(), content_type="audio/x-wav")
+
+async def bulk_upload(client, user, members):
+    return await client.post(
+        "/audio_files/bulk",
+        data={"category": "tests"},
+        files={"archive": ("upload.zip", archive(members), "application/zip")},
+        headers=user.get("headers")
+    )
+
+@pytest.mark.anyio
+async def test_member_files_are_closed_before_the_insert(client, new_user, monkeypatch):
+    user = await new_user()
+    extracted = []
+    open_at_insert = []
+
+    extract_member = audio_files.extract_member
+    reference_blobs = audio_files.reference_blobs
+
+    def record_extract(archive_file, info):
+        f = extract_member(archive_file, info)
+        extracted.append(f)
+        return f
+
+    async def record_reference(session, blobs):
+        open_at_insert.append(sum(1 for f in extracted if not f.closed))
+        return await reference_blobs(session=session, blobs=blobs)
+
+    monkeypatch.setattr(audio_files, "extract_member", record_extract)
+    monkeypatch.setattr(audio_files, "reference_blobs", record_reference)
+
+    shared = wav_file(1, seed=uuid.uuid4().bytes)
+    res = await bulk_upload(client, user, {"a.wav": shared, "b.wav": shared, "c.wav": wav_file(1, seed=uuid.uuid4().bytes)})
+
+    assert res.status_code == 201, res.text
+    assert res.json().get("created") == 3
+    assert len(extracted) == 3
+    assert open_at_insert == [0]
+
+@pytest.mark.anyio
+async def test_blob_that_cannot_be_stored_again_fails_its_entry(client, new_user, postgres_url, monkeypatch):
+    user = await new_user()
+    swept = wav_file(1, seed=uuid.uuid4().bytes)
+    fresh = wav_file(1, seed=uuid.uuid4().bytes)
+
+    res = await bulk_upload(client, user, {"swept.wav": swept})
+    assert res.status_code == 201, res.text
+    assert (await client.delete(f"/audio_files/{res.json().get('results')[0].get('id')}", headers=user.get("headers"))).status_code == 200
+
+    # the storage refuses the swept blob from now on
+    storage = get_storage()
+    upload = storage.upload
+    swept_object_name = blob_object_name(blob_name=str(blob_name_of(swept)), content_type="audio/x-wav")
+
+    async def failing_upload(blob_name, file, content_type):
+        if blob_name == swept_object_name:
+            return False, {"error": "Storage unavailable"}
+
+        return await upload(blob_name=blob_name, file=file, content_type=content_type)
+
+    monkeypatch.setattr(storage, "upload", failing_upload)
+
+    # a sweep that has claimed the unreferenced blob (app.worker.sweep_blobs)
+    sweeper = await asyncpg.connect(postgres_url)
+    observer = await asyncpg.connect(postgres_url)
+
+    try:
+        sweep = sweeper.transaction()
+        await sweep.start()
+        assert await sweeper.fetchval("SELECT blob_name FROM audio_blobs WHERE ref_count = 0 AND blob_name = $1 FOR UPDATE SKIP LOCKED", blob_name_of(swept)) is not None
+
+        uploading = asyncio.create_task(bulk_upload(client, user, {"swept.wav": swept, "fresh.wav": fresh}))
+        start = time.monotonic()
+
+        while await observer.fetchval("SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock' AND datname = current_database()") == 0:
+            assert not uploading.done(), uploading.result().text
+            assert time.monotonic() - start < 5, "The upload did not wait for the sweep"
+            await asyncio.sleep(0.05)
+
+        os.remove(storage.path(swept_object_name))
+        await sweeper.execute("DELETE FROM audio_blobs WHERE blob_name = $1", blob_name_of(swept))
+        await sweep.commit()
+
+        res = await uploading
+
+        assert res.status_code == 201, res.text
+        results = {result.get("filename"): result for result in res.json().get("results")}
+
+        assert results.get("swept.wav").get("error") == "Storage unavailable"
+        assert results.get("fresh.wav").get("id") is not None
+
+        # nothing points at the blob that is not stored
+        assert await observer.fetchval("SELECT count(*) FROM audio_files WHERE blob_name = $1", blob_name_of(swept)) == 0
+        assert await observer.fetchval("SELECT coalesce(max(ref_count), 0) FROM audio_blobs WHERE blob_name = $1", blob_name_of(swept)) == 0
+        assert await observer.fetchval("SELECT ref_count FROM audio_blobs WHERE blob_name = $1", blob_name_of(fresh)) == 1
+    finally:
+        await sweeper.close()
+        await observer.close()
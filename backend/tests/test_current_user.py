@@ -0,0 +1,67 @@
+# Sytem imports
+import time
+import asyncio
+
+# test-related imports
+import pytest
+import asyncpg
+
+# FastAPI-related imports
+from app import dependencies
+
+# well below CURRENT_USER_CACHE_TTL, a change has to reach the cache through the notification
+NOTIFICATION_TIMEOUT = 2.0
+
+async def wait_for_status(client, headers, status_code: int) -> float:
+    # seconds until GET /users/ answers with status_code
+    start = time.monotonic()
+
+    while time.monotonic() - start < NOTIFICATION_TIMEOUT:
+        if (await client.get("/users/", headers=headers)).status_code == status_code:
+            return time.monotonic() - start
+
+        await asyncio.sleep(0.05)
+
+    raise AssertionError(f"GET /users/ did not answer {status_code} within {NOTIFICATION_TIMEOUT} seconds")
+
+@pytest.fixture
+async def listening(client):
+    # the listener is started by the lifespan and connects in the background
+    start = time.monotonic()
+
+    while not dependencies.user_listener_connected:
+        assert time.monotonic() - start < 5, "Not listening for user changes"
+        await asyncio.sleep(0.05)
+
+@pytest.mark.anyio
+async def test_disabling_a_user_takes_effect_before_the_cache_expires(client, new_user, postgres_url, listening):
+    user = await new_user()
+
+    # cached by the first request
+    assert (await client.get("/users/", headers=user.get("headers"))).status_code == 200
+    assert dependencies.current_user_cache.get(str(user.get("id"))) is not None
+
+    # outside the app, as an operator would
+    conn = await asyncpg.connect(postgres_url)
+
+    try:
+        await conn.execute("UPDATE users SET disabled = true WHERE id = $1", user.get("id"))
+    finally:
+        await conn.close()
+
+    await wait_for_status(client, user.get("headers"), 403)
+
+@pytest.mark.anyio
+async def test_deleting_a_user_takes_effect_before_the_cache_expires(client, new_user, postgres_url, listening):
+    user = await new_user()
+
+    assert (await client.get("/users/", headers=user.get("headers"))).status_code == 200
+
+    conn = await asyncpg.connect(postgres_url)
+
+    try:
+        await conn.execute("DELETE FROM users WHERE id = $1", user.get("id"))
+    finally:
+        await conn.close()
+
+    await wait_for_status(client, user.get("headers"), 401)
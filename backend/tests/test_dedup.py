@@ -0,0 +1,207 @@
+# Sytem imports
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+
+# test-related imports
+import pytest
+import asyncpg
+
+# FastAPI-related imports
+from app.dependencies import get_storage
+from app.dedup import content_blob_name, BLOB_SWEEP_GRACE_SECONDS
+from app.worker import sweep_blobs
+from app.storage.base import blob_object_name
+
+# benchmark-related imports
+from benchmarks.seed import wav_file
+
+async def upload(client, user, data: bytes, description: str = "test upload"):
+    return await client.post(
+        "/audio_files/",
+        data={"description": description, "category": "tests"},
+        files={"audio_file": ("test.wav", data, "audio/wav")},
+        headers=user.get("headers")
+    )
+
+def stored_path(data: bytes) -> str:
+    blob_name = content_blob_name(sha256=hashlib.sha256(data).hexdigest(), content_type="audio/wav")
+
+    return get_storage().path(blob_object_name(blob_name=str(blob_name), content_type="audio/wav"))
+
+async def ref_count(postgres_url, data: bytes):
+    conn = await asyncpg.connect(postgres_url)
+
+    try:
+        return await conn.fetchval(
+            "SELECT ref_count FROM audio_blobs WHERE blob_name = $1",
+            content_blob_name(sha256=hashlib.sha256(data).hexdigest(), content_type="audio/wav")
+        )
+    finally:
+        await conn.close()
+
+@pytest.mark.anyio
+async def test_failed_insert_does_not_keep_the_reference(client, new_user, postgres_url):
+    user = await new_user()
+    data = wav_file(1, seed=uuid.uuid4().bytes)
+
+    # longer than audio_files.description, the insert fails after the blob is stored
+    res = await upload(client, user, data, description="x" * 101)
+
+    assert res.status_code == 500, res.text
+    assert await ref_count(postgres_url, data) == 0
+
+@pytest.mark.anyio
+async def test_upload_waiting_for_a_sweep_stores_the_blob_again(client, new_user, postgres_url):
+    user = await new_user()
+    data = wav_file(1, seed=uuid.uuid4().bytes)
+
+    res = await upload(client, user, data)
+    assert res.status_code == 201, res.text
+    assert (await client.delete(f"/audio_files/{res.json().get('id')}", headers=user.get("headers"))).status_code == 200
+    assert await ref_count(postgres_url, data) == 0
+
+    # a sweep that has claimed the unreferenced blob (app.worker.sweep_blobs)
+    sweeper = await asyncpg.connect(postgres_url)
+    observer = await asyncpg.connect(postgres_url)
+
+    try:
+        sweep = sweeper.transaction()
+        await sweep.start()
+        blob_name = await sweeper.fetchval("SELECT blob_name FROM audio_blobs WHERE ref_count = 0 AND blob_name = $1 FOR UPDATE SKIP LOCKED", content_blob_name(sha256=hashlib.sha256(data).hexdigest(), content_type="audio/wav"))
+        assert blob_name is not None
+
+        # the same content uploaded again, its reference waits for the sweep
+        uploading = asyncio.create_task(upload(client, user, data))
+        start = time.monotonic()
+
+        while await observer.fetchval("SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock' AND datname = current_database()") == 0:
+            assert not uploading.done(), uploading.result().text
+            assert time.monotonic() - start < 5, "The upload did not wait for the sweep"
+            await asyncio.sleep(0.05)
+
+        os.remove(stored_path(data))
+        await sweeper.execute("DELETE FROM audio_blobs WHERE blob_name = $1", blob_name)
+        await sweep.commit()
+
+        res = await uploading
+    finally:
+        await sweeper.close()
+        await observer.close()
+
+    assert res.status_code == 201, res.text
+    assert await ref_count(postgres_url, data) == 1
+    assert os.path.exists(stored_path(data))
+
+@pytest.mark.anyio
+async def test_stats_only_count_the_callers_files(client, new_user):
+    user = await new_user()
+    other = await new_user()
+    shared = wav_file(1, seed=uuid.uuid4().bytes)
+    own = wav_file(2, seed=uuid.uuid4().bytes)
+
+    for owner, data in [(user, shared), (user, shared), (user, own), (other, shared)]:
+        assert (await upload(client, owner, data)).status_code == 201
+
+    res = await client.get("/audio_files/stats", headers=user.get("headers"))
+
+    assert res.status_code == 200, res.text
+    assert res.json() == {
+        "blobs": 2,
+        "references": 3,
+        "stored_bytes": len(shared) + len(own),
+        "logical_bytes": 2 * len(shared) + len(own),
+        "dedup_ratio": (2 * len(shared) + len(own)) / (len(shared) + len(own)),
+        "bytes_saved": len(shared)
+    }
+
+    res = await client.get("/audio_files/stats", headers=(await new_user()).get("headers"))
+
+    assert res.status_code == 200, res.text
+    assert res.json().get("blobs") == 0 and res.json().get("references") == 0
+
+async def resumable_upload(client, user, data: bytes):
+    res = await client.post("/audio_files/uploads", data={"description": "test upload", "category": "tests", "content_type": "audio/wav", "size": len(data)}, headers=user.get("headers"))
+    assert res.status_code == 201, res.text
+    id = res.json().get("id")
+
+    res = await client.patch(f"/audio_files/uploads/{id}", content=data, headers={**user.get("headers"), "Upload-Offset": "0"})
+    assert res.status_code == 200, res.text
+
+    return await client.post(f"/audio_files/uploads/{id}/finalize", headers=user.get("headers"))
+
+@pytest.mark.anyio
+async def test_resumable_upload_references_the_blob_once(client, new_user, postgres_url):
+    user = await new_user()
+    data = wav_file(1, seed=uuid.uuid4().bytes)
+
+    # stored by the first, shared by the second
+    for expected_ref_count in [1, 2]:
+        res = await resumable_upload(client, user, data)
+
+        assert res.status_code == 201, res.text
+        assert await ref_count(postgres_url, data) == expected_ref_count
+        assert os.path.exists(stored_path(data))
+
+@pytest.mark.anyio
+async def test_deleting_a_user_releases_their_references(client, new_user, postgres_url):
+    user, other = await new_user(), await new_user()
+    data, shared = wav_file(1, seed=uuid.uuid4().bytes), wav_file(1, seed=uuid.uuid4().bytes)
+
+    # deduplicated, the user's two uploads of data share one blob
+    for owner, content in [(user, data), (user, data), (user, shared), (other, shared)]:
+        res = await upload(client, owner, content)
+        assert res.status_code == 201, res.text
+
+    assert await ref_count(postgres_url, data) == 2
+    assert await ref_count(postgres_url, shared) == 2
+
+    res = await client.delete("/users/", headers=user.get("headers"))
+    assert res.status_code == 202, res.text
+
+    # left for the worker's sweep, the other user's reference keeps the shared blob
+    assert await ref_count(postgres_url, data) == 0
+    assert await ref_count(postgres_url, shared) == 1
+
+@pytest.mark.anyio
+async def test_blob_that_cannot_be_deleted_does_not_stop_the_sweep(postgres_url, monkeypatch):
+    storage = get_storage()
+    stuck, swept = os.urandom(4096), os.urandom(4096)
+    conn = await asyncpg.connect(postgres_url)
+
+    try:
+        # unreferenced for longer than the grace period, the stuck one the longest
+        unreferenced_since = int(time.time()) - BLOB_SWEEP_GRACE_SECONDS - 60
+
+        for offset, data in enumerate([stuck, swept]):
+            sha256 = hashlib.sha256(data).hexdigest()
+            await conn.execute(
+                "INSERT INTO audio_blobs (blob_name, sha256, content_type, size, ref_count, created_at, updated_at) VALUES ($1, $2, 'audio/wav', $3, 0, $4, $4)",
+                content_blob_name(sha256=sha256, content_type="audio/wav"), sha256, len(data), unreferenced_since + offset
+            )
+
+            with open(stored_path(data), "wb") as f:
+                f.write(data)
+
+        delete = storage.delete
+
+        async def failing_delete(blob_name):
+            if blob_name == os.path.basename(stored_path(stuck)):
+                return False, {"error": "storage unavailable"}
+
+            return await delete(blob_name)
+
+        monkeypatch.setattr(storage, "delete", failing_delete)
+
+        await sweep_blobs()
+
+        # postponed by a grace period, the blob behind it is swept all the same
+        assert await conn.fetchval("SELECT updated_at FROM audio_blobs WHERE sha256 = $1", hashlib.sha256(stuck).hexdigest()) >= int(time.time()) - 60
+        assert os.path.exists(stored_path(stuck))
+        assert await conn.fetchval("SELECT count(*) FROM audio_blobs WHERE sha256 = $1", hashlib.sha256(swept).hexdigest()) == 0
+        assert not os.path.exists(stored_path(swept))
+    finally:
+        await conn.execute("DELETE FROM audio_blobs WHERE sha256 = $1", hashlib.sha256(stuck).hexdigest())
+        await conn.close()
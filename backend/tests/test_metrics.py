@@ -0,0 +1,58 @@
+# Sytem imports
+import os
+import uuid
+
+# test-related imports
+import pytest
+import httpx
+from tests.test_bulk_upload import bulk_upload
+
+# FastAPI-related imports
+from app.dependencies import engine
+from app.metrics import statement_fingerprint
+
+# SQLAlchemy-related imports
+from sqlalchemy import event
+
+# benchmark-related imports
+from benchmarks.seed import wav_file
+
+@pytest.mark.anyio
+async def test_metrics_are_not_served_on_the_public_port(client):
+    assert (await client.get("/metrics")).status_code == 404
+
+@pytest.mark.anyio
+async def test_metrics_are_served_on_their_own_port(client):
+    # a request through the app first, so that there is a sample to find
+    assert (await client.get("/")).status_code == 200
+
+    async with httpx.AsyncClient() as metrics_client:
+        res = await metrics_client.get(f"http://{os.getenv('METRICS_ADDR')}:{os.getenv('METRICS_PORT')}/metrics")
+
+    assert res.status_code == 200, res.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/",status_code="200"}' in res.text
+
+@pytest.mark.anyio
+async def test_multi_row_statements_have_one_fingerprint(client, new_user):
+    # the bulk upload inserts its audio files, blobs and transcode jobs with one multi-row INSERT each, one per row count
+    user = await new_user()
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+
+    try:
+        for count in [1, 2, 3]:
+            members = {f"{i}.wav": wav_file(seconds=1, seed=uuid.uuid4().bytes) for i in range(count)}
+            res = await bulk_upload(client, user, members)
+            assert res.status_code == 201, res.text
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+    for table in ["audio_files", "audio_blobs", "transcode_jobs"]:
+        inserts = {statement for statement in statements if statement.startswith(f"INSERT INTO {table} ")}
+
+        assert len(inserts) == 3, inserts
+        assert len({statement_fingerprint(statement) for statement in inserts}) == 1, inserts
@@ -0,0 +1,169 @@
+# Sytem imports
+import uuid
+from urllib.parse import urlparse
+
+# test-related imports
+import pytest
+import asyncpg
+import bcrypt
+import httpx
+
+# benchmark-related imports
+from benchmarks.environment import AppServer
+
+# FastAPI-related imports
+from app.postgres.migrations import migrate, schema_version, MIGRATIONS, LATEST_VERSION
+from app.postgres.mappings import Audio_File
+
+# SQLAlchemy-related imports
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# the schema of the first release, which ran create_all on every start and had no schema_migrations table
+BASELINE_SCHEMA = """
+    CREATE TABLE users (
+        id UUID NOT NULL,
+        username VARCHAR(20) NOT NULL,
+        email VARCHAR(320) NOT NULL,
+        password_hash VARCHAR(60) NOT NULL,
+        full_name VARCHAR(50) NOT NULL,
+        disabled BOOLEAN NOT NULL,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER,
+        deleted_at INTEGER,
+        PRIMARY KEY (id),
+        UNIQUE (username),
+        UNIQUE (email)
+    );
+    CREATE TABLE audio_files (
+        id UUID NOT NULL,
+        user_id UUID NOT NULL,
+        description VARCHAR(100) NOT NULL,
+        category VARCHAR(50) NOT NULL,
+        blob_name UUID NOT NULL,
+        content_type VARCHAR(50) NOT NULL,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER,
+        deleted_at INTEGER,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES users (id) ON DELETE CASCADE ON UPDATE CASCADE
+    );
+"""
+
+async def create_baseline_database(url: str) -> uuid.UUID:
+    # returns the id of its only user (password "password"), who owns two audio files
+    user_id = uuid.uuid4()
+    conn = await asyncpg.connect(url)
+
+    try:
+        await conn.execute(BASELINE_SCHEMA)
+        await conn.execute(
+            "INSERT INTO users VALUES ($1, 'baseline', 'baseline@example.com', $2, 'Baseline User', false, 1, NULL, NULL)",
+            user_id,
+            bcrypt.hashpw(b"password", bcrypt.gensalt(rounds=4)).decode()
+        )
+        await conn.executemany(
+            "INSERT INTO audio_files VALUES ($1, $2, $3, $4, $5, 'audio/wav', $6, NULL, NULL)",
+            [
+                (uuid.uuid4(), user_id, "punchy kick", "drums", uuid.uuid4(), 1),
+                (uuid.uuid4(), user_id, "warm pad", "keys", uuid.uuid4(), 2)
+            ]
+        )
+    finally:
+        await conn.close()
+
+    return user_id
+
+async def migrate_database(url: str):
+    engine = create_async_engine(url.replace("postgresql://", "postgresql+asyncpg://", 1))
+
+    try:
+        success, res = await migrate(engine=engine)
+        assert success, res.get("error")
+
+        success, version = await schema_version(engine=engine)
+        assert success, version.get("error")
+        assert version.get("version") == LATEST_VERSION
+
+        return res
+    finally:
+        await engine.dispose()
+
+@pytest.mark.anyio
+async def test_migrate_is_idempotent(empty_database):
+    res = await migrate_database(empty_database)
+    assert res.get("applied") == [version for version, _ in MIGRATIONS]
+
+    res = await migrate_database(empty_database)
+    assert res.get("applied") == []
+
+@pytest.mark.anyio
+async def test_migrate_adds_search_vector_to_baseline_database(empty_database):
+    await create_baseline_database(empty_database)
+    await migrate_database(empty_database)
+
+    conn = await asyncpg.connect(empty_database)
+
+    try:
+        # generated for the rows that were there before the column
+        assert await conn.fetchval("SELECT count(*) FROM audio_files WHERE search_vector @@ to_tsquery('simple', 'kick')") == 1
+        assert await conn.fetchval("SELECT to_regclass('ix_audio_files_search_vector') IS NOT NULL")
+        assert await conn.fetchval("SELECT to_regclass('ix_audio_files_description_trgm') IS NOT NULL")
+    finally:
+        await conn.close()
+
+@pytest.mark.anyio
+async def test_migrate_adds_audio_file_metadata_to_baseline_database(empty_database):
+    user_id = await create_baseline_database(empty_database)
+    await migrate_database(empty_database)
+
+    engine = create_async_engine(empty_database.replace("postgresql://", "postgresql+asyncpg://", 1))
+
+    try:
+        async with engine.connect() as conn:
+            # every mapped column of audio_files, as the routes select them
+            rows = (await conn.execute(select(Audio_File.__table__).where(Audio_File.user_id == user_id))).all()
+    finally:
+        await engine.dispose()
+
+    # not decoded yet, the worker fills them in
+    assert len(rows) == 2
+    assert all(row.duration is None and row.sample_rate is None and row.channels is None for row in rows)
+
+@pytest.mark.anyio
+async def test_app_serves_upgraded_baseline_database(empty_database, tmp_path):
+    # the upgrade path of a deployment: the first release's database, python -m app.migrate, then the app started on it
+    await create_baseline_database(empty_database)
+    await migrate_database(empty_database)
+
+    url = urlparse(empty_database)
+    server = AppServer(env={
+        "POSTGRES_USER": url.username,
+        "POSTGRES_PASSWORD": url.password or "",
+        "POSTGRES_HOST": f"{url.hostname}:{url.port or 5432}",
+        "POSTGRES_DATABASE": url.path.lstrip("/"),
+        "LOCAL_STORAGE_PATH": str(tmp_path / "storage")
+    }, log_path=str(tmp_path / "app.log"))
+
+    try:
+        # the lifespan refuses to start on a schema that is not at LATEST_VERSION
+        await server.start()
+
+        async with httpx.AsyncClient(base_url=server.base_url) as client:
+            res = await client.post("/token", data={"username": "baseline", "password": "password"})
+            assert res.status_code == 200, res.text
+            headers = {"Authorization": f"Bearer {res.json().get('access_token')}"}
+
+            res = await client.get("/audio_files/", headers=headers)
+            assert res.status_code == 200, res.text
+            objs = res.json().get("objs")
+            assert [obj.get("description") for obj in objs] == ["warm pad", "punchy kick"]
+
+            res = await client.get(f"/audio_files/token/{objs[0].get('id')}", headers=headers)
+            assert res.status_code == 200, res.text
+
+            res = await client.get("/audio_files/search", params={"q": "kick"}, headers=headers)
+            assert res.status_code == 200, res.text
+            assert [obj.get("description") for obj in res.json().get("objs")] == ["punchy kick"]
+    finally:
+        server.stop()
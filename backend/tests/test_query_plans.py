@@ -0,0 +1,33 @@
+# test-related imports
+import pytest
+
+# benchmark-related imports
+from benchmarks.plans import explain_queries
+
+# tables every hot query has to reach through an index, at the seeded size a sequential scan means a missing or unusable one
+INDEXED_TABLES = {"audio_files", "users"}
+
+QUERIES = [
+    "user_by_username",
+    "user_by_id",
+    "audio_file_by_id",
+    "library_first_page",
+    "library_next_page",
+    "search",
+    "search_with_category",
+    "playlist_tokens",
+    "blob_stats"
+]
+
+@pytest.fixture(scope="module")
+async def plans(postgres_url, seeded):
+    return await explain_queries(database_url=postgres_url, users=seeded.get("users"), audio_files=seeded.get("audio_files"))
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("query", QUERIES)
+async def test_no_sequential_scan(plans, query):
+    plan = plans.get(query)
+
+    assert plan is not None, f"{query} was not explained"
+    assert "error" not in plan, plan.get("error")
+    assert INDEXED_TABLES.isdisjoint(plan.get("seq_scans")), f"{query} scans {', '.join(plan.get('seq_scans'))} sequentially"
@@ -0,0 +1,78 @@
+# Sytem imports
+import os
+import time
+import uuid
+
+# test-related imports
+import pytest
+
+# FastAPI-related imports
+from app.dependencies import get_storage
+from app.storage.base import BaseStorage
+from app.storage.local import LocalStorage
+from app.storage.azure import AzureStorage
+
+@pytest.fixture
+def blob():
+    # a blob written straight into LOCAL_STORAGE_PATH, with a playback url signed for it
+    storage = get_storage()
+    blob_name = f"{uuid.uuid4()}.wav"
+    data = os.urandom(4096)
+
+    with open(storage.path(blob_name), "wb") as f:
+        f.write(data)
+
+    success, res = storage.sign_url(blob_name=blob_name, expires_at=int(time.time()) + 60)
+    assert success, res.get("error")
+
+    yield blob_name, data, res.get("url")
+
+    os.remove(storage.path(blob_name))
+
+@pytest.mark.anyio
+async def test_blob_is_streamed_by_the_app(client, blob):
+    _, data, url = blob
+
+    res = await client.get(url)
+
+    assert res.status_code == 200, res.text
+    assert res.content == data
+    assert res.headers.get("content-type") == "audio/x-wav"
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("header, prefix", [("X-Accel-Redirect", "/_blobs/"), ("X-Sendfile", "")])
+async def test_blob_is_sent_by_the_proxy(client, blob, monkeypatch, header, prefix):
+    blob_name, _, url = blob
+    storage = get_storage()
+    monkeypatch.setattr(storage, "sendfile_header", header)
+    monkeypatch.setattr(storage, "sendfile_prefix", prefix.rstrip("/"))
+
+    # ranges are the proxy's business too
+    res = await client.get(url, headers={"Range": "bytes=0-99"})
+
+    assert res.status_code == 200, res.text
+    assert res.content == b""
+    assert res.headers.get(header) == (f"/_blobs/{blob_name}" if prefix else storage.path(blob_name))
+    assert res.headers.get("content-type") == "audio/x-wav"
+
+@pytest.mark.anyio
+async def test_blob_with_a_bad_signature_is_forbidden(client, blob, monkeypatch):
+    _, _, url = blob
+    monkeypatch.setattr(get_storage(), "sendfile_header", "X-Accel-Redirect")
+
+    res = await client.get(url.replace("signature=", "signature=0"))
+
+    assert res.status_code == 403, res.text
+    assert "x-accel-redirect" not in res.headers
+
+def test_incomplete_backend_fails_on_instantiation():
+    class UploadOnlyStorage(BaseStorage):
+        async def upload(self, blob_name, file, content_type):
+            return True, {"size": 0}
+
+    with pytest.raises(TypeError, match="delete"):
+        UploadOnlyStorage()
+
+    # the shipped backends implement the whole interface
+    LocalStorage()
+    AzureStorage()
@@ -0,0 +1,88 @@
+# Sytem imports
+import uuid
+import asyncio
+
+# test-related imports
+import pytest
+import asyncpg
+
+# FastAPI-related imports
+from app.postgres import async_postgres_db
+
+# requests sent at the same time
+CONCURRENCY = 20
+
+@pytest.fixture
+def retries(monkeypatch):
+    # serialization failures that Async_Postgres_DB retried, counted from its log
+    events = []
+    info = async_postgres_db.log.info
+
+    def record(component, event, **fields):
+        if event == "Serialization failure, retrying":
+            events.append(fields)
+
+        info(component, event, **fields)
+
+    monkeypatch.setattr(async_postgres_db.log, "info", record)
+
+    return events
+
+@pytest.mark.anyio
+async def test_concurrent_sign_ups_with_the_same_username(client, postgres_url):
+    username = f"u{uuid.uuid4().hex[:12]}"
+
+    responses = await asyncio.gather(*[
+        client.post("/users/", data={"username": username, "email": f"{username}.{i}@example.com", "password": "password", "full_name": "Test User"})
+        for i in range(CONCURRENCY)
+    ])
+    status_codes = [res.status_code for res in responses]
+
+    # one wins, every other one is told the username is taken
+    assert status_codes.count(201) == 1, status_codes
+    assert status_codes.count(409) == CONCURRENCY - 1, status_codes
+
+    conn = await asyncpg.connect(postgres_url)
+
+    try:
+        assert await conn.fetchval("SELECT count(*) FROM users WHERE username = $1", username) == 1
+    finally:
+        await conn.close()
+
+@pytest.mark.anyio
+async def test_concurrent_updates_of_the_same_user(client, new_user, postgres_url, retries):
+    user = await new_user()
+    usernames = [f"u{uuid.uuid4().hex[:12]}" for _ in range(CONCURRENCY)]
+
+    # SERIALIZABLE, overlapping updates of the row fail with 40001 and are retried
+    responses = await asyncio.gather(*[
+        client.put("/users/", data={"username": username, "email": f"{username}@example.com", "full_name": "Test User"}, headers=user.get("headers"))
+        for username in usernames
+    ])
+    status_codes = [res.status_code for res in responses]
+
+    assert set(status_codes) <= {202, 409}, [res.text for res in responses if res.status_code not in [202, 409]]
+    assert len(retries) > 0
+
+    accepted = {username for username, res in zip(usernames, responses) if res.status_code == 202}
+    assert len(accepted) > 0
+
+    conn = await asyncpg.connect(postgres_url)
+
+    try:
+        row = await conn.fetchrow("SELECT username, email FROM users WHERE id = $1", user.get("id"))
+    finally:
+        await conn.close()
+
+    # the last accepted update, whole, never a mix of two of them
+    assert row["username"] in accepted
+    assert row["email"] == f"{row['username']}@example.com"
+
+@pytest.mark.anyio
+async def test_update_to_a_taken_username_conflicts(client, new_user):
+    user = await new_user()
+    other = await new_user()
+
+    res = await client.put("/users/", data={"username": other.get("username"), "email": f"{uuid.uuid4().hex}@example.com", "full_name": "Test User"}, headers=user.get("headers"))
+
+    assert res.status_code == 409, res.text
@@ -0,0 +1,36 @@
+# Sytem imports
+import sys
+import stat
+
+# test-related imports
+import pytest
+
+# FastAPI-related imports
+from app import waveform
+
+# stands in for ffmpeg: logs far more than a pipe buffer to stderr before it writes a second of silence as wav to stdout
+NOISY_FFMPEG = f"""#!{sys.executable}
+import sys, struct
+
+sys.stderr.write("[mp3 @ 0x0] invalid frame header\\n" * 20000)
+sys.stderr.flush()
+
+frames = 8000
+sys.stdout.buffer.write(b"RIFF" + struct.pack("<I", 36 + frames * 2) + b"WAVE")
+sys.stdout.buffer.write(b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, 8000, 16000, 2, 16))
+sys.stdout.buffer.write(b"data" + struct.pack("<I", frames * 2) + bytes(frames * 2))
+"""
+
+@pytest.mark.anyio
+async def test_waveform_of_noisy_decode_does_not_hang(tmp_path, monkeypatch):
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(NOISY_FFMPEG)
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(waveform, "FFMPEG_PATH", str(ffmpeg))
+
+    # hung before stderr was drained, ffmpeg blocked on its full stderr pipe while stdout was read
+    success, res = await waveform.compute_waveform(str(tmp_path / "damaged.mp3"))
+
+    assert success, res.get("error")
+    assert res.get("duration") == 1.0
+    assert res.get("sample_rate") == 8000